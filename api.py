@@ -2,25 +2,18 @@ from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import JSONResponse
-import hmac
-import hashlib
 import json
-import os
-import asyncpg
-from typing import Optional, Dict, List
-from datetime import datetime
 import logging
 
+from config import DATABASE_URL
+from database import Database
+from webapp_auth import validate_telegram_data
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-# Настройки
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-DATABASE_URL = os.getenv("DATABASE_URL")
-OWNER_ID = 989062605
-
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -33,111 +26,16 @@ app.add_middleware(
 # Подключаем статические файлы
 app.mount("/", StaticFiles(directory="mini_app", html=True), name="static")
 
-class Database:
-    def __init__(self, dsn: str):
-        self.dsn = dsn
-        self.pool = None
-    
-    async def connect(self):
-        self.pool = await asyncpg.create_pool(self.dsn)
-        logger.info("✅ API подключен к БД")
-    
-    async def close(self):
-        if self.pool:
-            await self.pool.close()
-    
-    async def get_user(self, user_id: int) -> Optional[Dict]:
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('SELECT * FROM users WHERE user_id = $1', user_id)
-            return dict(row) if row else None
-    
-    async def get_unanswered_count(self, user_id: int) -> int:
-        async with self.pool.acquire() as conn:
-            return await conn.fetchval('''
-                SELECT COUNT(*) FROM messages 
-                WHERE user_id = $1 AND is_answered = FALSE
-            ''', user_id)
-    
-    async def save_message(self, user_id: int, text: str) -> int:
-        async with self.pool.acquire() as conn:
-            result = await conn.fetchrow('''
-                UPDATE message_counter SET last_message_id = last_message_id + 1 WHERE id = 1 RETURNING last_message_id
-            ''')
-            message_id = result['last_message_id']
-            
-            await conn.execute('''
-                INSERT INTO messages (message_id, user_id, content_type, text)
-                VALUES ($1, $2, 'text', $3)
-            ''', message_id, user_id, text)
-            
-            return message_id
-    
-    async def get_user_inbox(self, user_id: int) -> List[Dict]:
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT m.message_id, m.answered_at, m.answered_by, m.answer_text,
-                       a.first_name as answered_by_name,
-                       orig.text as original_text
-                FROM messages m
-                JOIN messages orig ON m.message_id = orig.message_id
-                LEFT JOIN users a ON m.answered_by = a.user_id
-                WHERE m.user_id = $1 AND m.is_answered = TRUE
-                ORDER BY m.answered_at DESC
-            ''', user_id)
-            return [dict(row) for row in rows]
-    
-    async def get_user_sent(self, user_id: int) -> List[Dict]:
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT m.*, 
-                       a.first_name as answered_by_name
-                FROM messages m
-                LEFT JOIN users a ON m.answered_by = a.user_id
-                WHERE m.user_id = $1
-                ORDER BY m.forwarded_at DESC
-            ''', user_id)
-            return [dict(row) for row in rows]
-    
-    async def is_admin(self, user_id: int) -> bool:
-        if user_id == OWNER_ID:
-            return True
-        async with self.pool.acquire() as conn:
-            exists = await conn.fetchval(
-                'SELECT EXISTS(SELECT 1 FROM admins WHERE user_id = $1 AND is_active = TRUE)',
-                user_id
-            )
-            return exists
-
 db = Database(DATABASE_URL)
 
 @app.on_event("startup")
 async def startup():
-    await db.connect()
+    await db.create_pool()
 
 @app.on_event("shutdown")
 async def shutdown():
     await db.close()
 
-def validate_telegram_data(init_data: str) -> Optional[Dict]:
-    try:
-        data = {}
-        for item in init_data.split('&'):
-            if '=' in item:
-                key, value = item.split('=', 1)
-                data[key] = value
-        
-        hash_check = data.pop('hash', '')
-        data_check_string = '\n'.join(f"{k}={v}" for k, v in sorted(data.items()))
-        secret_key = hashlib.sha256(BOT_TOKEN.encode()).digest()
-        h = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256)
-        
-        if h.hexdigest() == hash_check:
-            return data
-        return None
-    except Exception as e:
-        logger.error(f"Validation error: {e}")
-        return None
-
 @app.get("/")
 async def root():
     return JSONResponse({"message": "Mini App Bot API is running"})
@@ -240,7 +138,8 @@ async def send_message(request: Request):
         user = json.loads(user_data.get('user', '{}'))
         user_id = int(user.get('id'))
         
-        message_id = await db.save_message(user_id, text)
+        message_id = await db.get_next_message_id()
+        await db.save_message(message_id, user_id, 'text', text=text)
         
         return {"ok": True, "message_id": message_id}
     except Exception as e:
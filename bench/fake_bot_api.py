@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# Заглушка Telegram Bot API для нагрузочных тестов: бот подключается через TELEGRAM_API_URL
+#
+#   python bench/fake_bot_api.py --port 18081 --api-latency sendMessage=lognormal:80,0.6 --api-chat-rate 1 --api-error-rate 0.01
+#   TELEGRAM_API_URL=http://127.0.0.1:18081 python main.py
+#
+# Апдейты для бота: POST /fake/updates (JSON-апдейт или список), статистика: GET /fake/stats
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List
+
+from aiohttp import web
+
+SEND_METHODS = ('sendMessage', 'sendPhoto', 'sendVideo', 'sendVoice', 'sendSticker', 'sendDocument')
+INJECTED_ERRORS = {
+    400: 'Bad Request: chat not found',
+    403: 'Forbidden: bot was blocked by the user',
+    500: 'Internal Server Error',
+    502: 'Bad Gateway',
+}
+
+# ==================== Latency Models ====================
+def parse_latency(spec: str) -> Callable[[], float]:
+    # Миллисекунды: "fixed:50", "uniform:20-80", "lognormal:<медиана>,<sigma>", "exp:<среднее>"
+    kind, _, value = spec.partition(':')
+    if kind == 'fixed':
+        delay = float(value)
+        return lambda: delay
+    if kind == 'uniform':
+        low, high = (float(part) for part in value.split('-'))
+        return lambda: random.uniform(low, high)
+    if kind == 'lognormal':
+        median, sigma = (float(part) for part in value.split(','))
+        return lambda: median * random.lognormvariate(0, sigma)
+    if kind == 'exp':
+        mean = float(value)
+        return lambda: random.expovariate(1 / mean) if mean else 0.0
+    raise ValueError(f"Неизвестная модель задержки: {spec}")
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        # 0 — запрос разрешён, иначе через сколько секунд появится токен
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+# ==================== Fake Bot API ====================
+class FakeBotAPI:
+    def __init__(self, latency: Dict[str, str] = None, error_rate: float = 0.0, error_codes=(400, 403, 500),
+                 rate_limit_rate: float = 0.0, retry_after: int = 1, chat_rate: float = 0.0, global_rate: float = 0.0):
+        # latency: {метод или 'default': спецификация}; getUpdates задержку не получает — это long polling
+        self.latency = {method: parse_latency(spec) for method, spec in (latency or {}).items()}
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        # Лимиты отправки как у Telegram: ~1 сообщение в секунду в чат и ~30 в секунду всего
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate) if global_rate else None
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.updates: List[Dict] = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.calls = Counter()
+        self.responses = defaultdict(Counter)
+        self.sent_to = Counter()
+        self._new_updates = asyncio.Event()
+        self.app = web.Application()
+        self.app.router.add_post('/fake/updates', self.push_updates_handler)
+        self.app.router.add_get('/fake/stats', self.stats_handler)
+        self.app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        self._runner = None
+
+    @classmethod
+    def from_args(cls, args) -> 'FakeBotAPI':
+        latency = {}
+        for item in args.api_latency or ():
+            method, _, spec = item.rpartition('=')
+            latency[method or 'default'] = spec
+        return cls(latency=latency, error_rate=args.api_error_rate, error_codes=[int(code) for code in args.api_error_codes.split(',')],
+                   rate_limit_rate=args.api_429_rate, retry_after=args.api_retry_after,
+                   chat_rate=args.api_chat_rate, global_rate=args.api_global_rate)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 18081):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def stats(self) -> Dict:
+        return {
+            'calls': dict(self.calls),
+            'responses': {method: dict(codes) for method, codes in self.responses.items()},
+            'chats': len(self.sent_to),
+            'pending_updates': len(self.updates),
+        }
+
+    def push_update(self, update: Dict):
+        update['update_id'] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(update)
+        self._new_updates.set()
+
+    def push_message(self, user_id: int, text: str, first_name: str = 'Bench'):
+        self.push_update({'message': {
+            'message_id': self._message_id(),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': first_name},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': first_name},
+            'text': text,
+        }})
+
+    def _message_id(self) -> int:
+        self.next_message_id += 1
+        return self.next_message_id
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(await request.post()) if request.method == 'POST' else dict(request.query)
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return self.ok(method, await self.get_updates(params))
+
+        delay = self.latency.get(method) or self.latency.get('default')
+        if delay:
+            await asyncio.sleep(max(delay(), 0) / 1000)
+
+        if method in SEND_METHODS:
+            chat_id = int(params.get('chat_id', 0))
+            retry_after = self._flood_wait(chat_id)
+            if retry_after:
+                return self.error(method, 429, f'Too Many Requests: retry after {retry_after}', {'retry_after': retry_after})
+        # Служебные вызовы старта не ломаем: иначе бот не запустится и тест не начнётся
+        if method not in ('getMe', 'deleteWebhook') and self.error_rate and random.random() < self.error_rate:
+            code = random.choice(self.error_codes)
+            return self.error(method, code, INJECTED_ERRORS.get(code, 'Injected error'))
+
+        if method == 'getMe':
+            return self.ok(method, {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'})
+        if method in ('deleteWebhook', 'setWebhook', 'answerCallbackQuery', 'deleteMessage'):
+            return self.ok(method, True)
+        if method in SEND_METHODS:
+            self.sent_to[chat_id] += 1
+            return self.ok(method, self._sent_message(method, chat_id, params))
+        return self.error(method, 404, 'Not Found: method not found')
+
+    def _flood_wait(self, chat_id: int) -> int:
+        if self.rate_limit_rate and random.random() < self.rate_limit_rate:
+            return self.retry_after
+        waits = []
+        if self.global_bucket:
+            waits.append(self.global_bucket.take())
+        if self.chat_rate:
+            bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, 1))
+            waits.append(bucket.take())
+        wait = max(waits, default=0)
+        return max(1, round(wait)) if wait else 0
+
+    def _sent_message(self, method: str, chat_id: int, params: Dict) -> Dict:
+        message = {'message_id': self._message_id(), 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        if method == 'sendMessage':
+            message['text'] = params.get('text', '')
+        elif 'caption' in params:
+            message['caption'] = params['caption']
+        return message
+
+    async def get_updates(self, params: Dict) -> List[Dict]:
+        offset = int(params.get('offset', 0) or 0)
+        timeout = float(params.get('timeout', 0) or 0)
+        limit = int(params.get('limit', 100) or 100)
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    async def push_updates_handler(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        for update in data if isinstance(data, list) else [data]:
+            self.push_update(update)
+        return web.json_response({'ok': True, 'pending': len(self.updates)})
+
+    async def stats_handler(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def ok(self, method: str, result) -> web.Response:
+        self.responses[method][200] += 1
+        return web.Response(text=json.dumps({'ok': True, 'result': result}), content_type='application/json')
+
+    def error(self, method: str, code: int, description: str, parameters: Dict = None) -> web.Response:
+        self.responses[method][code] += 1
+        body = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            body['parameters'] = parameters
+        return web.Response(status=code, text=json.dumps(body), content_type='application/json')
+
+def add_arguments(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group('заглушка Bot API')
+    group.add_argument('--api-latency', action='append', metavar='[METHOD=]SPEC',
+                       help='задержка ответа, мс: fixed:50, uniform:20-80, lognormal:80,0.6, exp:50; без METHOD — для всех')
+    group.add_argument('--api-error-rate', type=float, default=0.0, help='доля запросов с ошибкой')
+    group.add_argument('--api-error-codes', default='400,403,500', help='коды ошибок для инъекции')
+    group.add_argument('--api-429-rate', type=float, default=0.0, help='доля send*-запросов со случайным 429')
+    group.add_argument('--api-retry-after', type=int, default=1, help='retry_after для случайных 429, с')
+    group.add_argument('--api-chat-rate', type=float, default=0.0, help='лимит сообщений в секунду на чат (Telegram: 1)')
+    group.add_argument('--api-global-rate', type=float, default=0.0, help='общий лимит сообщений в секунду (Telegram: 30)')
+
+async def serve(args):
+    fake = FakeBotAPI.from_args(args)
+    await fake.start(args.host, args.port)
+    print(f"Заглушка Bot API: http://{args.host}:{args.port} (TELEGRAM_API_URL)")
+    await asyncio.Event().wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальная заглушка Telegram Bot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18081)
+    add_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
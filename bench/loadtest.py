@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+# Нагрузочный тест: main.py на локальном Postgres + заглушка Bot API из fake_bot_api.py
+#
+#   python bench/loadtest.py --database-url postgresql://postgres@127.0.0.1:5432/bot_bench --users 50 --duration 60
+#
+# Нужна отдельная БД: тест создаёт пользователей и сообщения (с --cleanup удаляет их в конце).
+#
+#   python bench/loadtest.py --database-url ... --users 20 --duration 14400 --soak --del-share 0.02
+#
+# --soak: раз в --sample-interval снимаются RSS, файловые дескрипторы, соединения Postgres, задачи asyncio,
+# занятость пула, размеры структур в памяти и p95 по эндпоинтам; растущий тренд любого из них — код выхода 1.
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import asyncpg
+
+from fake_bot_api import FakeBotAPI, add_arguments
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_TOKEN = '123456:BENCH-TOKEN'
+# /metrics закрыт токеном администратора
+BENCH_ADMIN_TOKEN = 'bench-admin-token'
+METRICS_HEADERS = {'Authorization': f'Bearer {BENCH_ADMIN_TOKEN}'}
+BENCH_USER_ID_START = 7_000_000_000
+OWNER_ID = 989062605
+
+# ==================== Helpers ====================
+def make_init_data(user: Dict, token: str = BENCH_TOKEN) -> str:
+    # Подпись как у Telegram: HMAC-SHA256 с ключом HMAC("WebAppData", token)
+    fields = {'auth_date': str(int(time.time())), 'user': json.dumps(user, separators=(',', ':'), ensure_ascii=False)}
+    check_string = '\n'.join(f'{key}={value}' for key, value in sorted(fields.items()))
+    secret = hmac.new(b'WebAppData', token.encode(), hashlib.sha256).digest()
+    fields['hash'] = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return urllib.parse.urlencode(fields)
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.db_queries: Dict[str, List[int]] = defaultdict(list)
+        self.errors: Dict[str, Counter] = defaultdict(Counter)
+        self.window_start: Dict[str, int] = {}
+
+    def record(self, endpoint: str, seconds: float, db_queries, error: str = None):
+        self.latencies[endpoint].append(seconds)
+        if db_queries is not None:
+            self.db_queries[endpoint].append(int(db_queries))
+        if error:
+            self.errors[endpoint][error] += 1
+
+    def window_p95(self) -> Dict[str, float]:
+        # p95 по запросам с прошлого вызова: soak-режиму важна динамика, а не итог за весь тест
+        result = {}
+        for endpoint, values in self.latencies.items():
+            start = self.window_start.get(endpoint, 0)
+            if len(values) > start:
+                result[endpoint] = percentile(values[start:], 0.95)
+            self.window_start[endpoint] = len(values)
+        return result
+
+    def summary(self, duration: float) -> Dict[str, Dict]:
+        result = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            queries = self.db_queries.get(endpoint, [])
+            result[endpoint] = {
+                'requests': len(values),
+                'rps': round(len(values) / duration, 1),
+                'errors': sum(self.errors[endpoint].values()),
+                'error_kinds': dict(self.errors[endpoint]),
+                'p50_ms': round(percentile(values, 0.50) * 1000, 1),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 1),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 1),
+                'max_ms': round(max(values) * 1000, 1),
+                'db_queries_avg': round(sum(queries) / len(queries), 2) if queries else None,
+            }
+        return result
+
+# ==================== Application Process ====================
+async def start_app(args) -> asyncio.subprocess.Process:
+    env = dict(os.environ)
+    env.update({
+        'BOT_TOKEN': BENCH_TOKEN,
+        'ADMIN_API_TOKEN': BENCH_ADMIN_TOKEN,
+        'DATABASE_URL': args.database_url,
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{args.bot_api_port}',
+        'PORT': str(args.port),
+        'APP_URL': f'http://127.0.0.1:{args.port}',
+        'RATE_LIMIT_MINUTES': '0',
+        'KEEP_WARM_ENABLED': '0',
+        'LOG_LEVEL': args.app_log_level,
+    })
+    log = open(args.app_log, 'w')
+    return await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT_DIR, 'main.py'), cwd=ROOT_DIR, env=env, stdout=log, stderr=log)
+
+async def stop_app(process: asyncio.subprocess.Process):
+    if process.returncode is not None:
+        return
+    process.terminate()
+    try:
+        await asyncio.wait_for(process.wait(), 10)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+async def wait_ready(session: aiohttp.ClientSession, base_url: str, process, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.returncode is not None:
+            raise RuntimeError(f"main.py завершился с кодом {process.returncode}, см. лог приложения")
+        try:
+            async with session.get(f'{base_url}/ready') as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"Приложение не стало готовым за {timeout:.0f} с")
+
+async def seed_users(database_url: str, user_ids: List[int]):
+    conn = await asyncpg.connect(database_url)
+    try:
+        await conn.executemany('''
+            INSERT INTO users (user_id, username, first_name, accepted_tos) VALUES ($1, $2, 'Bench', TRUE)
+            ON CONFLICT (user_id) DO UPDATE SET accepted_tos = TRUE, is_banned = FALSE
+        ''', [(user_id, f'bench{user_id}') for user_id in user_ids])
+    finally:
+        await conn.close()
+
+async def cleanup_users(database_url: str, user_ids: List[int]):
+    conn = await asyncpg.connect(database_url)
+    try:
+        await conn.execute('DELETE FROM users WHERE user_id = ANY($1::bigint[])', user_ids)
+        await conn.execute('DELETE FROM message_tombstones WHERE user_id = ANY($1::bigint[])', user_ids)
+    finally:
+        await conn.close()
+
+async def scrape_metrics(session: aiohttp.ClientSession, base_url: str) -> Dict[str, Dict]:
+    # Среднее время обработчиков aiogram из /metrics приложения
+    async with session.get(f'{base_url}/metrics', headers=METRICS_HEADERS) as response:
+        text = await response.text()
+    handlers = defaultdict(dict)
+    for line in text.splitlines():
+        if line.startswith('bot_handler_duration_seconds_sum') or line.startswith('bot_handler_duration_seconds_count'):
+            name, value = line.rsplit(' ', 1)
+            handler = name.split('handler="', 1)[1].split('"', 1)[0]
+            handlers[handler]['sum' if '_sum' in name else 'count'] = float(value)
+    return {
+        handler: {'count': int(values.get('count', 0)), 'avg_ms': round(values.get('sum', 0) / values['count'] * 1000, 1) if values.get('count') else None}
+        for handler, values in sorted(handlers.items())
+    }
+
+# ==================== Workload ====================
+class VirtualUser:
+    def __init__(self, user_id: int, session: aiohttp.ClientSession, base_url: str, stats: Stats, sent_ids: List[int]):
+        self.user = {'id': user_id, 'first_name': 'Bench', 'username': f'bench{user_id}'}
+        self.session = session
+        self.base_url = base_url
+        self.stats = stats
+        self.sent_ids = sent_ids
+        self.etags: Dict[str, str] = {}
+        self.init_data = make_init_data(self.user)
+
+    async def request(self, endpoint: str, method: str, path: str, **kwargs):
+        started = time.perf_counter()
+        error = None
+        db_queries = None
+        try:
+            async with self.session.request(method, f'{self.base_url}{path}', **kwargs) as response:
+                body = await response.read()
+                db_queries = response.headers.get('X-DB-Queries')
+                if response.status not in (200, 304):
+                    error = f'http_{response.status}'
+                elif response.status == 200 and response.content_type == 'application/json':
+                    data = json.loads(body)
+                    if isinstance(data, dict) and data.get('ok') is False:
+                        error = str(data.get('error'))
+                    return response.status, response.headers, data
+                return response.status, response.headers, None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = type(e).__name__
+            return None, {}, None
+        finally:
+            self.stats.record(endpoint, time.perf_counter() - started, db_queries, error)
+
+    async def auth(self):
+        await self.request('auth', 'POST', '/api/auth', json={'initData': self.init_data})
+
+    async def send(self):
+        text = f"Нагрузочный тест {random.randint(1, 10 ** 9)}"
+        status, headers, data = await self.request('send', 'POST', '/api/send', json={'initData': self.init_data, 'text': text})
+        if data and data.get('ok') and data.get('message_id'):
+            self.sent_ids.append(data['message_id'])
+
+    async def messages(self, box: str):
+        # Как браузер: повторный запрос с If-None-Match
+        headers = {'X-Telegram-Init-Data': self.init_data}
+        if box in self.etags:
+            headers['If-None-Match'] = self.etags[box]
+        status, response_headers, data = await self.request(box, 'GET', f'/api/messages/{box}', headers=headers)
+        if status == 200 and response_headers.get('ETag'):
+            self.etags[box] = response_headers['ETag']
+
+    async def run(self, deadline: float, rate: float, mix: Dict[str, float]):
+        actions = {'auth': self.auth, 'send': self.send, 'inbox': lambda: self.messages('inbox'), 'sent': lambda: self.messages('sent')}
+        names = [name for name in mix if name in actions]
+        weights = [mix[name] for name in names]
+        await self.auth()
+        while time.monotonic() < deadline:
+            await asyncio.sleep(random.expovariate(rate))
+            if time.monotonic() >= deadline:
+                break
+            await actions[random.choices(names, weights)[0]]()
+
+async def chat_updates(fake: FakeBotAPI, user_ids: List[int], sent_ids: List[int], rate: float, answer_share: float,
+                       del_share: float, deadline: float) -> int:
+    # Поток апдейтов: сообщения пользователей в чат, ответы владельца "#ID текст"
+    # и /del без подтверждения — каждый оставляет запись в delete_confirmations
+    pushed = 0
+    while time.monotonic() < deadline:
+        await asyncio.sleep(random.expovariate(rate))
+        if sent_ids and random.random() < del_share:
+            fake.push_message(OWNER_ID, f"/del #{random.choice(sent_ids)}", 'Owner')
+        elif sent_ids and random.random() < answer_share:
+            fake.push_message(OWNER_ID, f"#{sent_ids.pop(random.randrange(len(sent_ids)))} Ответ из нагрузочного теста", 'Owner')
+        else:
+            fake.push_message(random.choice(user_ids), random.choice(['/help', '/app', 'Сообщение в чат']))
+        pushed += 1
+    return pushed
+
+# ==================== Soak ====================
+# Абсолютный рост, ниже которого тренд считается шумом, по типу ряда
+SOAK_FLOORS = {'rss_mb': 20, 'open_fds': 10, 'pg_connections': 2, 'asyncio_tasks': 10, 'pool_in_use': 2, 'items': 20, 'p95_ms': 20}
+
+def process_rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+def process_open_fds(pid: int) -> Optional[int]:
+    try:
+        return len(os.listdir(f'/proc/{pid}/fd'))
+    except OSError:
+        return None
+
+async def scrape_gauges(session: aiohttp.ClientSession, base_url: str) -> Dict[str, float]:
+    async with session.get(f'{base_url}/metrics', headers=METRICS_HEADERS) as response:
+        text = await response.text()
+    gauges = {}
+    for line in text.splitlines():
+        if line.startswith(('asyncio_tasks', 'db_pool_connections', 'app_in_memory_items')):
+            name, value = line.rsplit(' ', 1)
+            gauges[name] = float(value)
+    return gauges
+
+async def soak_sample(session: aiohttp.ClientSession, base_url: str, pid: int, conn, stats: Stats) -> Dict[str, float]:
+    gauges = await scrape_gauges(session, base_url)
+    sample = {
+        'rss_mb': process_rss_mb(pid),
+        'open_fds': process_open_fds(pid),
+        'pg_connections': await conn.fetchval(
+            'SELECT COUNT(*) FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid()'
+        ),
+        'asyncio_tasks': gauges.get('asyncio_tasks'),
+        'pool_in_use': gauges.get('db_pool_connections{state="in_use"}'),
+    }
+    for name, value in gauges.items():
+        if name.startswith('app_in_memory_items'):
+            structure = name.split('structure="', 1)[1].split('"', 1)[0]
+            sample[f'items.{structure}'] = value
+    for endpoint, p95 in stats.window_p95().items():
+        sample[f'p95_ms.{endpoint}'] = round(p95 * 1000, 1)
+    return {key: value for key, value in sample.items() if value is not None}
+
+async def soak_sampler(session: aiohttp.ClientSession, base_url: str, process, database_url: str, stats: Stats,
+                       interval: float, deadline: float) -> List[Dict]:
+    samples = []
+    conn = await asyncpg.connect(database_url)
+    try:
+        started = time.monotonic()
+        while time.monotonic() + interval <= deadline:
+            await asyncio.sleep(interval)
+            try:
+                sample = await soak_sample(session, base_url, process.pid, conn, stats)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"[soak] замер пропущен: {type(e).__name__}")
+                continue
+            sample['t'] = round(time.monotonic() - started, 1)
+            samples.append(sample)
+            print(f"[soak] {sample['t']:>7.0f} с  RSS {sample.get('rss_mb')} МБ, fd {sample.get('open_fds')}, "
+                  f"pg {sample.get('pg_connections')}, задач {sample.get('asyncio_tasks')}, пул {sample.get('pool_in_use')}", flush=True)
+    finally:
+        await conn.close()
+    return samples
+
+def theil_sen_slope(points: List[Tuple[float, float]]) -> float:
+    # Медиана наклонов по всем парам: одиночные выбросы (GC, пауза диска) тренд не создают
+    slopes = [(y2 - y1) / (x2 - x1) for i, (x1, y1) in enumerate(points) for x2, y2 in points[i + 1:] if x2 != x1]
+    return statistics.median(slopes) if slopes else 0.0
+
+def soak_trends(samples: List[Dict], warmup: float, tolerance: float) -> Dict[str, Dict]:
+    # Прогрев (кэши, пул, JIT-аллокации) в тренд не входит
+    steady = [sample for sample in samples if sample['t'] >= warmup]
+    trends = {}
+    for key in sorted({key for sample in steady for key in sample if key != 't'}):
+        points = [(sample['t'], sample[key]) for sample in steady if key in sample]
+        if len(points) < 5:
+            continue
+        slope = theil_sen_slope(points)
+        growth = slope * (points[-1][0] - points[0][0])
+        start = statistics.median(value for _, value in points[:3])
+        limit = max(SOAK_FLOORS[key.split('.')[0]], tolerance * abs(start))
+        trends[key] = {
+            'start': start,
+            'end': statistics.median(value for _, value in points[-3:]),
+            'per_hour': round(slope * 3600, 2),
+            'growth': round(growth, 2),
+            'limit': round(limit, 2),
+            'failed': growth > limit,
+        }
+    return trends
+
+def print_soak_report(soak: Dict):
+    print(f"\nSoak: замеров {len(soak['samples'])}, прогрев {soak['warmup_s']:.0f} с, допуск {soak['tolerance'] * 100:.0f}%")
+    if not soak['trends']:
+        print("Недостаточно замеров после прогрева для оценки трендов (нужно минимум 5)")
+        return
+    print(f"{'series':<36} {'start':>9} {'end':>9} {'в час':>9} {'рост':>9} {'предел':>9}")
+    for key, row in soak['trends'].items():
+        flag = '  РОСТ' if row['failed'] else ''
+        print(f"{key:<36} {row['start']:>9} {row['end']:>9} {row['per_hour']:>9} {row['growth']:>9} {row['limit']:>9}{flag}")
+    if soak['failed']:
+        print(f"\nТест не пройден: растут {', '.join(soak['failed'])}")
+
+def print_report(result: Dict):
+    print(f"\nДлительность {result['duration_s']} с, пользователей {result['users']}, апдейтов в чат {result['updates_pushed']}")
+    print(f"{'endpoint':<10} {'req':>7} {'rps':>7} {'err':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'db q':>6}")
+    for endpoint, row in result['endpoints'].items():
+        queries = '-' if row['db_queries_avg'] is None else f"{row['db_queries_avg']:.1f}"
+        print(f"{endpoint:<10} {row['requests']:>7} {row['rps']:>7} {row['errors']:>5} {row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8} {row['max_ms']:>8} {queries:>6}")
+        if row['error_kinds']:
+            print(f"{'':<10} ошибки: {row['error_kinds']}")
+    if result['handlers']:
+        print("\nОбработчики aiogram (среднее):")
+        for handler, row in result['handlers'].items():
+            print(f"  {handler:<28} {row['count']:>6}  {row['avg_ms']} мс")
+    print(f"\nВызовы Bot API: {result['bot_api']['calls']}")
+    print(f"Ответы Bot API по кодам: {result['bot_api']['responses']}")
+    if result.get('soak'):
+        print_soak_report(result['soak'])
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Нагрузочный тест main.py против локального Postgres и заглушки Bot API')
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'), help='отдельная БД для теста (или BENCH_DATABASE_URL)')
+    parser.add_argument('--users', type=int, default=50, help='число виртуальных пользователей Mini App')
+    parser.add_argument('--rate', type=float, default=1.0, help='запросов в секунду на пользователя')
+    parser.add_argument('--mix', default='auth=1,inbox=4,sent=3,send=2', help='веса действий')
+    parser.add_argument('--updates-rate', type=float, default=5.0, help='апдейтов в секунду в чат бота')
+    parser.add_argument('--answer-share', type=float, default=0.3, help='доля апдейтов — ответы владельца на отправленные сообщения')
+    parser.add_argument('--del-share', type=float, default=0.0, help='доля апдейтов — /del владельца без подтверждения')
+    parser.add_argument('--duration', type=float, default=60, help='длительность, с')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--bot-api-port', type=int, default=18081)
+    parser.add_argument('--app-log', default='loadtest-app.log')
+    parser.add_argument('--app-log-level', default='WARNING')
+    parser.add_argument('--json', help='сохранить результат в JSON-файл')
+    parser.add_argument('--cleanup', action='store_true', help='удалить тестовых пользователей и их сообщения в конце')
+    group = parser.add_argument_group('soak-режим')
+    group.add_argument('--soak', action='store_true', help='снимать показатели процесса по ходу теста и проверять их тренды')
+    group.add_argument('--sample-interval', type=float, default=60, help='период замеров, с')
+    group.add_argument('--soak-warmup', type=float, default=300, help='начальный отрезок, не входящий в тренд, с')
+    group.add_argument('--soak-tolerance', type=float, default=0.2, help='допустимый рост за тест, доля начального значения')
+    add_arguments(parser)
+    return parser
+
+async def run(args) -> Dict:
+    base_url = f'http://127.0.0.1:{args.port}'
+    user_ids = [BENCH_USER_ID_START + i for i in range(args.users)]
+    fake = FakeBotAPI.from_args(args)
+    await fake.start(port=args.bot_api_port)
+    process = await start_app(args)
+    stats = Stats()
+    sent_ids: List[int] = []
+    connector = aiohttp.TCPConnector(limit=0)
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as session:
+            await wait_ready(session, base_url, process, 60)
+            await seed_users(args.database_url, user_ids)
+            started = time.monotonic()
+            deadline = started + args.duration
+            mix = parse_mix(args.mix)
+            users = [VirtualUser(user_id, session, base_url, stats, sent_ids) for user_id in user_ids]
+            sampler = asyncio.create_task(soak_sampler(
+                session, base_url, process, args.database_url, stats, args.sample_interval, deadline
+            )) if args.soak else None
+            results = await asyncio.gather(
+                chat_updates(fake, user_ids, sent_ids, args.updates_rate, args.answer_share, args.del_share, deadline) if args.updates_rate > 0 else asyncio.sleep(0, 0),
+                *(user.run(deadline, args.rate, mix) for user in users),
+            )
+            duration = time.monotonic() - started
+            samples = await sampler if sampler else None
+            # Даём боту дочитать очередь апдейтов перед снятием метрик
+            await asyncio.sleep(1)
+            handlers = await scrape_metrics(session, base_url)
+    finally:
+        await stop_app(process)
+        await fake.stop()
+        if args.cleanup:
+            await cleanup_users(args.database_url, user_ids)
+    soak = None
+    if samples is not None:
+        trends = soak_trends(samples, args.soak_warmup, args.soak_tolerance)
+        soak = {
+            'warmup_s': args.soak_warmup,
+            'tolerance': args.soak_tolerance,
+            'trends': trends,
+            'failed': [key for key, row in trends.items() if row['failed']],
+            'samples': samples,
+        }
+    return {
+        'duration_s': round(duration, 1),
+        'users': args.users,
+        'updates_pushed': results[0],
+        'endpoints': stats.summary(duration),
+        'handlers': handlers,
+        'bot_api': fake.stats(),
+        'soak': soak,
+    }
+
+def main():
+    args = build_parser().parse_args()
+    if not args.database_url:
+        sys.exit("Укажите --database-url или BENCH_DATABASE_URL")
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if result['soak'] and result['soak']['failed']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
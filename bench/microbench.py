@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# Микробенчмарки методов Database на засеянных наборах данных и CPU-бенчмарки разбора initData
+#
+#   python bench/microbench.py --database-url postgresql://postgres@127.0.0.1:5432/bot_bench --sizes 10000,100000 --json HEAD.json
+#   python bench/microbench.py --database-url ... --compare BASE.json --json HEAD.json
+#
+# Каждый набор живёт в своей схеме (bench_10000, bench_100000, ...) и засевается один раз; --reseed пересоздаёт.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+import asyncpg
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault('BOT_TOKEN', '123456:BENCH-TOKEN')
+
+from database import Database, QUERY_COUNT  # noqa: E402
+from webapp_auth import parse_init_data_user, validate_telegram_data  # noqa: E402
+from loadtest import make_init_data, percentile  # noqa: E402
+
+MESSAGES_PER_USER = 10
+ANSWERED_SHARE = 0.7
+HEAVY_USER_MESSAGES = 2000
+WRITER_USER_ID = 6_999_999_999
+
+# ==================== Datasets ====================
+def schema_dsn(database_url: str, schema: str) -> str:
+    # Неизвестные asyncpg параметры DSN уходят в server_settings: search_path на всё соединение
+    separator = '&' if '?' in database_url else '?'
+    return f'{database_url}{separator}search_path={schema}'
+
+async def seed_dataset(database_url: str, size: int, reseed: bool) -> str:
+    schema = f'bench_{size}'
+    conn = await asyncpg.connect(database_url)
+    try:
+        if reseed:
+            await conn.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        await conn.execute(f'CREATE SCHEMA IF NOT EXISTS {schema}')
+    finally:
+        await conn.close()
+
+    db = Database(schema_dsn(database_url, schema))
+    await db.create_pool()
+    try:
+        async with db.pool.acquire() as conn:
+            existing = await conn.fetchval('SELECT COUNT(*) FROM messages')
+            if existing >= size:
+                print(f"[{schema}] набор уже засеян: {existing} сообщений")
+                return schema
+            print(f"[{schema}] засев {size} сообщений...")
+            started = time.perf_counter()
+            user_count = max(size // MESSAGES_PER_USER, 10)
+            now = datetime.now()
+            rng = random.Random(size)
+            # Пользователь 1 — «тяжёлый» с длинной историей, остальные — с распределением по степенному закону
+            await conn.copy_records_to_table('users', columns=['user_id', 'username', 'first_name', 'accepted_tos', 'messages_sent', 'last_message_time'], records=(
+                (user_id, f'user{user_id}', f'Имя {user_id}', True, 0, now - timedelta(minutes=rng.randint(0, 60 * 24 * 90)))
+                for user_id in range(1, user_count + 1)
+            ))
+            # История на 90 дней назад: секции messages под неё создаются заранее
+            await db.ensure_message_partitions(now - timedelta(days=91))
+            heavy = min(HEAVY_USER_MESSAGES, size // 10)
+            first_id = 1_000_000
+            records = []
+            for i in range(size):
+                user_id = 1 if i < heavy else 1 + min(int(rng.paretovariate(1.2)), user_count - 1) if rng.random() < 0.3 else rng.randint(2, user_count)
+                forwarded_at = now - timedelta(seconds=rng.randint(0, 90 * 24 * 3600))
+                answered = rng.random() < ANSWERED_SHARE
+                records.append((
+                    first_id + i, user_id, 'text', f'Сообщение {i} ' + 'x' * rng.randint(10, 300), forwarded_at,
+                    answered, 989062605 if answered else None, forwarded_at + timedelta(hours=rng.randint(1, 48)) if answered else None,
+                    f'Ответ {i}' if answered else None,
+                ))
+                if len(records) == 50_000:
+                    await copy_messages(conn, records)
+                    records = []
+            if records:
+                await copy_messages(conn, records)
+            await conn.execute('UPDATE message_counter SET last_message_id = $1 WHERE id = 1', first_id + size)
+            await conn.execute('''
+                INSERT INTO users (user_id, username, first_name, accepted_tos) VALUES ($1, 'writer', 'Writer', TRUE)
+                ON CONFLICT (user_id) DO NOTHING
+            ''', WRITER_USER_ID)
+            await conn.execute('ANALYZE')
+            print(f"[{schema}] готово за {time.perf_counter() - started:.1f} с")
+    finally:
+        await db.close()
+    return schema
+
+async def copy_messages(conn, records):
+    await conn.copy_records_to_table('messages', columns=[
+        'message_id', 'user_id', 'content_type', 'text', 'forwarded_at', 'is_answered', 'answered_by', 'answered_at', 'answer_text'
+    ], records=records)
+
+# ==================== Database Benchmarks ====================
+def database_benchmarks(ctx: Dict) -> Dict[str, Callable]:
+    # ctx: случайные существующие ID, чтобы не мерить один и тот же горячий ряд
+    rng = ctx['rng']
+    user = lambda: rng.randint(2, ctx['user_count'])
+    message = lambda: rng.randint(ctx['first_message_id'], ctx['last_message_id'])
+    db = ctx['db']
+    recent = datetime.now() - timedelta(minutes=5)
+    return {
+        'get_user': lambda: db.get_user(user()),
+        'has_accepted_tos': lambda: db.has_accepted_tos(user()),
+        'get_unanswered_count': lambda: db.get_unanswered_count(user()),
+        'get_user_inbox': lambda: db.get_user_inbox(user()),
+        'get_user_inbox[heavy]': lambda: db.get_user_inbox(1),
+        'get_user_sent': lambda: db.get_user_sent(user()),
+        'get_user_sent[heavy]': lambda: db.get_user_sent(1),
+        'get_user_messages_version': lambda: db.get_user_messages_version(user()),
+        'get_bootstrap_pages': lambda: db.get_bootstrap_pages(user(), 20),
+        'get_bootstrap_pages[heavy]': lambda: db.get_bootstrap_pages(1, 20),
+        'get_user_changes[full]': lambda: db.get_user_changes(user()),
+        'get_user_changes[delta]': lambda: db.get_user_changes(user(), recent),
+        'get_user_full_data': lambda: db.get_user_full_data(user()),
+        'get_message': lambda: db.get_message(message()),
+        'get_message_with_details': lambda: db.get_message_with_details(message()),
+        'get_inbox_message': lambda: db.get_inbox_message(message()),
+        'get_unanswered_requests': lambda: db.get_unanswered_requests(),
+        'get_users_count': lambda: db.get_users_count(),
+        'get_stats': lambda: db.get_stats(),
+        'get_all_users': lambda: db.get_all_users(),
+        'get_admins': lambda: db.get_admins(),
+        'is_admin': lambda: db.is_admin(user()),
+        'save_user': lambda: db.save_user(user_id=WRITER_USER_ID, username='writer', first_name='Writer', last_name=None),
+        'upsert_user': lambda: db.upsert_user(WRITER_USER_ID, 'writer', 'Writer', None),
+        'update_user_stats': lambda: db.update_user_stats(WRITER_USER_ID),
+        'update_user_last_message': lambda: db.update_user_last_message(WRITER_USER_ID, datetime.now()),
+        'update_stats': lambda: db.update_stats(total_messages=1),
+        'save_message': lambda: save_message(db),
+        'mark_message_answered': lambda: db.mark_message_answered(message(), 989062605, 'Ответ бенчмарка'),
+    }
+
+async def save_message(db: Database):
+    message_id = await db.get_next_message_id()
+    await db.save_message(message_id, WRITER_USER_ID, 'text', text='Сообщение бенчмарка')
+
+async def time_async(call: Callable, iterations: int, max_seconds: float) -> Dict:
+    for _ in range(3):
+        await call()
+    durations, queries = [], []
+    deadline = time.perf_counter() + max_seconds
+    for _ in range(iterations):
+        counter = [0]
+        token = QUERY_COUNT.set(counter)
+        started = time.perf_counter()
+        await call()
+        durations.append(time.perf_counter() - started)
+        # Логгер запросов asyncpg срабатывает через call_soon
+        await asyncio.sleep(0)
+        QUERY_COUNT.reset(token)
+        queries.append(counter[0])
+        if time.perf_counter() > deadline:
+            break
+    return summarize(durations, queries)
+
+def summarize(durations: List[float], queries: List[int] = None) -> Dict:
+    return {
+        'iterations': len(durations),
+        'mean_ms': round(sum(durations) / len(durations) * 1000, 4),
+        'p50_ms': round(percentile(durations, 0.50) * 1000, 4),
+        'p95_ms': round(percentile(durations, 0.95) * 1000, 4),
+        'ops_per_s': round(len(durations) / sum(durations), 1),
+        'queries': round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+async def run_database(args, size: int, selected: re.Pattern) -> List[Dict]:
+    schema = await seed_dataset(args.database_url, size, args.reseed)
+    db = Database(schema_dsn(args.database_url, schema))
+    await db.create_pool()
+    results = []
+    try:
+        async with db.pool.acquire() as conn:
+            bounds = await conn.fetchrow('SELECT MIN(message_id) AS first, MAX(message_id) AS last FROM messages')
+            user_count = await conn.fetchval('SELECT COUNT(*) FROM users')
+        ctx = {'db': db, 'rng': random.Random(42), 'user_count': user_count - 2,
+               'first_message_id': bounds['first'], 'last_message_id': bounds['last']}
+        for name, call in database_benchmarks(ctx).items():
+            if not selected.search(f'db.{name}'):
+                continue
+            result = await time_async(call, args.iterations, args.max_seconds)
+            result.update({'name': f'db.{name}', 'dataset': size})
+            results.append(result)
+            print(format_row(result))
+        # Записанное бенчмарками удаляем, чтобы набор оставался сопоставимым между запусками
+        async with db.pool.acquire() as conn:
+            await conn.execute('DELETE FROM messages WHERE user_id = $1', WRITER_USER_ID)
+            await conn.execute('DELETE FROM message_tombstones WHERE user_id = $1', WRITER_USER_ID)
+    finally:
+        await db.close()
+    return results
+
+# ==================== CPU Benchmarks ====================
+def run_cpu(args, selected: re.Pattern) -> List[Dict]:
+    user = {'id': 123456789, 'first_name': 'Иван', 'last_name': 'Петров', 'username': 'ivan_petrov', 'language_code': 'ru', 'allows_write_to_pm': True}
+    valid = make_init_data(user, os.environ['BOT_TOKEN'])
+    tampered = valid.replace('ivan_petrov', 'ivan_petrow')
+    # Иначе обе строки мерили бы один и тот же путь отказа
+    if not isinstance(validate_telegram_data(valid), dict) or validate_telegram_data(tampered) is not None:
+        raise SystemExit("validate_telegram_data не принимает корректную подпись или принимает подделку")
+    benchmarks = {
+        'parse_init_data_user': lambda: parse_init_data_user(valid),
+        'validate_telegram_data[valid]': lambda: validate_telegram_data(valid),
+        'validate_telegram_data[tampered]': lambda: validate_telegram_data(tampered),
+    }
+    results = []
+    for name, call in benchmarks.items():
+        if not selected.search(f'cpu.{name}'):
+            continue
+        # Пачки по 1000 вызовов: время одного вызова меньше разрешения одиночного замера
+        batches = []
+        for _ in range(max(args.iterations // 10, 20)):
+            started = time.perf_counter()
+            for _ in range(1000):
+                call()
+            batches.append((time.perf_counter() - started) / 1000)
+        result = summarize(batches)
+        result.update({'name': f'cpu.{name}', 'dataset': None, 'iterations': len(batches) * 1000})
+        results.append(result)
+        print(format_row(result))
+    return results
+
+# ==================== Report ====================
+def format_row(result: Dict) -> str:
+    dataset = result['dataset'] or '-'
+    queries = '-' if result['queries'] is None else result['queries']
+    return f"{result['name']:<42} {dataset:>8} {result['mean_ms']:>10.4f} {result['p50_ms']:>10.4f} {result['p95_ms']:>10.4f} {result['ops_per_s']:>10} {queries:>6}"
+
+def compare(base_path: str, results: List[Dict]):
+    with open(base_path) as f:
+        base = {(row['name'], row['dataset']): row for row in json.load(f)['results']}
+    print(f"\nСравнение с {base_path} (p50, мс):")
+    print(f"{'benchmark':<42} {'dataset':>8} {'base':>10} {'head':>10} {'delta':>8}")
+    for row in results:
+        old = base.get((row['name'], row['dataset']))
+        if not old:
+            continue
+        delta = (row['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0
+        flag = '  !' if delta > 20 else ''
+        print(f"{row['name']:<42} {row['dataset'] or '-':>8} {old['p50_ms']:>10.4f} {row['p50_ms']:>10.4f} {delta:>+7.1f}%{flag}")
+
+def environment() -> Dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'machine': platform.machine(), 'started_at': datetime.now().isoformat()}
+
+async def run(args) -> Dict:
+    selected = re.compile(args.only or '.')
+    print(f"{'benchmark':<42} {'dataset':>8} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10} {'ops/s':>10} {'db q':>6}")
+    results = run_cpu(args, selected)
+    if args.database_url:
+        for size in (int(size) for size in args.sizes.split(',')):
+            results.extend(await run_database(args, size, selected))
+    meta = environment()
+    if args.database_url:
+        conn = await asyncpg.connect(args.database_url)
+        meta['postgres'] = await conn.fetchval('SHOW server_version')
+        await conn.close()
+    return {'meta': meta, 'results': results}
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарки Database и разбора initData')
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'), help='без БД выполняются только CPU-бенчмарки')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='размеры наборов, сообщений')
+    parser.add_argument('--iterations', type=int, default=200, help='замеров на бенчмарк')
+    parser.add_argument('--max-seconds', type=float, default=5, help='предел времени на один бенчмарк')
+    parser.add_argument('--only', help="регулярное выражение по имени, например 'db.get_user|cpu'")
+    parser.add_argument('--reseed', action='store_true', help='пересоздать наборы данных')
+    parser.add_argument('--json', help='сохранить результат в JSON')
+    parser.add_argument('--compare', help='JSON предыдущего запуска для сравнения')
+    args = parser.parse_args()
+    result = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        compare(args.compare, result['results'])
+
+if __name__ == '__main__':
+    main()
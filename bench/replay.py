@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# Реплей записанных апдейтов (UPDATE_RECORD_PATH) через dp.feed_update на локальном Postgres и заглушке Bot API
+#
+#   UPDATE_RECORD_PATH=updates.jsonl python main.py            # запись на живом боте, апдейты обезличены
+#   python bench/replay.py updates.jsonl --database-url postgresql://postgres@127.0.0.1:5432/bot_bench --json base.json
+#   python bench/replay.py updates.jsonl --database-url ... --speed 10 --compare base.json
+#
+# Каждый запуск начинается с чистой схемы (--schema, по умолчанию replay): результат воспроизводим.
+# Заглушка Bot API слушает REPLAY_API_PORT (18082).
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+import asyncpg
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+API_PORT = int(os.getenv('REPLAY_API_PORT', 18082))
+# config читает окружение при импорте: бот должен ходить только в заглушку, а не в api.telegram.org
+os.environ['TELEGRAM_API_URL'] = f'http://127.0.0.1:{API_PORT}'
+os.environ.setdefault('BOT_TOKEN', '123456:BENCH-TOKEN')
+os.environ.setdefault('RATE_LIMIT_MINUTES', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from aiogram.types import Update  # noqa: E402
+from database import Database, QUERY_COUNT  # noqa: E402
+from main import AnswerHub, MessageForwardingBot  # noqa: E402
+from fake_bot_api import FakeBotAPI, add_arguments  # noqa: E402
+from loadtest import OWNER_ID, percentile  # noqa: E402
+from microbench import schema_dsn  # noqa: E402
+
+# Обработчик, выбранный aiogram для текущего апдейта: словарь на задачу, заполняется inner-middleware
+CURRENT_HANDLER: ContextVar[dict] = ContextVar('replay_handler')
+
+# ==================== Recording ====================
+def load_recording(path: str, limit: int = None) -> List[Dict]:
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+            if limit and len(records) >= limit:
+                break
+    records.sort(key=lambda record: record['ts'])
+    return records
+
+def update_kind(update: Dict) -> str:
+    return next((key for key in update if key != 'update_id'), 'unknown')
+
+async def prepare_schema(database_url: str, schema: str):
+    conn = await asyncpg.connect(database_url)
+    try:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        await conn.execute(f'CREATE SCHEMA {schema}')
+    finally:
+        await conn.close()
+
+# ==================== Replay ====================
+async def handler_name_middleware(handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any, data: Dict[str, Any]) -> Any:
+    current = CURRENT_HANDLER.get(None)
+    if current is not None and data.get('handler') is not None:
+        current['name'] = data['handler'].callback.__name__
+    return await handler(event, data)
+
+async def feed(bot: MessageForwardingBot, record: Dict, index: int, results: List[Dict]):
+    update = Update.model_validate(record['update'], context={'bot': bot.bot})
+    current = {'name': 'unhandled'}
+    CURRENT_HANDLER.set(current)
+    queries = [0]
+    QUERY_COUNT.set(queries)
+    error = None
+    started = time.perf_counter()
+    try:
+        await bot.dp.feed_update(bot.bot, update)
+    except Exception as e:
+        error = type(e).__name__
+    elapsed = time.perf_counter() - started
+    # Логгер запросов asyncpg вызывается через call_soon: один проход цикла, чтобы учесть последние
+    await asyncio.sleep(0)
+    results.append({'index': index, 'kind': update_kind(record['update']), 'handler': current['name'],
+                    'seconds': elapsed, 'queries': queries[0], 'error': error})
+
+async def replay(args, records: List[Dict]) -> Tuple[List[Dict], float, Dict]:
+    fake = FakeBotAPI.from_args(args)
+    await fake.start(port=API_PORT)
+    await prepare_schema(args.database_url, args.schema)
+    db = Database(schema_dsn(args.database_url, args.schema))
+    await db.create_pool()
+    hub = AnswerHub(db)
+    await hub.start()
+    bot = MessageForwardingBot(os.environ['BOT_TOKEN'], db, hub)
+    bot.router.message.middleware(handler_name_middleware)
+    bot.router.callback_query.middleware(handler_name_middleware)
+    await bot.outbox.start()
+    results = []
+    try:
+        # Администраторы из записи — под теми же псевдонимами, иначе их команды уйдут в ветку «нет прав»
+        for admin_id in {record['update'].get(update_kind(record['update']), {}).get('from', {}).get('id') for record in records if record.get('admin')} - {None}:
+            await db.add_admin(admin_id, OWNER_ID)
+        await db.load_admins()
+        await bot.load_closed_state()
+
+        started = time.perf_counter()
+        if args.speed <= 0:
+            # Последовательно, без пауз: максимально воспроизводимый режим
+            for index, record in enumerate(records):
+                await feed(bot, record, index, results)
+        else:
+            # Темп записи, ускоренный в speed раз; апдейты обрабатываются параллельно, как при polling
+            first_ts = records[0]['ts'] if records else 0
+            tasks = []
+            for index, record in enumerate(records):
+                delay = (record['ts'] - first_ts) / args.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(feed(bot, record, index, results)))
+            await asyncio.gather(*tasks)
+        wall = time.perf_counter() - started
+        # Фоновые задачи обработчиков (уведомления, события) и очередь outbox дорабатывают до остановки пула
+        await asyncio.sleep(0.5)
+        await bot.outbox.flush()
+    finally:
+        await bot.outbox.stop()
+        hub.close()
+        await bot.bot.session.close()
+        await db.close()
+        await fake.stop()
+    return results, wall, fake.stats()
+
+# ==================== Report ====================
+def summarize(results: List[Dict]) -> Dict[str, Dict]:
+    groups = defaultdict(list)
+    for result in results:
+        groups[result['handler']].append(result)
+        groups['(все)'].append(result)
+    summary = {}
+    for name, rows in groups.items():
+        seconds = [row['seconds'] for row in rows]
+        summary[name] = {
+            'count': len(rows),
+            'errors': sum(1 for row in rows if row['error']),
+            'mean_ms': round(sum(seconds) / len(seconds) * 1000, 3),
+            'p50_ms': round(percentile(seconds, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(seconds, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(seconds, 0.99) * 1000, 3),
+            'max_ms': round(max(seconds) * 1000, 3),
+            'db_queries': round(sum(row['queries'] for row in rows) / len(rows), 2),
+        }
+    return summary
+
+def print_report(summary: Dict[str, Dict], wall: float, api_stats: Dict):
+    total = summary.get('(все)', {}).get('count', 0)
+    print(f"\nАпдейтов: {total} за {wall:.1f} с ({total / wall if wall else 0:.1f}/с)")
+    print(f"{'handler':<28} {'count':>6} {'err':>4} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'db q':>6}")
+    for name, row in sorted(summary.items(), key=lambda item: -item[1]['count']):
+        print(f"{name:<28} {row['count']:>6} {row['errors']:>4} {row['mean_ms']:>9.2f} {row['p50_ms']:>9.2f} "
+              f"{row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['max_ms']:>9.2f} {row['db_queries']:>6}")
+    print("\nВызовы Bot API: " + ", ".join(f"{method} {count}" for method, count in sorted(api_stats['calls'].items())))
+
+def compare(base_path: str, summary: Dict[str, Dict]):
+    with open(base_path) as f:
+        base = json.load(f)['handlers']
+    print(f"\nСравнение с {base_path} (p50, мс; запросы к БД):")
+    print(f"{'handler':<28} {'base':>9} {'head':>9} {'delta':>8} {'db q':>11}")
+    for name, row in sorted(summary.items()):
+        old = base.get(name)
+        if not old:
+            continue
+        delta = (row['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0
+        # Рост числа запросов — регрессия независимо от шума времени
+        flag = '  !' if delta > 20 or row['db_queries'] > old['db_queries'] else ''
+        print(f"{name:<28} {old['p50_ms']:>9.2f} {row['p50_ms']:>9.2f} {delta:>+7.1f}% {old['db_queries']:>5}->{row['db_queries']:<5}{flag}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Реплей записанных апдейтов через диспетчер aiogram')
+    parser.add_argument('recording', help='JSONL, записанный с UPDATE_RECORD_PATH')
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'), required=not os.getenv('BENCH_DATABASE_URL'))
+    parser.add_argument('--schema', default='replay', help='схема для реплея, пересоздаётся при каждом запуске')
+    parser.add_argument('--speed', type=float, default=0, help='0 — подряд без пауз, 1 — темп записи, N — ускорение в N раз')
+    parser.add_argument('--limit', type=int, help='реплеить только первые N апдейтов')
+    parser.add_argument('--json', help='сохранить результат в JSON')
+    parser.add_argument('--compare', help='JSON предыдущего запуска для сравнения')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    records = load_recording(args.recording, args.limit)
+    results, wall, api_stats = asyncio.run(replay(args, records))
+    summary = summarize(results)
+    print_report(summary, wall, api_stats)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'recording': args.recording, 'speed': args.speed, 'wall_seconds': round(wall, 3),
+                       'handlers': summary, 'updates': results}, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        compare(args.compare, summary)
+
+if __name__ == '__main__':
+    main()
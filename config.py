@@ -0,0 +1,102 @@
+import os
+
+# ==================== Configuration ====================
+OWNER_ID = 989062605
+RATE_LIMIT_MINUTES = int(os.getenv("RATE_LIMIT_MINUTES", 10))
+MAX_BAN_HOURS = 720
+DATABASE_URL = os.getenv("DATABASE_URL")
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Альтернативный адрес Bot API (локальный сервер или заглушка из bench/); по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+APP_URL = os.getenv("APP_URL", "https://mini-app-bot-lzya.onrender.com")
+PORT = int(os.getenv("PORT", 10000))
+MESSAGE_ID_START = 100569
+SYNC_CURSOR_OVERLAP_SECONDS = 5
+# Сколько хранить отметки об удалении; клиент с более старым курсором получает полную синхронизацию
+SYNC_TOMBSTONE_KEEP_DAYS = float(os.getenv("SYNC_TOMBSTONE_KEEP_DAYS", 30))
+BOOTSTRAP_PAGE_SIZE = 20
+# Одновременных SSE-потоков /api/events на пользователя; при превышении закрывается самый старый
+SSE_MAX_STREAMS_PER_USER = int(os.getenv("SSE_MAX_STREAMS_PER_USER", 3))
+# Монитор цикла событий: период замера лага и порог, после которого в лог пишется стек
+LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("LOOP_LAG_INTERVAL_SECONDS", 0.5))
+LOOP_BLOCK_THRESHOLD_MS = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", 200))
+# Сэмплирующий профайлер (/profile): период сэмплов и максимальное окно
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 120))
+# /memprof: сколько снимков tracemalloc хранить и сколько строк показывать
+MEMPROF_MAX_SNAPSHOTS = int(os.getenv("MEMPROF_MAX_SNAPSHOTS", 5))
+MEMPROF_TOP = int(os.getenv("MEMPROF_TOP", 15))
+# Токен для служебных HTTP-эндпоинтов (/admin/*); без токена они отключены
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")
+# Запись входящих апдейтов (обезличенных) в JSONL для bench/replay.py; без пути запись выключена
+UPDATE_RECORD_PATH = os.getenv("UPDATE_RECORD_PATH")
+# Соль псевдонимов ID: одна соль — одинаковые псевдонимы в разных записях; по умолчанию случайная на процесс
+UPDATE_RECORD_SALT = os.getenv("UPDATE_RECORD_SALT")
+# Сколько API-запрос, пришедший во время старта, ждёт готовности БД и бота
+STARTUP_WAIT_SECONDS = float(os.getenv("STARTUP_WAIT_SECONDS", 30))
+
+# ==================== Readiness ====================
+# Пороги /ready: при превышении любого ответ 503. Это диагностика, а не проверка платформы: занятый пул
+# или сбой Telegram перезапуском не лечатся, поэтому healthCheckPath в render.yaml — /health
+READY_MAX_POOL_USAGE = float(os.getenv("READY_MAX_POOL_USAGE", 1.0))
+READY_MAX_POLL_AGE_SECONDS = float(os.getenv("READY_MAX_POLL_AGE_SECONDS", 90))
+READY_MAX_OUTBOUND = int(os.getenv("READY_MAX_OUTBOUND", 100))
+READY_MAX_LOOP_LAG_MS = float(os.getenv("READY_MAX_LOOP_LAG_MS", 500))
+READY_MAX_DB_MS = float(os.getenv("READY_MAX_DB_MS", 500))
+
+# ==================== Database Connections ====================
+# Общий бюджет соединений процесса: пул + отдельное соединение LISTEN
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", 5))
+# Пул растёт по требованию до бюджета и закрывает соединения, простаивающие дольше порога
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_INACTIVE_SECONDS = float(os.getenv("DB_POOL_MAX_INACTIVE_SECONDS", 60))
+# PgBouncer в режиме transaction: без кэша подготовленных запросов и без LISTEN через пулер
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "0") == "1"
+# Прямое подключение к Postgres для LISTEN, когда DATABASE_URL указывает на PgBouncer
+DATABASE_DIRECT_URL = os.getenv("DATABASE_DIRECT_URL")
+# Период опроса таблицы admins, если LISTEN недоступен
+ADMIN_POLL_SECONDS = int(os.getenv("ADMIN_POLL_SECONDS", 30))
+# Запросы дольше порога пишутся в лог; EXPLAIN (ANALYZE, BUFFERS) — только по флагу и не чаще интервала
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", 200))
+DB_SLOW_QUERY_EXPLAIN = os.getenv("DB_SLOW_QUERY_EXPLAIN", "0") == "1"
+DB_EXPLAIN_INTERVAL_SECONDS = float(os.getenv("DB_EXPLAIN_INTERVAL_SECONDS", 600))
+# Сколько последних замеров на запрос хранится для p95
+DB_PROFILE_SAMPLES = int(os.getenv("DB_PROFILE_SAMPLES", 500))
+
+# ==================== Keep Warm ====================
+KEEP_WARM_ENABLED = os.getenv("KEEP_WARM_ENABLED", "1") == "1"
+# Интервал меньше DB_POOL_MAX_INACTIVE_SECONDS, чтобы прогретые соединения не успевали закрыться
+KEEP_WARM_INTERVAL_SECONDS = float(os.getenv("KEEP_WARM_INTERVAL_SECONDS", 45))
+KEEP_WARM_MIN_CONNECTIONS = int(os.getenv("KEEP_WARM_MIN_CONNECTIONS", 1))
+KEEP_WARM_CACHE_REFRESH_SECONDS = float(os.getenv("KEEP_WARM_CACHE_REFRESH_SECONDS", 300))
+# Часы (по времени сервера), когда инстанс можно отпустить в сон, например "1-7"
+KEEP_WARM_QUIET_HOURS = os.getenv("KEEP_WARM_QUIET_HOURS", "")
+
+# ==================== Outbox ====================
+# Исходящие сообщения Telegram проходят через таблицу outbox: сколько строк забирать за раз и сколько чатов слать параллельно
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", 5))
+# Опрос очереди, если NOTIFY не пришёл (другой инстанс, PgBouncer, отложенные повторы)
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", 5))
+# Строка, взятая в работу, возвращается в очередь, если отправитель не отчитался за это время.
+# Аренда продлевается перед отправкой в каждый чат и должна быть дольше одного запроса к Bot API (60 с)
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", 120))
+# Повторы с экспоненциальной задержкой; после последней попытки строка помечается failed
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", 2))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", 600))
+# Сколько хранить отправленные и окончательно неудачные строки
+OUTBOX_KEEP_HOURS = float(os.getenv("OUTBOX_KEEP_HOURS", 72))
+
+# ==================== Message Partitions ====================
+# messages секционирована по месяцам forwarded_at: сколько месяцев вперёд держать готовыми и как часто проверять
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_PARTITIONS_AHEAD", 3))
+MESSAGE_PARTITION_CHECK_HOURS = float(os.getenv("MESSAGE_PARTITION_CHECK_HOURS", 12))
+
+# ==================== Retention ====================
+# Отвеченные обращения старше RETENTION_DAYS переносятся в messages_archive; 0 — не переносить
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", 180))
+# Перенос короткими пачками по message_id с паузой между ними: блокировки строк держатся миллисекунды
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", 500))
+RETENTION_PAUSE_SECONDS = float(os.getenv("RETENTION_PAUSE_SECONDS", 0.5))
+RETENTION_INTERVAL_HOURS = float(os.getenv("RETENTION_INTERVAL_HOURS", 24))
@@ -0,0 +1,1257 @@
+import asyncio
+import contextlib
+import json
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Dict, Optional, List, Tuple
+
+import asyncpg
+
+from config import (
+    OWNER_ID, MESSAGE_ID_START, SYNC_CURSOR_OVERLAP_SECONDS, SYNC_TOMBSTONE_KEEP_DAYS,
+    DB_CONNECTION_BUDGET, DB_POOL_MIN_SIZE, DB_POOL_MAX_INACTIVE_SECONDS,
+    DB_PGBOUNCER, DATABASE_DIRECT_URL, ADMIN_POLL_SECONDS,
+    DB_SLOW_QUERY_MS, DB_SLOW_QUERY_EXPLAIN, DB_EXPLAIN_INTERVAL_SECONDS, DB_PROFILE_SAMPLES,
+    MESSAGE_PARTITIONS_AHEAD, MESSAGE_PARTITION_CHECK_HOURS
+)
+
+logger = logging.getLogger(__name__)
+
+# ==================== Schema Migrations ====================
+SCHEMA_LOCK_ID = 100569001
+# Перенос в messages_archive: одна реплика за раз
+RETENTION_LOCK_ID = 100569002
+
+async def get_schema_version(conn) -> int:
+    if not await conn.fetchval("SELECT to_regclass('schema_version') IS NOT NULL"):
+        return 0
+    return await conn.fetchval('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+
+async def migration_001_base(conn):
+    # Users table
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            last_message_time TIMESTAMP,
+            is_banned BOOLEAN DEFAULT FALSE,
+            ban_until TIMESTAMP,
+            ban_reason TEXT,
+            messages_sent INTEGER DEFAULT 0,
+            accepted_tos BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Базы, созданные до появления accepted_tos
+    await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS accepted_tos BOOLEAN DEFAULT FALSE')
+
+    # Messages table
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id INTEGER PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            content_type TEXT NOT NULL,
+            file_id TEXT,
+            caption TEXT,
+            text TEXT,
+            forwarded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_answered BOOLEAN DEFAULT FALSE,
+            answered_by BIGINT,
+            answered_at TIMESTAMP,
+            answer_text TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )
+    ''')
+    await conn.execute('ALTER TABLE messages ADD COLUMN IF NOT EXISTS answer_text TEXT')
+
+    # Indexes
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id)')
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_is_answered ON messages(is_answered)')
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_forwarded_at ON messages(forwarded_at)')
+
+    # Admins table
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id BIGINT PRIMARY KEY,
+            added_by BIGINT NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )
+    ''')
+
+    # Stats table
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats (
+            id SERIAL PRIMARY KEY,
+            total_messages INTEGER DEFAULT 0,
+            successful_forwards INTEGER DEFAULT 0,
+            failed_forwards INTEGER DEFAULT 0,
+            bans_issued INTEGER DEFAULT 0,
+            rate_limit_blocks INTEGER DEFAULT 0,
+            answers_sent INTEGER DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Message counter
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS message_counter (
+            id INTEGER PRIMARY KEY,
+            last_message_id INTEGER NOT NULL
+        )
+    ''')
+    await conn.execute('''
+        INSERT INTO message_counter (id, last_message_id) 
+        VALUES (1, $1) ON CONFLICT (id) DO NOTHING
+    ''', MESSAGE_ID_START)
+
+    # Owner user
+    await conn.execute('''
+        INSERT INTO users (user_id, username, first_name, accepted_tos) 
+        VALUES ($1, 'owner', 'Владелец', TRUE)
+        ON CONFLICT (user_id) DO UPDATE SET username='owner', first_name='Владелец', accepted_tos = TRUE
+    ''', OWNER_ID)
+
+    # Owner as admin
+    await conn.execute('''
+        INSERT INTO admins (user_id, added_by) VALUES ($1, $1) ON CONFLICT DO NOTHING
+    ''', OWNER_ID)
+
+    # Initial stats
+    await conn.execute('''
+        INSERT INTO stats (id, total_messages, successful_forwards, failed_forwards, bans_issued, rate_limit_blocks, answers_sent)
+        VALUES (1,0,0,0,0,0,0) ON CONFLICT DO NOTHING
+    ''')
+
+async def migration_002_admin_notify(conn):
+    await conn.execute('''
+        CREATE OR REPLACE FUNCTION notify_admins_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('admins_changed', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    await conn.execute('''
+        CREATE OR REPLACE TRIGGER admins_changed_trigger
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON admins
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_admins_changed()
+    ''')
+
+async def migration_003_message_changes(conn):
+    await conn.execute('ALTER TABLE messages ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_updated ON messages(user_id, updated_at)')
+    await conn.execute('''
+        CREATE OR REPLACE FUNCTION touch_message_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := CURRENT_TIMESTAMP;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    await conn.execute('''
+        CREATE OR REPLACE TRIGGER messages_touch_updated_at
+        BEFORE UPDATE ON messages
+        FOR EACH ROW EXECUTE FUNCTION touch_message_updated_at()
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS message_tombstones (
+            message_id INTEGER NOT NULL,
+            user_id BIGINT NOT NULL,
+            deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_message_tombstones_user_deleted ON message_tombstones(user_id, deleted_at)')
+    await conn.execute('''
+        CREATE OR REPLACE FUNCTION record_message_tombstone() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO message_tombstones (message_id, user_id) VALUES (OLD.message_id, OLD.user_id);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    await conn.execute('''
+        CREATE OR REPLACE TRIGGER messages_record_tombstone
+        AFTER DELETE ON messages
+        FOR EACH ROW EXECUTE FUNCTION record_message_tombstone()
+    ''')
+
+async def migration_004_bot_settings(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS bot_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+async def migration_005_outbox(conn):
+    # Исходящие сообщения Telegram: пишутся в одной транзакции с изменением, отправляются OutboxDispatcher
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            method TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'notice',
+            message_id INTEGER,
+            dedup_key TEXT UNIQUE,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+    ''')
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(next_attempt_at) WHERE status = 'pending'")
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_message ON outbox(message_id) WHERE message_id IS NOT NULL')
+
+async def migration_006_delivery_status(conn):
+    # Старые сообщения уже пересланы синхронно; новые начинают с queued и обновляются OutboxDispatcher
+    await conn.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS delivery_status TEXT NOT NULL DEFAULT 'delivered'")
+    await conn.execute("ALTER TABLE messages ALTER COLUMN delivery_status SET DEFAULT 'queued'")
+
+def month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def next_month(value: datetime) -> datetime:
+    return (value.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def message_partition_name(month: datetime) -> str:
+    return f"messages_{month:%Y_%m}"
+
+async def create_message_partitions(conn, start: datetime, end: datetime) -> List[str]:
+    # Помесячные секции с start по end включительно; существующие (в том числе отсоединённые) не трогаем
+    created = []
+    month = month_start(start)
+    while month <= end:
+        name = message_partition_name(month)
+        if not await conn.fetchval('SELECT to_regclass($1) IS NOT NULL', name):
+            await conn.execute(
+                f"CREATE TABLE {name} PARTITION OF messages FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month(month):%Y-%m-%d}')"
+            )
+            created.append(name)
+        month = next_month(month)
+    return created
+
+async def migration_007_partition_messages(conn):
+    # Ключ секционирования обязан входить в первичный ключ: (message_id, forwarded_at).
+    # Уникальность message_id по-прежнему обеспечивает message_counter
+    await conn.execute("UPDATE messages SET forwarded_at = COALESCE(answered_at, updated_at, CURRENT_TIMESTAMP) WHERE forwarded_at IS NULL")
+    await conn.execute('ALTER TABLE messages RENAME TO messages_unpartitioned')
+    await conn.execute('ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey')
+    for index in ('idx_messages_user_id', 'idx_messages_is_answered', 'idx_messages_forwarded_at', 'idx_messages_user_updated'):
+        await conn.execute(f'DROP INDEX IF EXISTS {index}')
+
+    await conn.execute('CREATE TABLE messages (LIKE messages_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (forwarded_at)')
+    await conn.execute('ALTER TABLE messages ALTER COLUMN forwarded_at SET NOT NULL')
+    await conn.execute('ALTER TABLE messages ADD PRIMARY KEY (message_id, forwarded_at)')
+    await conn.execute('ALTER TABLE messages ADD FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE')
+    # (user_id, forwarded_at): страницы «последних» читаются с новой секции и останавливаются на LIMIT.
+    # Частичные индексы по неотвеченным в старых секциях пусты, их проверка почти бесплатна
+    await conn.execute('CREATE INDEX idx_messages_user_forwarded ON messages(user_id, forwarded_at)')
+    await conn.execute('CREATE INDEX idx_messages_user_updated ON messages(user_id, updated_at)')
+    await conn.execute('CREATE INDEX idx_messages_unanswered ON messages(forwarded_at) WHERE is_answered = FALSE')
+    await conn.execute('CREATE INDEX idx_messages_user_unanswered ON messages(user_id) WHERE is_answered = FALSE')
+
+    first = await conn.fetchval('SELECT MIN(forwarded_at) FROM messages_unpartitioned')
+    now = datetime.now()
+    await create_message_partitions(conn, min(first, now) if first else now, month_start(now) + timedelta(days=31 * MESSAGE_PARTITIONS_AHEAD))
+    await conn.execute('INSERT INTO messages SELECT * FROM messages_unpartitioned')
+
+    await conn.execute('''
+        CREATE OR REPLACE TRIGGER messages_touch_updated_at
+        BEFORE UPDATE ON messages
+        FOR EACH ROW EXECUTE FUNCTION touch_message_updated_at()
+    ''')
+    await conn.execute('''
+        CREATE OR REPLACE TRIGGER messages_record_tombstone
+        AFTER DELETE ON messages
+        FOR EACH ROW EXECUTE FUNCTION record_message_tombstone()
+    ''')
+    await conn.execute('DROP TABLE messages_unpartitioned')
+
+async def migration_008_messages_archive(conn):
+    # Отвеченные обращения старше RETENTION_DAYS. Столбцы — как у messages плюс archived_at в конце:
+    # перенос делает INSERT ... SELECT m.*, поэтому новый столбец messages добавляется и сюда, перед archived_at
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages_archive (
+            LIKE messages INCLUDING DEFAULTS,
+            archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (message_id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )
+    ''')
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_archive_user ON messages_archive(user_id)')
+
+async def migration_009_archive_without_tombstones(conn):
+    # Перенос в messages_archive выставляет app.skip_message_tombstones: архивные сообщения
+    # остаются в истории Mini App, а message_tombstones не растёт на каждую перенесённую строку
+    await conn.execute('''
+        CREATE OR REPLACE FUNCTION record_message_tombstone() RETURNS trigger AS $$
+        BEGIN
+            IF current_setting('app.skip_message_tombstones', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            INSERT INTO message_tombstones (message_id, user_id) VALUES (OLD.message_id, OLD.user_id);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+
+# Новые изменения схемы — только новой миграцией в конце списка; применённые не редактируются
+MIGRATIONS = [
+    (1, 'base schema', migration_001_base),
+    (2, 'admins change notifications', migration_002_admin_notify),
+    (3, 'message change tracking', migration_003_message_changes),
+    (4, 'persistent bot settings', migration_004_bot_settings),
+    (5, 'telegram outbox', migration_005_outbox),
+    (6, 'message delivery status', migration_006_delivery_status),
+    (7, 'monthly partitions of messages', migration_007_partition_messages),
+    (8, 'archive of old answered messages', migration_008_messages_archive),
+    (9, 'no tombstones for archived messages', migration_009_archive_without_tombstones),
+]
+
+# ==================== Query Profiler ====================
+def redact_args(args) -> str:
+    # В лог попадают только типы и длины: тексты сообщений и имена пользователей не пишем
+    redacted = []
+    for value in args or ():
+        if value is None:
+            redacted.append('NULL')
+        elif isinstance(value, (str, bytes)):
+            redacted.append(f'{type(value).__name__}[{len(value)}]')
+        else:
+            redacted.append(type(value).__name__)
+    return ', '.join(redacted) or '-'
+
+def percentile(samples, fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+# Счётчик запросов текущего HTTP-запроса: middleware кладёт сюда [0], профайлер увеличивает
+QUERY_COUNT: ContextVar[Optional[list]] = ContextVar('db_query_count', default=None)
+
+class QueryProfiler:
+    def __init__(self, db):
+        self.db = db
+        self.started_at = datetime.now()
+        self.stats: Dict[str, Dict] = {}
+        self._normalized: Dict[str, str] = {}
+        self._explained_at: Dict[str, float] = {}
+        self._tasks = set()
+
+    def normalize(self, query: str) -> str:
+        normalized = self._normalized.get(query)
+        if normalized is None:
+            normalized = self._normalized[query] = ' '.join(query.split())
+        return normalized
+
+    def record(self, record):
+        # Колбэк asyncpg add_query_logger, вызывается после каждого запроса на соединениях пула
+        query = self.normalize(record.query)
+        if query.startswith('EXPLAIN'):
+            return
+        # call_soon копирует контекст вызывающего, поэтому счётчик тот же, что у запроса
+        counter = QUERY_COUNT.get()
+        if counter is not None:
+            counter[0] += 1
+        elapsed_ms = record.elapsed * 1000
+        stat = self.stats.get(query)
+        if stat is None:
+            stat = self.stats[query] = {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'samples': deque(maxlen=DB_PROFILE_SAMPLES)}
+        stat['calls'] += 1
+        stat['total_ms'] += elapsed_ms
+        stat['max_ms'] = max(stat['max_ms'], elapsed_ms)
+        stat['samples'].append(elapsed_ms)
+        if record.exception is not None:
+            stat['errors'] += 1
+        if elapsed_ms >= DB_SLOW_QUERY_MS:
+            logger.warning(f"Медленный запрос {elapsed_ms:.0f} мс: {query[:500]} | параметры: {redact_args(record.args)}")
+            if DB_SLOW_QUERY_EXPLAIN and record.exception is None and self._should_explain(query):
+                task = asyncio.create_task(self.explain(record.query, record.args))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    def _should_explain(self, query: str) -> bool:
+        # Только чтение и не чаще раза в интервал на запрос: EXPLAIN ANALYZE выполняет запрос повторно
+        head = query.lstrip('(').upper()
+        if not head.startswith(('SELECT', 'WITH')) or 'NEXTVAL' in head or ';' in head.rstrip('; '):
+            return False
+        now = time.monotonic()
+        if now - self._explained_at.get(query, -DB_EXPLAIN_INTERVAL_SECONDS) < DB_EXPLAIN_INTERVAL_SECONDS:
+            return False
+        self._explained_at[query] = now
+        return True
+
+    async def explain(self, query: str, args):
+        try:
+            async with self.db.pool.acquire(timeout=5) as conn:
+                # Транзакция всегда откатывается: побочные эффекты CTE и триггеров не сохраняются
+                transaction = conn.transaction()
+                await transaction.start()
+                try:
+                    rows = await conn.fetch('EXPLAIN (ANALYZE, BUFFERS) ' + query, *(args or ()))
+                finally:
+                    await transaction.rollback()
+            plan = '\n'.join(row[0] for row in rows)
+            logger.warning(f"План медленного запроса:\n{plan}")
+        except Exception as e:
+            logger.error(f"Не удалось получить EXPLAIN: {e}")
+
+    def top(self, limit: int = 10) -> List[Dict]:
+        rows = []
+        for query, stat in self.stats.items():
+            rows.append({
+                'query': query,
+                'calls': stat['calls'],
+                'errors': stat['errors'],
+                'total_ms': stat['total_ms'],
+                'avg_ms': stat['total_ms'] / stat['calls'],
+                'p95_ms': percentile(stat['samples'], 0.95),
+                'max_ms': stat['max_ms'],
+            })
+        rows.sort(key=lambda row: row['total_ms'], reverse=True)
+        return rows[:limit]
+
+# ==================== Database Class ====================
+TOMBSTONE_PURGE_INTERVAL_SECONDS = 3600
+
+def outbox_transaction(conn, items: Optional[List[Dict]]):
+    # Одиночный запрос атомарен сам по себе: транзакция нужна, только когда вместе с ним пишется outbox
+    return conn.transaction() if items else contextlib.nullcontext()
+
+class Database:
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        # Через PgBouncer (transaction) LISTEN не работает: нужен прямой адрес или опрос
+        self.listen_dsn = DATABASE_DIRECT_URL or (None if DB_PGBOUNCER else dsn)
+        self.pool = None
+        self.profiler = QueryProfiler(self)
+        self.admin_ids = set()
+        self.listener_conn = None
+        self._admin_poll_task = None
+        self._partition_task = None
+        self._tombstone_task = None
+        self.notification_handlers = {'admins_changed': self._on_admins_changed}
+        self._admin_reload_task = None
+        self._admin_reload_pending = False
+        self._listener_reconnect_task = None
+        self._closing = False
+        self.delete_confirmations = {}
+        self.remove_data_confirmations = {}
+
+    async def create_pool(self):
+        logger.info("Подключение к PostgreSQL...")
+        max_size = max(1, DB_CONNECTION_BUDGET - (1 if self.listen_dsn else 0))
+        pool_kwargs = {
+            'min_size': min(DB_POOL_MIN_SIZE, max_size),
+            'max_size': max_size,
+            'max_inactive_connection_lifetime': DB_POOL_MAX_INACTIVE_SECONDS,
+            'init': self._init_connection,
+        }
+        if DB_PGBOUNCER:
+            pool_kwargs['statement_cache_size'] = 0
+        self.pool = await asyncpg.create_pool(self.dsn, **pool_kwargs)
+        await self.init_db()
+        await self.load_admins()
+        if self.listen_dsn:
+            await self.start_listener()
+        else:
+            logger.warning(f"LISTEN недоступен, кэш администраторов обновляется раз в {ADMIN_POLL_SECONDS} с")
+            self._admin_poll_task = asyncio.create_task(self._poll_admins())
+        await self.ensure_message_partitions()
+        self._partition_task = asyncio.create_task(self._maintain_partitions())
+        self._tombstone_task = asyncio.create_task(self._purge_tombstones())
+        logger.info(f"Подключение к PostgreSQL установлено (пул до {max_size}, PgBouncer: {'да' if DB_PGBOUNCER else 'нет'})")
+
+    async def _init_connection(self, conn):
+        conn.add_query_logger(self.profiler.record)
+
+    async def init_db(self):
+        latest = MIGRATIONS[-1][0]
+        async with self.pool.acquire() as conn:
+            # Быстрый путь: схема актуальна — только чтение версии, без DDL и блокировок
+            current = await get_schema_version(conn)
+            if current >= latest:
+                logger.info(f"Схема БД актуальна (версия {current})")
+                return
+            # Транзакционная advisory-блокировка: реплики не применяют миграции параллельно,
+            # и она совместима с PgBouncer в режиме transaction
+            async with conn.transaction():
+                await conn.execute('SELECT pg_advisory_xact_lock($1)', SCHEMA_LOCK_ID)
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT NOT NULL,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                current = await get_schema_version(conn)
+                for version, description, migrate in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    logger.info(f"Применение миграции {version}: {description}")
+                    await migrate(conn)
+                    await conn.execute('INSERT INTO schema_version (version, description) VALUES ($1, $2)', version, description)
+            logger.info(f"Схема БД обновлена до версии {latest}")
+
+    async def accept_tos(self, user_id: int) -> bool:
+        async with self.pool.acquire() as conn:
+            result = await conn.execute('UPDATE users SET accepted_tos = TRUE, updated_at = CURRENT_TIMESTAMP WHERE user_id = $1', user_id)
+            return result.split()[1] == '1'
+
+    async def unset_tos(self, user_id: int) -> bool:
+        async with self.pool.acquire() as conn:
+            result = await conn.execute('UPDATE users SET accepted_tos = FALSE, updated_at = CURRENT_TIMESTAMP WHERE user_id = $1', user_id)
+            return result.split()[1] == '1'
+
+    async def has_accepted_tos(self, user_id: int) -> bool:
+        async with self.pool.acquire() as conn:
+            accepted = await conn.fetchval('SELECT accepted_tos FROM users WHERE user_id = $1', user_id)
+            return accepted is True
+
+    async def get_next_message_id(self) -> int:
+        async with self.pool.acquire() as conn:
+            result = await conn.fetchrow('''
+                UPDATE message_counter SET last_message_id = last_message_id + 1 WHERE id = 1 RETURNING last_message_id
+            ''')
+            return result['last_message_id'] if result else MESSAGE_ID_START
+
+    async def save_message(self, message_id: int, user_id: int, content_type: str,
+                           file_id: str = None, caption: str = None, text: str = None, outbox: List[Dict] = None) -> str:
+        # Без пересылок статус сразу stored: queued обновляет только OutboxDispatcher по строкам forward
+        delivery_status = 'queued' if outbox else 'stored'
+        async with self.pool.acquire() as conn:
+            # Пересылка администраторам фиксируется вместе с сообщением: либо есть оба, либо ничего
+            async with outbox_transaction(conn, outbox):
+                await conn.execute('''
+                    INSERT INTO messages (message_id, user_id, content_type, file_id, caption, text, delivery_status)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7)
+                ''', message_id, user_id, content_type, file_id, caption, text, delivery_status)
+                await self._insert_outbox(conn, outbox)
+        self._outbox_committed(outbox)
+        return delivery_status
+
+    async def get_message(self, message_id: int) -> Optional[Dict]:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow('SELECT * FROM messages WHERE message_id = $1', message_id)
+            if not row:
+                row = await conn.fetchrow('SELECT * FROM messages_archive WHERE message_id = $1', message_id)
+            return dict(row) if row else None
+
+    async def get_message_with_details(self, message_id: int) -> Optional[Dict]:
+        async with self.pool.acquire() as conn:
+            # Не найдено среди текущих — ищем в архиве (там есть archived_at)
+            for table in ('messages', 'messages_archive'):
+                row = await conn.fetchrow(f'''
+                    SELECT m.*, 
+                           u.username, u.first_name as user_first_name, u.last_name as user_last_name,
+                           a.first_name as answered_by_name
+                    FROM {table} m
+                    LEFT JOIN users u ON m.user_id = u.user_id
+                    LEFT JOIN users a ON m.answered_by = a.user_id
+                    WHERE m.message_id = $1
+                ''', message_id)
+                if row:
+                    return dict(row)
+            return None
+
+    async def delete_message(self, message_id: int) -> bool:
+        async with self.pool.acquire() as conn:
+            exists = await conn.fetchval('SELECT EXISTS(SELECT 1 FROM messages WHERE message_id = $1)', message_id)
+            if exists:
+                result = await conn.execute('DELETE FROM messages WHERE message_id = $1', message_id)
+                return result.split()[1] == '1'
+            # Архивное сообщение может оставаться в локальной истории Mini App: отметку пишем сами,
+            # на messages_archive триггера нет
+            user_id = await conn.fetchval('''
+                WITH deleted AS (
+                    DELETE FROM messages_archive WHERE message_id = $1 RETURNING message_id, user_id
+                )
+                INSERT INTO message_tombstones (message_id, user_id) SELECT message_id, user_id FROM deleted
+                RETURNING user_id
+            ''', message_id)
+            return user_id is not None
+
+    async def delete_all_user_data(self, user_id: int) -> bool:
+        async with self.pool.acquire() as conn:
+            await conn.execute('DELETE FROM messages WHERE user_id = $1', user_id)
+            await conn.execute('DELETE FROM messages_archive WHERE user_id = $1', user_id)
+            result = await conn.execute('DELETE FROM users WHERE user_id = $1', user_id)
+            return result.split()[1] == '1'
+
+    async def get_user_full_data(self, user_id: int) -> Optional[Dict]:
+        async with self.pool.acquire() as conn:
+            user_row = await conn.fetchrow('SELECT * FROM users WHERE user_id = $1', user_id)
+            if not user_row:
+                return None
+            user_data = dict(user_row)
+            messages_rows = await conn.fetch('''
+                SELECT message_id, text, forwarded_at, is_answered, answered_at, answer_text
+                FROM messages 
+                WHERE user_id = $1 
+                UNION ALL
+                SELECT message_id, text, forwarded_at, is_answered, answered_at, answer_text
+                FROM messages_archive
+                WHERE user_id = $1
+                ORDER BY forwarded_at DESC
+            ''', user_id)
+            user_data['messages'] = [dict(row) for row in messages_rows]
+            user_data['unanswered_count'] = len([m for m in user_data['messages'] if not m['is_answered']])
+            return user_data
+
+    async def get_unanswered_requests(self) -> List[Dict]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT m.message_id, m.text, m.forwarded_at, 
+                       u.user_id, u.username, u.first_name, u.last_name
+                FROM messages m
+                JOIN users u ON m.user_id = u.user_id
+                WHERE m.is_answered = FALSE
+                ORDER BY m.forwarded_at ASC
+            ''')
+            return [dict(row) for row in rows]
+
+    async def mark_message_answered(self, message_id: int, answered_by: int, answer_text: str, outbox: List[Dict] = None):
+        async with self.pool.acquire() as conn:
+            # NOTIFY доставляется подписчикам только после фиксации транзакции
+            async with outbox_transaction(conn, outbox):
+                payload = await conn.fetchval('''
+                    WITH updated AS (
+                        UPDATE messages SET is_answered = TRUE, answered_by = $2, answered_at = CURRENT_TIMESTAMP, answer_text = $3
+                        WHERE message_id = $1
+                        RETURNING json_build_object('message_id', message_id, 'user_id', user_id)::text AS payload
+                    )
+                    SELECT payload FROM updated, pg_notify('message_answered', payload)
+                ''', message_id, answered_by, answer_text)
+                if payload:
+                    await self._insert_outbox(conn, outbox)
+        if payload and not self.listener_conn:
+            self._dispatch_local('message_answered', payload)
+        if payload:
+            self._outbox_committed(outbox)
+        return payload is not None
+
+    async def get_inbox_message(self, message_id: int) -> Optional[Dict]:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow('''
+                SELECT m.message_id, m.answered_at, m.answered_by, m.answer_text,
+                       u.first_name as answered_by_name, m.text as original_text
+                FROM messages m
+                LEFT JOIN users u ON m.answered_by = u.user_id
+                WHERE m.message_id = $1 AND m.is_answered = TRUE
+            ''', message_id)
+            return dict(row) if row else None
+
+    async def get_user_inbox(self, user_id: int) -> List[Dict]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT m.message_id, m.answered_at, m.answered_by, m.answer_text,
+                       u.first_name as answered_by_name, m.text as original_text
+                FROM messages m
+                LEFT JOIN users u ON m.answered_by = u.user_id
+                WHERE m.user_id = $1 AND m.is_answered = TRUE
+                ORDER BY m.answered_at DESC
+            ''', user_id)
+            return [dict(row) for row in rows]
+
+    async def get_user_sent(self, user_id: int) -> List[Dict]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT m.*, u.first_name as answered_by_name
+                FROM messages m
+                LEFT JOIN users u ON m.answered_by = u.user_id
+                WHERE m.user_id = $1
+                ORDER BY m.forwarded_at DESC
+            ''', user_id)
+            return [dict(row) for row in rows]
+
+    async def get_user_messages_version(self, user_id: int) -> str:
+        # Дешёвый отпечаток истории пользователя для ETag: одна агрегатная выборка по индексу
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow('''
+                SELECT COUNT(*) AS total,
+                       COUNT(*) FILTER (WHERE m.is_answered) AS answered,
+                       MAX(m.forwarded_at) AS last_forwarded,
+                       MAX(m.answered_at) AS last_answered,
+                       MAX(m.updated_at) AS last_updated,
+                       -- answered_by_name в ответах берётся из users: переименование ответившего тоже меняет версию
+                       md5(COALESCE(string_agg(DISTINCT a.user_id || ':' || COALESCE(a.first_name, ''), ','), '')) AS answerers
+                FROM messages m
+                LEFT JOIN users a ON a.user_id = m.answered_by
+                WHERE m.user_id = $1
+            ''', user_id)
+            last_forwarded = row['last_forwarded'].timestamp() if row['last_forwarded'] else 0
+            last_answered = row['last_answered'].timestamp() if row['last_answered'] else 0
+            # updated_at меняется и при смене delivery_status, которую не видно по остальным полям
+            last_updated = row['last_updated'].timestamp() if row['last_updated'] else 0
+            return f"{row['total']}-{row['answered']}-{last_forwarded:.6f}-{last_answered:.6f}-{last_updated:.6f}-{row['answerers'][:12]}"
+
+    async def get_bootstrap_pages(self, user_id: int, limit: int) -> Dict:
+        # Счётчик и первые страницы обеих вкладок одним запросом; json_agg сразу отдаёт ISO-даты
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow('''
+                SELECT
+                    (SELECT COUNT(*) FROM messages WHERE user_id = $1 AND is_answered = FALSE) AS unanswered,
+                    (SELECT COALESCE(json_agg(i ORDER BY i.answered_at DESC), '[]'::json) FROM (
+                        (SELECT m.message_id, m.answered_at, m.answered_by, m.answer_text,
+                                u.first_name as answered_by_name, m.text as original_text
+                         FROM messages m
+                         LEFT JOIN users u ON m.answered_by = u.user_id
+                         WHERE m.user_id = $1 AND m.is_answered = TRUE
+                         ORDER BY m.answered_at DESC
+                         LIMIT $2)
+                        UNION ALL
+                        (SELECT a.message_id, a.answered_at, a.answered_by, a.answer_text,
+                                u.first_name as answered_by_name, a.text as original_text
+                         FROM messages_archive a
+                         LEFT JOIN users u ON a.answered_by = u.user_id
+                         WHERE a.user_id = $1
+                         ORDER BY a.answered_at DESC
+                         LIMIT $2)
+                        ORDER BY answered_at DESC
+                        LIMIT $2
+                    ) i) AS inbox,
+                    -- У архива на столбец больше (archived_at): строки собираются в jsonb, лишний ключ отбрасывается
+                    (SELECT COALESCE(json_agg(s.doc ORDER BY s.forwarded_at DESC), '[]'::json) FROM (
+                        (SELECT to_jsonb(m) || jsonb_build_object('answered_by_name', u.first_name) AS doc, m.forwarded_at
+                         FROM messages m
+                         LEFT JOIN users u ON m.answered_by = u.user_id
+                         WHERE m.user_id = $1
+                         ORDER BY m.forwarded_at DESC
+                         LIMIT $2)
+                        UNION ALL
+                        (SELECT (to_jsonb(a) - 'archived_at') || jsonb_build_object('answered_by_name', u.first_name), a.forwarded_at
+                         FROM messages_archive a
+                         LEFT JOIN users u ON a.answered_by = u.user_id
+                         WHERE a.user_id = $1
+                         ORDER BY a.forwarded_at DESC
+                         LIMIT $2)
+                        ORDER BY forwarded_at DESC
+                        LIMIT $2
+                    ) s) AS sent
+            ''', user_id, limit)
+            return {'unanswered': row['unanswered'], 'inbox': json.loads(row['inbox']), 'sent': json.loads(row['sent'])}
+
+    async def get_user_changes(self, user_id: int, since: Optional[datetime] = None) -> Dict:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                cursor = await conn.fetchval('SELECT LOCALTIMESTAMP')
+                # Отметки старше SYNC_TOMBSTONE_KEEP_DAYS удалены: по такому курсору удаления не восстановить
+                if since is not None and since < cursor - timedelta(days=SYNC_TOMBSTONE_KEEP_DAYS):
+                    since = None
+                unanswered = await conn.fetchval('SELECT COUNT(*) FROM messages WHERE user_id = $1 AND is_answered = FALSE', user_id)
+                if since is None:
+                    rows = await conn.fetch('''
+                        SELECT m.*, u.first_name as answered_by_name
+                        FROM messages m
+                        LEFT JOIN users u ON m.answered_by = u.user_id
+                        WHERE m.user_id = $1
+                    ''', user_id)
+                    # Полный снимок заменяет локальную историю Mini App, поэтому архив входит в него.
+                    # В дельту архив не попадает: перенос не меняет updated_at и не пишет отметок
+                    archived = await conn.fetch('''
+                        SELECT a.*, u.first_name as answered_by_name
+                        FROM messages_archive a
+                        LEFT JOIN users u ON a.answered_by = u.user_id
+                        WHERE a.user_id = $1
+                    ''', user_id)
+                    messages = [dict(row) for row in rows]
+                    for row in archived:
+                        message = dict(row)
+                        del message['archived_at']
+                        messages.append(message)
+                    return {'full': True, 'cursor': cursor, 'unanswered': unanswered, 'messages': messages, 'deleted': []}
+                # Перекрытие окна: транзакции, начатые до курсора, могут зафиксироваться позже него
+                since = since - timedelta(seconds=SYNC_CURSOR_OVERLAP_SECONDS)
+                rows = await conn.fetch('''
+                    SELECT m.*, u.first_name as answered_by_name
+                    FROM messages m
+                    LEFT JOIN users u ON m.answered_by = u.user_id
+                    WHERE m.user_id = $1 AND m.updated_at > $2
+                ''', user_id, since)
+                deleted = await conn.fetch('''
+                    SELECT message_id FROM message_tombstones
+                    WHERE user_id = $1 AND deleted_at > $2
+                ''', user_id, since)
+                return {
+                    'full': False,
+                    'cursor': cursor,
+                    'unanswered': unanswered,
+                    'messages': [dict(row) for row in rows],
+                    'deleted': [row['message_id'] for row in deleted]
+                }
+
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow('SELECT * FROM users WHERE user_id = $1', user_id)
+            return dict(row) if row else None
+
+    async def get_unanswered_count(self, user_id: int) -> int:
+        async with self.pool.acquire() as conn:
+            count = await conn.fetchval('SELECT COUNT(*) FROM messages WHERE user_id = $1 AND is_answered = FALSE', user_id)
+            return count if count else 0
+
+    async def save_user(self, user_id: int, **kwargs):
+        async with self.pool.acquire() as conn:
+            exists = await conn.fetchval('SELECT EXISTS(SELECT 1 FROM users WHERE user_id = $1)', user_id)
+            if exists:
+                set_clause = ', '.join([f"{k} = ${i+2}" for i, k in enumerate(kwargs.keys())])
+                set_clause += ", updated_at = CURRENT_TIMESTAMP"
+                await conn.execute(f'UPDATE users SET {set_clause} WHERE user_id = $1', user_id, *kwargs.values())
+            else:
+                fields = ['user_id'] + list(kwargs.keys())
+                values = [user_id] + list(kwargs.values())
+                placeholders = ', '.join([f'${i+1}' for i in range(len(values))])
+                await conn.execute(f'INSERT INTO users ({", ".join(fields)}) VALUES ({placeholders})', *values)
+
+    async def upsert_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None) -> Dict:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow('''
+                INSERT INTO users (user_id, username, first_name, last_name) VALUES ($1, $2, $3, $4)
+                ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, first_name = EXCLUDED.first_name,
+                    last_name = EXCLUDED.last_name, updated_at = CURRENT_TIMESTAMP
+                RETURNING *
+            ''', user_id, username, first_name, last_name)
+            return dict(row)
+
+    async def update_user_stats(self, user_id: int, increment_messages: bool = True):
+        async with self.pool.acquire() as conn:
+            if increment_messages:
+                await conn.execute('UPDATE users SET messages_sent = messages_sent + 1, updated_at = CURRENT_TIMESTAMP WHERE user_id = $1', user_id)
+            else:
+                await conn.execute('UPDATE users SET updated_at = CURRENT_TIMESTAMP WHERE user_id = $1', user_id)
+
+    async def update_user_last_message(self, user_id: int, message_time: datetime):
+        async with self.pool.acquire() as conn:
+            await conn.execute('UPDATE users SET last_message_time = $1, updated_at = CURRENT_TIMESTAMP WHERE user_id = $2', message_time, user_id)
+
+    async def ban_user(self, user_id: int, reason: str, ban_until: Optional[datetime] = None):
+        async with self.pool.acquire() as conn:
+            await conn.execute('UPDATE users SET is_banned = TRUE, ban_reason = $1, ban_until = $2, updated_at = CURRENT_TIMESTAMP WHERE user_id = $3', reason, ban_until, user_id)
+
+    async def unban_user(self, user_id: int):
+        async with self.pool.acquire() as conn:
+            await conn.execute('UPDATE users SET is_banned = FALSE, ban_reason = NULL, ban_until = NULL, updated_at = CURRENT_TIMESTAMP WHERE user_id = $1', user_id)
+
+    async def get_all_users(self) -> List[Dict]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('SELECT * FROM users ORDER BY created_at DESC')
+            return [dict(row) for row in rows]
+
+    async def add_admin(self, user_id: int, added_by: int) -> bool:
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute('''
+                    INSERT INTO admins (user_id, added_by) VALUES ($1, $2)
+                    ON CONFLICT (user_id) DO UPDATE SET is_active = TRUE, added_by = EXCLUDED.added_by, added_at = CURRENT_TIMESTAMP
+                ''', user_id, added_by)
+            self.admin_ids.add(user_id)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка добавления администратора {user_id}: {e}")
+            return False
+
+    async def remove_admin(self, user_id: int) -> bool:
+        if user_id == OWNER_ID:
+            return False
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute('DELETE FROM admins WHERE user_id = $1', user_id)
+            self.admin_ids.discard(user_id)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка удаления администратора {user_id}: {e}")
+            return False
+
+    async def load_admins(self):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('SELECT user_id FROM admins WHERE is_active = TRUE')
+        self.admin_ids = {row['user_id'] for row in rows}
+        logger.info(f"Кэш администраторов загружен: {len(self.admin_ids)}")
+
+    async def start_listener(self):
+        # Отдельное соединение вне пула: LISTEN живёт, пока соединение открыто
+        self.listener_conn = await asyncpg.connect(self.listen_dsn)
+        self.listener_conn.add_termination_listener(self._on_listener_terminated)
+        for channel, handler in self.notification_handlers.items():
+            await self.listener_conn.add_listener(channel, handler)
+
+    async def add_notification_handler(self, channel: str, handler):
+        self.notification_handlers[channel] = handler
+        if self.listener_conn and not self.listener_conn.is_closed():
+            await self.listener_conn.add_listener(channel, handler)
+
+    def _dispatch_local(self, channel: str, payload: str):
+        # Без LISTEN уведомления доходят только до обработчиков этого процесса
+        handler = self.notification_handlers.get(channel)
+        if handler:
+            handler(None, None, channel, payload)
+
+    async def _poll_admins(self):
+        while not self._closing:
+            await asyncio.sleep(ADMIN_POLL_SECONDS)
+            try:
+                await self.load_admins()
+            except Exception as e:
+                logger.error(f"Ошибка обновления кэша администраторов: {e}")
+
+    def _on_admins_changed(self, conn, pid, channel, payload):
+        self._schedule_admin_reload()
+
+    def _schedule_admin_reload(self):
+        # Несколько NOTIFY подряд схлопываются в одну перезагрузку
+        if self._admin_reload_task and not self._admin_reload_task.done():
+            self._admin_reload_pending = True
+            return
+        self._admin_reload_task = asyncio.create_task(self._reload_admins())
+
+    async def _reload_admins(self):
+        while True:
+            self._admin_reload_pending = False
+            try:
+                await self.load_admins()
+            except Exception as e:
+                logger.error(f"Ошибка обновления кэша администраторов: {e}")
+            if not self._admin_reload_pending:
+                break
+
+    def _on_listener_terminated(self, conn):
+        if self._closing:
+            return
+        logger.warning("Соединение LISTEN потеряно, переподключение...")
+        if not self._listener_reconnect_task or self._listener_reconnect_task.done():
+            self._listener_reconnect_task = asyncio.create_task(self._reconnect_listener())
+
+    async def _reconnect_listener(self):
+        delay = 1
+        while not self._closing:
+            try:
+                await self.start_listener()
+                # Пока соединения не было, уведомления могли быть пропущены
+                self._schedule_admin_reload()
+                logger.info("Соединение LISTEN восстановлено")
+                return
+            except Exception as e:
+                logger.error(f"Не удалось восстановить LISTEN: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    # Секции messages: будущие месяцы создаются заранее, старые можно отсоединить без переписывания данных
+    async def ensure_message_partitions(self, since: datetime = None) -> List[str]:
+        now = datetime.now()
+        async with self.pool.acquire() as conn:
+            # Та же блокировка, что у миграций: реплики не создают одну секцию одновременно
+            async with conn.transaction():
+                await conn.execute('SELECT pg_advisory_xact_lock($1)', SCHEMA_LOCK_ID)
+                created = await create_message_partitions(conn, since or now, month_start(now) + timedelta(days=31 * MESSAGE_PARTITIONS_AHEAD))
+        if created:
+            logger.info(f"Созданы секции messages: {', '.join(created)}")
+        return created
+
+    async def _maintain_partitions(self):
+        while not self._closing:
+            await asyncio.sleep(MESSAGE_PARTITION_CHECK_HOURS * 3600)
+            try:
+                await self.ensure_message_partitions()
+            except Exception as e:
+                logger.error(f"Ошибка создания секций messages: {e}")
+
+    async def _purge_tombstones(self):
+        # Во всех процессах с пулом (бот, api.py): дельта-синхронизация не зависит от отправки в Telegram
+        while not self._closing:
+            await asyncio.sleep(TOMBSTONE_PURGE_INTERVAL_SECONDS)
+            try:
+                purged = await self.purge_message_tombstones(SYNC_TOMBSTONE_KEEP_DAYS)
+                if purged:
+                    logger.info(f"Удалено {purged} старых отметок об удалении сообщений")
+            except Exception as e:
+                logger.error(f"Ошибка очистки message_tombstones: {e}")
+
+    async def get_message_partitions(self) -> List[Dict]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT c.relname AS name,
+                       pg_get_expr(c.relpartbound, c.oid) AS bound,
+                       GREATEST(c.reltuples, 0)::bigint AS rows_estimate,
+                       pg_total_relation_size(c.oid) AS total_bytes
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'messages'::regclass
+                ORDER BY c.relname
+            ''')
+            return [dict(row) for row in rows]
+
+    async def detach_message_partition(self, month: datetime) -> Optional[str]:
+        # CONCURRENTLY не блокирует чтение и запись в messages; отсоединённая таблица остаётся как есть —
+        # её можно выгрузить pg_dump и удалить. Не работает внутри транзакции, поэтому отдельный запрос
+        if month_start(month) >= month_start(datetime.now()):
+            raise ValueError("текущую и будущие секции отсоединять нельзя: в них идут новые сообщения")
+        name = message_partition_name(month_start(month))
+        async with self.pool.acquire() as conn:
+            attached = await conn.fetchval('''
+                SELECT EXISTS(SELECT 1 FROM pg_inherits WHERE inhparent = 'messages'::regclass AND inhrelid = to_regclass($1))
+            ''', name)
+            if not attached:
+                return None
+            # Отсоединённые строки пропадают из бота и Mini App: секция должна быть пуста, то есть
+            # всё отвечено и перенесено в messages_archive
+            left = await conn.fetchrow(f'SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE NOT is_answered) AS unanswered FROM {name}')
+            if left['unanswered']:
+                raise ValueError(f"в {name} остались неотвеченные обращения ({left['unanswered']}) — отсоединять нельзя")
+            if left['total']:
+                raise ValueError(f"в {name} остались обращения, не перенесённые в архив ({left['total']}) — сначала /retention run")
+            await conn.execute(f'ALTER TABLE messages DETACH PARTITION {name} CONCURRENTLY')
+        logger.warning(f"Секция {name} отсоединена от messages")
+        return name
+
+    # Архив отвеченных обращений: перенос пачками по message_id, каждая пачка — своя короткая транзакция
+    async def archive_messages_batch(self, cutoff: datetime, after_id: int, limit: int) -> Optional[Tuple[int, Optional[int]]]:
+        # Возвращает (перенесено, последний message_id пачки); None — переносом уже занята другая реплика.
+        # forwarded_at < cutoff отсекает свежие секции; строки, занятые ответом или правкой, пропускаются до следующего прогона
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if not await conn.fetchval('SELECT pg_try_advisory_xact_lock($1)', RETENTION_LOCK_ID):
+                    return None
+                # Перенос — не удаление: отметки для Mini App не пишем (см. record_message_tombstone)
+                await conn.execute("SET LOCAL app.skip_message_tombstones = 'on'")
+                # Удаляются только строки, которые реально легли в архив: при совпадении message_id
+                # с уже архивированным строка остаётся в messages, а не пропадает
+                row = await conn.fetchrow('''
+                    WITH batch AS (
+                        SELECT message_id, forwarded_at FROM messages
+                        WHERE forwarded_at < $1 AND is_answered = TRUE AND answered_at < $1 AND message_id > $2
+                        ORDER BY message_id
+                        LIMIT $3
+                        FOR UPDATE SKIP LOCKED
+                    ), archived AS (
+                        INSERT INTO messages_archive
+                        SELECT m.* FROM messages m JOIN batch b ON m.message_id = b.message_id AND m.forwarded_at = b.forwarded_at
+                        ON CONFLICT (message_id) DO NOTHING
+                        RETURNING message_id, forwarded_at
+                    ), moved AS (
+                        DELETE FROM messages m USING archived a
+                        WHERE m.message_id = a.message_id AND m.forwarded_at = a.forwarded_at
+                        RETURNING m.message_id
+                    )
+                    SELECT (SELECT COUNT(*) FROM moved) AS moved, (SELECT COUNT(*) FROM batch) AS selected,
+                           (SELECT MAX(message_id) FROM batch) AS last_id
+                ''', cutoff, after_id, limit)
+                if row['selected'] > row['moved']:
+                    logger.warning(f"Архивация: {row['selected'] - row['moved']} сообщений уже есть в архиве с тем же message_id, оставлены в messages")
+                return row['moved'], row['last_id']
+
+    async def count_archivable_messages(self, cutoff: datetime) -> int:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(
+                'SELECT COUNT(*) FROM messages WHERE forwarded_at < $1 AND is_answered = TRUE AND answered_at < $1', cutoff
+            )
+
+    async def get_archive_stats(self) -> Dict:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow('''
+                SELECT COUNT(*) AS total, MIN(forwarded_at) AS oldest, MAX(archived_at) AS last_archived_at,
+                       pg_total_relation_size('messages_archive') AS total_bytes
+                FROM messages_archive
+            ''')
+            return dict(row)
+
+    async def get_admins(self) -> List[int]:
+        return sorted(self.admin_ids)
+
+    async def is_admin(self, user_id: int) -> bool:
+        return user_id == OWNER_ID or user_id in self.admin_ids
+
+    async def save_closed_state(self, closed: bool, message: str):
+        async with self.pool.acquire() as conn:
+            if closed:
+                await conn.execute('''
+                    INSERT INTO bot_settings (key, value) VALUES ('closed_message', $1)
+                    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP
+                ''', message)
+            else:
+                await conn.execute("DELETE FROM bot_settings WHERE key = 'closed_message'")
+
+    async def load_closed_state(self) -> tuple[bool, str]:
+        async with self.pool.acquire() as conn:
+            message = await conn.fetchval("SELECT value FROM bot_settings WHERE key = 'closed_message'")
+            return message is not None, message or ""
+
+    # Очередь исходящих сообщений. Элемент: {'chat_id', 'method', 'payload', 'kind', 'message_id', 'dedup_key'}; повтор dedup_key не ставится в очередь
+    async def _insert_outbox(self, conn, items: Optional[List[Dict]]):
+        if not items:
+            return
+        await conn.executemany('''
+            INSERT INTO outbox (chat_id, method, payload, kind, message_id, dedup_key)
+            VALUES ($1, $2, $3::jsonb, $4, $5, $6)
+            ON CONFLICT (dedup_key) DO NOTHING
+        ''', [(item['chat_id'], item['method'], json.dumps(item['payload'], ensure_ascii=False), item.get('kind', 'notice'),
+               item.get('message_id'), item.get('dedup_key')) for item in items])
+        await conn.execute("SELECT pg_notify('outbox', '')")
+
+    def _outbox_committed(self, items: Optional[List[Dict]]):
+        if items and not self.listener_conn:
+            self._dispatch_local('outbox', '')
+
+    async def enqueue_outbox(self, items: List[Dict]):
+        if not items:
+            return
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await self._insert_outbox(conn, items)
+        self._outbox_committed(items)
+
+    async def claim_outbox(self, limit: int, lease_seconds: float) -> List[Dict]:
+        # SKIP LOCKED: несколько инстансов разбирают очередь, не пересекаясь. Аренда сдвигает next_attempt_at,
+        # поэтому строка упавшего посреди отправки процесса вернётся в очередь сама
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('''
+                UPDATE outbox o SET attempts = o.attempts + 1,
+                                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => $2)
+                FROM (
+                    SELECT id FROM outbox
+                    WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                    ORDER BY next_attempt_at, id
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                ) claimed
+                WHERE o.id = claimed.id
+                RETURNING o.id, o.chat_id, o.method, o.payload, o.kind, o.message_id, o.attempts
+            ''', limit, float(lease_seconds))
+            result = []
+            for row in sorted(rows, key=lambda row: row['id']):
+                item = dict(row)
+                item['payload'] = json.loads(item['payload'])
+                result.append(item)
+            return result
+
+    async def renew_outbox_lease(self, rows: List[Dict], lease_seconds: float) -> set:
+        # Продлевает аренду строк, которые всё ещё наши: attempts не изменился, значит, никто не забрал их повторно
+        if not rows:
+            return set()
+        async with self.pool.acquire() as conn:
+            renewed = await conn.fetch('''
+                UPDATE outbox o SET next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => $3)
+                FROM unnest($1::bigint[], $2::int[]) AS r(id, attempts)
+                WHERE o.id = r.id AND o.attempts = r.attempts AND o.status = 'pending'
+                RETURNING o.id
+            ''', [row['id'] for row in rows], [row['attempts'] for row in rows], float(lease_seconds))
+            return {row['id'] for row in renewed}
+
+    async def finish_outbox(self, sent: List[int], retry: List[tuple], failed: List[tuple]):
+        # retry: (id, задержка в секундах, ошибка, засчитывать ли попытку); failed: (id, ошибка)
+        async with self.pool.acquire() as conn:
+            if sent:
+                await conn.execute('''
+                    UPDATE outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP, last_error = NULL WHERE id = ANY($1::bigint[])
+                ''', sent)
+            if retry:
+                await conn.executemany('''
+                    UPDATE outbox SET next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => $2), last_error = $3,
+                                      attempts = attempts - CASE WHEN $4 THEN 0 ELSE 1 END
+                    WHERE id = $1
+                ''', [(outbox_id, float(delay), error, counted) for outbox_id, delay, error, counted in retry])
+            if failed:
+                await conn.executemany("UPDATE outbox SET status = 'failed', last_error = $2 WHERE id = $1", failed)
+
+    async def update_delivery_status(self, message_ids: List[int]):
+        # Статус пересылки по строкам outbox: доставлено хотя бы одному администратору, всем не удалось или ещё в очереди.
+        # Изменение трогает updated_at (дельта-синхронизация) и уходит в NOTIFY для SSE
+        if not message_ids:
+            return
+        async with self.pool.acquire() as conn:
+            payloads = await conn.fetch('''
+                WITH status AS (
+                    SELECT message_id,
+                           CASE WHEN bool_or(status = 'sent') THEN 'delivered'
+                                WHEN bool_and(status = 'failed') THEN 'failed'
+                                ELSE 'queued' END AS delivery_status
+                    FROM outbox
+                    WHERE message_id = ANY($1::int[]) AND kind = 'forward' AND method = 'send_message'
+                    GROUP BY message_id
+                ), updated AS (
+                    UPDATE messages m SET delivery_status = status.delivery_status
+                    FROM status
+                    WHERE m.message_id = status.message_id AND m.delivery_status <> status.delivery_status
+                    RETURNING json_build_object('message_id', m.message_id, 'user_id', m.user_id, 'delivery_status', m.delivery_status)::text AS payload
+                )
+                SELECT payload FROM updated, pg_notify('message_delivery', payload)
+            ''', list(set(message_ids)))
+        if not self.listener_conn:
+            for row in payloads:
+                self._dispatch_local('message_delivery', row['payload'])
+
+    async def purge_outbox(self, keep_hours: float) -> int:
+        async with self.pool.acquire() as conn:
+            result = await conn.execute('''
+                DELETE FROM outbox WHERE status <> 'pending' AND created_at < CURRENT_TIMESTAMP - make_interval(secs => $1)
+            ''', keep_hours * 3600)
+            return int(result.split()[1])
+
+    async def purge_message_tombstones(self, keep_days: float) -> int:
+        async with self.pool.acquire() as conn:
+            result = await conn.execute('''
+                DELETE FROM message_tombstones WHERE deleted_at < CURRENT_TIMESTAMP - make_interval(secs => $1)
+            ''', keep_days * 86400)
+            return int(result.split()[1])
+
+    async def get_outbox_stats(self) -> Dict:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow('''
+                SELECT COUNT(*) FILTER (WHERE status = 'pending') AS pending,
+                       COUNT(*) FILTER (WHERE status = 'failed') AS failed,
+                       EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - MIN(created_at) FILTER (WHERE status = 'pending'))::float AS oldest_pending_seconds
+                FROM outbox
+            ''')
+            return dict(row)
+
+    async def update_stats(self, **kwargs):
+        async with self.pool.acquire() as conn:
+            set_clause = ', '.join([f"{k} = {k} + ${i+1}" for i, k in enumerate(kwargs.keys())])
+            set_clause += ", updated_at = CURRENT_TIMESTAMP"
+            await conn.execute(f'UPDATE stats SET {set_clause} WHERE id = 1', *kwargs.values())
+
+    async def get_stats(self) -> Dict:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow('SELECT * FROM stats WHERE id = 1')
+            if not row:
+                return {'total_messages':0, 'successful_forwards':0, 'failed_forwards':0, 'bans_issued':0, 'rate_limit_blocks':0, 'answers_sent':0}
+            return dict(row)
+
+    async def get_users_count(self) -> Dict:
+        async with self.pool.acquire() as conn:
+            total = await conn.fetchval('SELECT COUNT(*) FROM users')
+            banned = await conn.fetchval('SELECT COUNT(*) FROM users WHERE is_banned = TRUE')
+            active_today = await conn.fetchval('SELECT COUNT(*) FROM users WHERE updated_at > CURRENT_TIMESTAMP - INTERVAL \'24 hours\'')
+            return {'total': total, 'banned': banned, 'active_today': active_today}
+
+    async def clear_database(self):
+        async with self.pool.acquire() as conn:
+            await conn.execute('DELETE FROM messages')
+            await conn.execute('DELETE FROM messages_archive')
+            await conn.execute('UPDATE message_counter SET last_message_id = $1 WHERE id = 1', MESSAGE_ID_START)
+            await conn.execute('UPDATE stats SET total_messages = 0, successful_forwards = 0, failed_forwards = 0, answers_sent = 0 WHERE id = 1')
+            await conn.execute('UPDATE users SET messages_sent = 0')
+            logger.warning("База данных очищена администратором")
+
+    async def close(self):
+        self._closing = True
+        for task in (self._listener_reconnect_task, self._admin_reload_task, self._admin_poll_task, self._partition_task,
+                     self._tombstone_task):
+            if task and not task.done():
+                task.cancel()
+        if self.listener_conn and not self.listener_conn.is_closed():
+            await self.listener_conn.close()
+        if self.pool:
+            await self.pool.close()
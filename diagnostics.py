@@ -0,0 +1,318 @@
+import asyncio
+import gc
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+
+from config import (
+    OWNER_ID, LOOP_LAG_INTERVAL_SECONDS, LOOP_BLOCK_THRESHOLD_MS, PROFILE_INTERVAL_MS, PROFILE_MAX_SECONDS,
+    MEMPROF_MAX_SNAPSHOTS, MEMPROF_TOP, UPDATE_RECORD_SALT
+)
+from metrics import LOOP_LAG_SECONDS, LOOP_LAG_GAUGE, LOOP_BLOCKS
+
+logger = logging.getLogger(__name__)
+
+# ==================== Event Loop Monitor ====================
+class LoopMonitor:
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL_SECONDS, block_threshold_ms: float = LOOP_BLOCK_THRESHOLD_MS):
+        self.interval = interval
+        self.block_threshold = block_threshold_ms / 1000
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.blocks = 0
+        self._heartbeat = time.monotonic()
+        self._reported_heartbeat = None
+        self._loop_thread_id = None
+        self._task = None
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._measure())
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+        logger.info(f"Монитор цикла событий запущен: порог блокировки {self.block_threshold * 1000:.0f} мс")
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def status(self) -> dict:
+        return {'lag_ms': round(self.lag * 1000, 1), 'max_lag_ms': round(self.max_lag * 1000, 1), 'blocks': self.blocks}
+
+    async def _measure(self):
+        # Лаг — насколько позже запланированного проснулся sleep: всё это время цикл был занят
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.lag = max(now - started - self.interval, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+            self._heartbeat = now
+            LOOP_LAG_SECONDS.observe(self.lag)
+            LOOP_LAG_GAUGE.set(self.lag)
+
+    def _watch(self):
+        # Отдельный поток: пока цикл заблокирован, снимаем стек главного потока в момент блокировки
+        while not self._stop.wait(max(self.block_threshold / 2, 0.01)):
+            heartbeat = self._heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for < self.block_threshold or heartbeat == self._reported_heartbeat:
+                continue
+            self._reported_heartbeat = heartbeat
+            self.blocks += 1
+            LOOP_BLOCKS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else 'стек недоступен'
+            logger.warning(f"Цикл событий заблокирован дольше {blocked_for * 1000:.0f} мс, стек:\n{stack}")
+
+# ==================== Sampling Profiler ====================
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    # Поток снимает стек главного потока каждые PROFILE_INTERVAL_MS; на сам цикл событий нагрузки нет
+    def __init__(self):
+        self.thread_id = threading.get_ident()
+        self._lock = asyncio.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    @staticmethod
+    def window(seconds: float) -> float:
+        # Фактическое окно: от 1 с до PROFILE_MAX_SECONDS
+        return min(max(seconds, 1), PROFILE_MAX_SECONDS)
+
+    async def run(self, seconds: float) -> Tuple[str, str]:
+        # Возвращает (collapsed stacks для flamegraph.pl/speedscope, краткую сводку)
+        seconds = self.window(seconds)
+        async with self._lock:
+            stacks = await asyncio.to_thread(self._sample, seconds, PROFILE_INTERVAL_MS / 1000)
+        collapsed = '\n'.join(f"{stack} {count}" for stack, count in stacks.most_common())
+        return collapsed + '\n', self._summary(stacks, seconds)
+
+    def _sample(self, seconds: float, interval: float) -> Counter:
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame))
+                frame = frame.f_back
+            if labels:
+                stacks[';'.join(reversed(labels))] += 1
+            time.sleep(interval)
+        return stacks
+
+    def _summary(self, stacks: Counter, seconds: float) -> str:
+        total = sum(stacks.values())
+        if not total:
+            return "Сэмплов нет"
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        # Цикл ждёт событий в select/epoll — это простой, а не нагрузка
+        idle = sum(count for leaf, count in leaves.items() if leaf.startswith(('select ', 'poll ', 'control ')))
+        lines = [f"{seconds:.0f} с, {total} сэмплов, простой цикла {idle * 100 / total:.0f}%", "Топ функций (self):"]
+        for leaf, count in leaves.most_common(10):
+            lines.append(f"{count * 100 / total:5.1f}% {leaf}")
+        return '\n'.join(lines)
+
+# ==================== Memory Profiler ====================
+def rss_bytes() -> Optional[int]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+def format_size(size: float) -> str:
+    for unit in ('Б', 'КБ', 'МБ'):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+class MemoryProfiler:
+    # tracemalloc включается только командой: пока он выключен, накладных расходов нет
+    def __init__(self):
+        self.snapshots: List[Tuple[datetime, tracemalloc.Snapshot]] = []
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(max(1, min(frames, 25)))
+
+    def stop(self):
+        tracemalloc.stop()
+        self.snapshots.clear()
+
+    def status(self, structures: Dict[str, int]) -> str:
+        rss = rss_bytes()
+        lines = [f"RSS: {format_size(rss) if rss is not None else 'н/д'}"]
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f"tracemalloc: включён, сейчас {format_size(current)}, пик {format_size(peak)}, снимков {len(self.snapshots)}")
+        else:
+            lines.append("tracemalloc: выключен")
+        lines.append("Размеры структур:")
+        lines.extend(f"  {name}: {size}" for name, size in structures.items())
+        return '\n'.join(lines)
+
+    async def snapshot(self) -> str:
+        snapshot = await asyncio.to_thread(self._take_snapshot)
+        self.snapshots.append((datetime.now(), snapshot))
+        # Храним ограниченное число снимков: каждый занимает память пропорционально числу аллокаций
+        del self.snapshots[:-MEMPROF_MAX_SNAPSHOTS]
+        stats = snapshot.statistics('lineno')
+        lines = [f"Снимок #{len(self.snapshots)}, всего {format_size(sum(stat.size for stat in stats))}. Топ мест аллокации:"]
+        for stat in stats[:MEMPROF_TOP]:
+            frame = stat.traceback[0]
+            lines.append(f"{format_size(stat.size)} в {stat.count} блоках — {os.path.basename(frame.filename)}:{frame.lineno}")
+        return '\n'.join(lines)
+
+    def diff(self, first: int = None, second: int = None) -> str:
+        # Номера снимков с 1; по умолчанию сравниваются два последних
+        if len(self.snapshots) < 2:
+            return "Нужно минимум два снимка: /memprof snap"
+        first = first or len(self.snapshots) - 1
+        second = second or len(self.snapshots)
+        if not (1 <= first <= len(self.snapshots) and 1 <= second <= len(self.snapshots)):
+            return f"Снимки нумеруются с 1 до {len(self.snapshots)}"
+        (first_at, old), (second_at, new) = self.snapshots[first - 1], self.snapshots[second - 1]
+        stats = new.compare_to(old, 'lineno')
+        growth = sum(stat.size_diff for stat in stats)
+        lines = [f"Снимок #{second} против #{first} ({(second_at - first_at).total_seconds():.0f} с): прирост {format_size(growth)}"]
+        for stat in stats[:MEMPROF_TOP]:
+            frame = stat.traceback[0]
+            lines.append(f"{'+' if stat.size_diff >= 0 else ''}{format_size(stat.size_diff)} ({stat.count_diff:+d} блоков) — {os.path.basename(frame.filename)}:{frame.lineno}")
+        return '\n'.join(lines)
+
+    async def object_types(self) -> str:
+        counts = await asyncio.to_thread(lambda: Counter(type(obj).__name__ for obj in gc.get_objects()))
+        lines = [f"Объектов под GC: {sum(counts.values())}. Топ типов:"]
+        lines.extend(f"{count} {name}" for name, count in counts.most_common(MEMPROF_TOP))
+        return '\n'.join(lines)
+
+    def _take_snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ))
+
+# ==================== Update Recorder ====================
+# Поля с ID пользователей и чатов; message_id и ID callback не личные и нужны обработчикам как есть
+RECORD_ID_KEYS = ('id', 'user_id')
+RECORD_TEXT_KEYS = ('text', 'caption')
+RECORD_NAME_KEYS = ('first_name', 'last_name', 'title')
+RECORD_FILE_KEYS = ('file_id', 'file_unique_id')
+RECORD_DROP_KEYS = ('phone_number', 'bio', 'description', 'invite_link', 'photo_url')
+TEXT_TOKEN_RE = re.compile(r'\S+')
+
+class UpdateAnonymizer:
+    # Одинаковый ID в пределах соли всегда даёт одинаковый псевдоним — связи между апдейтами сохраняются
+    def __init__(self, salt: bytes):
+        self.salt = salt
+
+    def pseudonym(self, value: int) -> int:
+        if value == OWNER_ID or value < 0:
+            return value
+        digest = hmac.new(self.salt, str(value).encode(), hashlib.sha256).digest()
+        return 8_000_000_000 + int.from_bytes(digest[:8], 'big') % 1_000_000_000
+
+    def token(self, value: str) -> str:
+        return hmac.new(self.salt, value.encode(), hashlib.sha256).hexdigest()[:16]
+
+    def text(self, value: str) -> str:
+        # Команды, #ID и короткие числа обработчики разбирают — оставляем; длинные числа считаем ID пользователей
+        def replace(match):
+            word = match.group(0)
+            if word.startswith(('/', '#')) or (word.isdigit() and len(word) < 7):
+                return word
+            if word.isdigit():
+                return str(self.pseudonym(int(word)))
+            return 'x' * len(word)
+        return TEXT_TOKEN_RE.sub(replace, value)
+
+    def anonymize(self, data: Any) -> Any:
+        if isinstance(data, list):
+            return [self.anonymize(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        result = {}
+        for key, value in data.items():
+            if key in RECORD_DROP_KEYS:
+                continue
+            if key in RECORD_ID_KEYS and isinstance(value, int):
+                result[key] = self.pseudonym(value)
+            elif key in RECORD_TEXT_KEYS and isinstance(value, str):
+                result[key] = self.text(value)
+            elif key in ('entities', 'caption_entities'):
+                # Смещения сущностей после замены текста неверны; команды фильтры находят и без них
+                result[key] = [entity for entity in value if entity.get('type') == 'bot_command' and entity.get('offset') == 0]
+            elif key in RECORD_NAME_KEYS and isinstance(value, str):
+                result[key] = 'User'
+            elif key == 'username' and isinstance(value, str):
+                result[key] = f"u{self.token(value)}"
+            elif key in RECORD_FILE_KEYS and isinstance(value, str):
+                result[key] = f"file_{self.token(value)}"
+            else:
+                result[key] = self.anonymize(value)
+        return result
+
+class UpdateRecorder(BaseMiddleware):
+    # Outer-middleware на dp.update: строка JSONL на апдейт — {"ts", "admin", "update"} до обработки
+    def __init__(self, path: str, is_admin: Callable[[int], Awaitable[bool]]):
+        self.path = path
+        self.is_admin = is_admin
+        self.anonymizer = UpdateAnonymizer(UPDATE_RECORD_SALT.encode() if UPDATE_RECORD_SALT else os.urandom(16))
+        # Построчная буферизация: строка уходит в page cache сразу, без fsync — это микросекунды
+        self._file = open(path, 'a', encoding='utf-8', buffering=1)
+        self.recorded = 0
+        logger.info(f"Запись апдейтов включена: {path}")
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any, data: Dict[str, Any]) -> Any:
+        try:
+            user = data.get('event_from_user')
+            # Роль нужна реплею: администраторов он заводит в пустой БД под их псевдонимами
+            admin = bool(user) and user.id != OWNER_ID and await self.is_admin(user.id)
+            update = self.anonymizer.anonymize(event.model_dump(mode='json', by_alias=True, exclude_none=True))
+            self._file.write(json.dumps({'ts': round(time.time(), 3), 'admin': admin, 'update': update}, ensure_ascii=False) + '\n')
+            self.recorded += 1
+        except Exception as e:
+            logger.warning(f"Не удалось записать апдейт: {e}")
+        return await handler(event, data)
+
+    def close(self):
+        self._file.close()
@@ -1,14 +1,116 @@
-from aiohttp import web
+import asyncio
 import logging
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from config import (
+    KEEP_WARM_INTERVAL_SECONDS, KEEP_WARM_MIN_CONNECTIONS, KEEP_WARM_CACHE_REFRESH_SECONDS, KEEP_WARM_QUIET_HOURS
+)
 
 logger = logging.getLogger(__name__)
 
-async def handle(request):
-    return web.Response(text="I'm alive!")
+def parse_quiet_hours(value: str) -> Optional[Tuple[int, int]]:
+    # "1-7" — с 01:00 до 06:59; "23-5" переходит через полночь
+    if not value:
+        return None
+    try:
+        start, end = (int(part) % 24 for part in value.split('-', 1))
+        return start, end
+    except ValueError:
+        logger.error(f"Некорректный KEEP_WARM_QUIET_HOURS: {value}")
+        return None
+
+class KeepWarmScheduler:
+    def __init__(self, db, health_url: str, refreshers: List[Callable[[], Awaitable]] = None):
+        self.db = db
+        self.health_url = health_url
+        self.refreshers = refreshers or []
+        self.quiet_hours = parse_quiet_hours(KEEP_WARM_QUIET_HOURS)
+        self.state = 'cold'
+        self.last_tick_at = None
+        self.last_refresh_at = 0.0
+        self.last_error = None
+        self._task = None
+        self._session = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Прогрев запущен: каждые {KEEP_WARM_INTERVAL_SECONDS} с, тихие часы: {KEEP_WARM_QUIET_HOURS or 'нет'}")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._session:
+            await self._session.close()
+
+    def in_quiet_hours(self, now: datetime = None) -> bool:
+        if not self.quiet_hours:
+            return False
+        hour = (now or datetime.now()).hour
+        start, end = self.quiet_hours
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def status(self) -> Dict:
+        return {
+            'state': self.state,
+            'last_tick_at': self.last_tick_at,
+            'last_error': self.last_error,
+        }
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.info(f"Состояние прогрева: {self.state} -> {state}")
+            self.state = state
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(KEEP_WARM_INTERVAL_SECONDS)
+            if self.in_quiet_hours():
+                # В тихие часы не мешаем платформе усыпить инстанс
+                self._set_state('quiet')
+                continue
+            try:
+                await self.tick()
+                self.last_error = None
+                self._set_state('warm')
+            except Exception as e:
+                self.last_error = str(e)
+                logger.warning(f"Ошибка прогрева: {e}")
+                self._set_state('cold')
+            self.last_tick_at = time.time()
+
+    async def tick(self):
+        await asyncio.gather(self._ping_health(), self._touch_pool())
+        if time.monotonic() - self.last_refresh_at >= KEEP_WARM_CACHE_REFRESH_SECONDS:
+            for refresh in self.refreshers:
+                await refresh()
+            self.last_refresh_at = time.monotonic()
+
+    async def _ping_health(self):
+        # Запрос через внешний адрес: для платформы это входящий трафик
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        async with self._session.get(self.health_url) as response:
+            if response.status != 200:
+                raise RuntimeError(f"{self.health_url} вернул {response.status}")
 
-def create_keep_alive_server(port):
-    app = web.Application()
-    app.router.add_get('/', handle)
-    app.router.add_get('/health', handle)
-    logger.info(f"Keep-alive server created on port {port}")
-    return app
\ No newline at end of file
+    async def _touch_pool(self):
+        # Держим открытыми минимум соединений, иначе их закроет max_inactive_connection_lifetime
+        count = min(KEEP_WARM_MIN_CONNECTIONS, self.db.pool.get_max_size())
+        connections = []
+        try:
+            for _ in range(count):
+                connections.append(await self.db.pool.acquire())
+            await asyncio.gather(*(conn.fetchval('SELECT 1') for conn in connections))
+        finally:
+            for conn in connections:
+                await self.db.pool.release(conn)
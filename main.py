@@ -1,27 +1,37 @@
-import asyncio, logging, os, sys, signal, asyncpg, random, string
+import asyncio, logging, os, sys, signal, random, string, time, queue, atexit
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional, List
-from aiogram import Bot, Dispatcher, Router, types
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo, Update, CallbackQuery
+from typing import Dict, Any, Awaitable, Callable, Optional, List
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, types
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo, Update, CallbackQuery, BufferedInputFile
 from aiogram.filters import CommandStart, Command
+from aiogram.dispatcher.flags import get_flag
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiohttp import web
 import re
+import html
 import json
 import traceback
-import urllib.parse
-
-# ==================== Configuration ====================
-OWNER_ID = 989062605
-RATE_LIMIT_MINUTES = 10
-MAX_BAN_HOURS = 720
-DATABASE_URL = os.getenv("DATABASE_URL")
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-APP_URL = os.getenv("APP_URL", "https://mini-app-bot-lzya.onrender.com")
-PORT = int(os.getenv("PORT", 10000))
-MESSAGE_ID_START = 100569
+
+from config import (
+    OWNER_ID, RATE_LIMIT_MINUTES, MAX_BAN_HOURS, DATABASE_URL, BOT_TOKEN, TELEGRAM_API_URL, APP_URL, PORT, BOOTSTRAP_PAGE_SIZE,
+    STARTUP_WAIT_SECONDS, KEEP_WARM_ENABLED, READY_MAX_POOL_USAGE, READY_MAX_POLL_AGE_SECONDS, READY_MAX_OUTBOUND,
+    READY_MAX_LOOP_LAG_MS, READY_MAX_DB_MS, ADMIN_API_TOKEN, UPDATE_RECORD_PATH, RETENTION_DAYS, SSE_MAX_STREAMS_PER_USER
+)
+from database import Database
+from webapp_auth import parse_init_data_user
+from keep_alive import KeepWarmScheduler
+from outbox import OutboxDispatcher, outbox_item
+from retention import RetentionJob
+from diagnostics import LoopMonitor, SamplingProfiler, MemoryProfiler, UpdateRecorder
+from metrics import (
+    http_metrics_middleware, instrument_database, instrument_bot, metrics_handler, cache_result, EVENT_QUEUE_DEPTH, IN_MEMORY_ITEMS,
+    BOT_API_IN_FLIGHT, BOT_API_LAST_OK
+)
 
 # ==================== Bot State ====================
 BOT_CLOSED = False
@@ -29,11 +39,16 @@ BOT_CLOSED_MESSAGE = ""
 
 # ==================== Logging ====================
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Запись в stdout — в отдельном потоке: медленный stdout не блокирует цикл событий
+log_queue = queue.SimpleQueue()
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
+    handlers=[QueueHandler(log_queue)]
 )
+log_listener = QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 DEBUG_MODE = True
@@ -48,400 +63,200 @@ def log_user_action(action: str, user_id: int, user_data: dict = None, extra: st
         log_msg += f" | {extra}"
     logger.info(log_msg)
 
-# ==================== Database Class ====================
-class Database:
-    def __init__(self, dsn: str):
-        self.dsn = dsn
-        self.pool = None
-        self.admin_cache = []
-        self.admin_cache_time = 0
-        self.delete_confirmations = {}
-        self.remove_data_confirmations = {}
-
-    async def create_pool(self):
-        logger.info("Подключение к PostgreSQL...")
-        self.pool = await asyncpg.create_pool(self.dsn, min_size=10, max_size=20)
-        await self.init_db()
-        logger.info("Подключение к PostgreSQL установлено")
-
-    async def init_db(self):
-        async with self.pool.acquire() as conn:
-            # Users table
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    last_message_time TIMESTAMP,
-                    is_banned BOOLEAN DEFAULT FALSE,
-                    ban_until TIMESTAMP,
-                    ban_reason TEXT,
-                    messages_sent INTEGER DEFAULT 0,
-                    accepted_tos BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Check and add accepted_tos column
-            try:
-                await conn.execute('SELECT accepted_tos FROM users LIMIT 1')
-            except asyncpg.UndefinedColumnError:
-                logger.info("Добавление колонки accepted_tos в таблицу users...")
-                await conn.execute('ALTER TABLE users ADD COLUMN accepted_tos BOOLEAN DEFAULT FALSE')
-                logger.info("Колонка accepted_tos добавлена")
-            
-            # Messages table
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    message_id INTEGER PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    content_type TEXT NOT NULL,
-                    file_id TEXT,
-                    caption TEXT,
-                    text TEXT,
-                    forwarded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_answered BOOLEAN DEFAULT FALSE,
-                    answered_by BIGINT,
-                    answered_at TIMESTAMP,
-                    answer_text TEXT,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
-                )
-            ''')
-            
-            # Check answer_text column
-            try:
-                await conn.execute('SELECT answer_text FROM messages LIMIT 1')
-            except asyncpg.UndefinedColumnError:
-                logger.info("Добавление колонки answer_text в таблицу messages...")
-                await conn.execute('ALTER TABLE messages ADD COLUMN answer_text TEXT')
-                logger.info("Колонка answer_text добавлена")
-
-            # Indexes
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id)')
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_is_answered ON messages(is_answered)')
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_forwarded_at ON messages(forwarded_at)')
-
-            # Admins table
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS admins (
-                    user_id BIGINT PRIMARY KEY,
-                    added_by BIGINT NOT NULL,
-                    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
-                )
-            ''')
-            
-            # Stats table
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS stats (
-                    id SERIAL PRIMARY KEY,
-                    total_messages INTEGER DEFAULT 0,
-                    successful_forwards INTEGER DEFAULT 0,
-                    failed_forwards INTEGER DEFAULT 0,
-                    bans_issued INTEGER DEFAULT 0,
-                    rate_limit_blocks INTEGER DEFAULT 0,
-                    answers_sent INTEGER DEFAULT 0,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Message counter
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS message_counter (
-                    id INTEGER PRIMARY KEY,
-                    last_message_id INTEGER NOT NULL
-                )
-            ''')
-            await conn.execute('''
-                INSERT INTO message_counter (id, last_message_id) 
-                VALUES (1, $1) ON CONFLICT (id) DO NOTHING
-            ''', MESSAGE_ID_START)
-            
-            # Owner user
-            await conn.execute('''
-                INSERT INTO users (user_id, username, first_name, accepted_tos) 
-                VALUES ($1, 'owner', 'Владелец', TRUE)
-                ON CONFLICT (user_id) DO UPDATE SET username='owner', first_name='Владелец', accepted_tos = TRUE
-            ''', OWNER_ID)
-            
-            # Owner as admin
-            await conn.execute('''
-                INSERT INTO admins (user_id, added_by) VALUES ($1, $1) ON CONFLICT DO NOTHING
-            ''', OWNER_ID)
-            
-            # Initial stats
-            await conn.execute('''
-                INSERT INTO stats (id, total_messages, successful_forwards, failed_forwards, bans_issued, rate_limit_blocks, answers_sent)
-                VALUES (1,0,0,0,0,0,0) ON CONFLICT DO NOTHING
-            ''')
-
-    async def accept_tos(self, user_id: int) -> bool:
-        async with self.pool.acquire() as conn:
-            result = await conn.execute('UPDATE users SET accepted_tos = TRUE, updated_at = CURRENT_TIMESTAMP WHERE user_id = $1', user_id)
-            return result.split()[1] == '1'
-
-    async def unset_tos(self, user_id: int) -> bool:
-        async with self.pool.acquire() as conn:
-            result = await conn.execute('UPDATE users SET accepted_tos = FALSE, updated_at = CURRENT_TIMESTAMP WHERE user_id = $1', user_id)
-            return result.split()[1] == '1'
-
-    async def has_accepted_tos(self, user_id: int) -> bool:
-        async with self.pool.acquire() as conn:
-            accepted = await conn.fetchval('SELECT accepted_tos FROM users WHERE user_id = $1', user_id)
-            return accepted is True
-
-    async def get_next_message_id(self) -> int:
-        async with self.pool.acquire() as conn:
-            result = await conn.fetchrow('''
-                UPDATE message_counter SET last_message_id = last_message_id + 1 WHERE id = 1 RETURNING last_message_id
-            ''')
-            return result['last_message_id'] if result else MESSAGE_ID_START
-
-    async def save_message(self, message_id: int, user_id: int, content_type: str,
-                           file_id: str = None, caption: str = None, text: str = None):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                INSERT INTO messages (message_id, user_id, content_type, file_id, caption, text)
-                VALUES ($1, $2, $3, $4, $5, $6)
-            ''', message_id, user_id, content_type, file_id, caption, text)
-
-    async def get_message(self, message_id: int) -> Optional[Dict]:
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('SELECT * FROM messages WHERE message_id = $1', message_id)
-            return dict(row) if row else None
-
-    async def get_message_with_details(self, message_id: int) -> Optional[Dict]:
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('''
-                SELECT m.*, 
-                       u.username, u.first_name as user_first_name, u.last_name as user_last_name,
-                       a.first_name as answered_by_name
-                FROM messages m
-                LEFT JOIN users u ON m.user_id = u.user_id
-                LEFT JOIN users a ON m.answered_by = a.user_id
-                WHERE m.message_id = $1
-            ''', message_id)
-            return dict(row) if row else None
-
-    async def delete_message(self, message_id: int) -> bool:
-        async with self.pool.acquire() as conn:
-            exists = await conn.fetchval('SELECT EXISTS(SELECT 1 FROM messages WHERE message_id = $1)', message_id)
-            if not exists:
-                return False
-            result = await conn.execute('DELETE FROM messages WHERE message_id = $1', message_id)
-            return result.split()[1] == '1'
-
-    async def delete_all_user_data(self, user_id: int) -> bool:
-        async with self.pool.acquire() as conn:
-            await conn.execute('DELETE FROM messages WHERE user_id = $1', user_id)
-            result = await conn.execute('DELETE FROM users WHERE user_id = $1', user_id)
-            return result.split()[1] == '1'
-
-    async def get_user_full_data(self, user_id: int) -> Optional[Dict]:
-        async with self.pool.acquire() as conn:
-            user_row = await conn.fetchrow('SELECT * FROM users WHERE user_id = $1', user_id)
-            if not user_row:
-                return None
-            user_data = dict(user_row)
-            messages_rows = await conn.fetch('''
-                SELECT message_id, text, forwarded_at, is_answered, answered_at, answer_text
-                FROM messages 
-                WHERE user_id = $1 
-                ORDER BY forwarded_at DESC
-            ''', user_id)
-            user_data['messages'] = [dict(row) for row in messages_rows]
-            user_data['unanswered_count'] = len([m for m in user_data['messages'] if not m['is_answered']])
-            return user_data
-
-    async def get_unanswered_requests(self) -> List[Dict]:
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT m.message_id, m.text, m.forwarded_at, 
-                       u.user_id, u.username, u.first_name, u.last_name
-                FROM messages m
-                JOIN users u ON m.user_id = u.user_id
-                WHERE m.is_answered = FALSE
-                ORDER BY m.forwarded_at ASC
-            ''')
-            return [dict(row) for row in rows]
-
-    async def mark_message_answered(self, message_id: int, answered_by: int, answer_text: str):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                UPDATE messages SET is_answered = TRUE, answered_by = $2, answered_at = CURRENT_TIMESTAMP, answer_text = $3
-                WHERE message_id = $1
-            ''', message_id, answered_by, answer_text)
-
-    async def get_user_inbox(self, user_id: int) -> List[Dict]:
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT m.message_id, m.answered_at, m.answered_by, m.answer_text,
-                       u.first_name as answered_by_name, orig.text as original_text
-                FROM messages m
-                JOIN messages orig ON m.message_id = orig.message_id
-                LEFT JOIN users u ON m.answered_by = u.user_id
-                WHERE m.user_id = $1 AND m.is_answered = TRUE
-                ORDER BY m.answered_at DESC
-            ''', user_id)
-            return [dict(row) for row in rows]
-
-    async def get_user_sent(self, user_id: int) -> List[Dict]:
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT m.*, u.first_name as answered_by_name
-                FROM messages m
-                LEFT JOIN users u ON m.answered_by = u.user_id
-                WHERE m.user_id = $1
-                ORDER BY m.forwarded_at DESC
-            ''', user_id)
-            return [dict(row) for row in rows]
-
-    async def get_user(self, user_id: int) -> Optional[Dict]:
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('SELECT * FROM users WHERE user_id = $1', user_id)
-            return dict(row) if row else None
-
-    async def get_unanswered_count(self, user_id: int) -> int:
-        async with self.pool.acquire() as conn:
-            count = await conn.fetchval('SELECT COUNT(*) FROM messages WHERE user_id = $1 AND is_answered = FALSE', user_id)
-            return count if count else 0
-
-    async def save_user(self, user_id: int, **kwargs):
-        async with self.pool.acquire() as conn:
-            exists = await conn.fetchval('SELECT EXISTS(SELECT 1 FROM users WHERE user_id = $1)', user_id)
-            if exists:
-                set_clause = ', '.join([f"{k} = ${i+2}" for i, k in enumerate(kwargs.keys())])
-                set_clause += ", updated_at = CURRENT_TIMESTAMP"
-                await conn.execute(f'UPDATE users SET {set_clause} WHERE user_id = $1', user_id, *kwargs.values())
-            else:
-                fields = ['user_id'] + list(kwargs.keys())
-                values = [user_id] + list(kwargs.values())
-                placeholders = ', '.join([f'${i+1}' for i in range(len(values))])
-                await conn.execute(f'INSERT INTO users ({", ".join(fields)}) VALUES ({placeholders})', *values)
-
-    async def update_user_stats(self, user_id: int, increment_messages: bool = True):
-        async with self.pool.acquire() as conn:
-            if increment_messages:
-                await conn.execute('UPDATE users SET messages_sent = messages_sent + 1, updated_at = CURRENT_TIMESTAMP WHERE user_id = $1', user_id)
-            else:
-                await conn.execute('UPDATE users SET updated_at = CURRENT_TIMESTAMP WHERE user_id = $1', user_id)
+def to_json_row(row: Dict) -> Dict:
+    return {k: v.isoformat() if isinstance(v, datetime) else v for k, v in row.items()}
 
-    async def update_user_last_message(self, user_id: int, message_time: datetime):
-        async with self.pool.acquire() as conn:
-            await conn.execute('UPDATE users SET last_message_time = $1, updated_at = CURRENT_TIMESTAMP WHERE user_id = $2', message_time, user_id)
+def parse_sync_cursor(value) -> Optional[datetime]:
+    # Курсор выдаётся как LOCALTIMESTAMP без зоны; курсор со смещением приводим к локальному времени,
+    # некорректный означает полную синхронизацию
+    try:
+        cursor = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if cursor.tzinfo is not None:
+        cursor = cursor.astimezone().replace(tzinfo=None)
+    return cursor
+
+def etag_matches(request, etag: str) -> bool:
+    if_none_match = request.headers.get('If-None-Match', '')
+    matched = any(tag.strip() in (etag, '*') for tag in if_none_match.split(','))
+    cache_result('etag', matched)
+    return matched
+
+# ==================== Live Updates ====================
+class AnswerHub:
+    def __init__(self, db: Database):
+        self.db = db
+        # Очереди пользователя в порядке подключения: первая — самая старая
+        self.subscribers: Dict[int, List[asyncio.Queue]] = {}
+        self._tasks = set()
+
+    async def start(self):
+        await self.db.add_notification_handler('message_answered', self._on_message_answered)
+        await self.db.add_notification_handler('message_delivery', self._on_message_delivery)
+
+    def subscribe(self, user_id: int) -> asyncio.Queue:
+        queues = self.subscribers.setdefault(user_id, [])
+        # Перезагрузки вкладки оставляют потоки, обрыв которых заметен только на следующем ping:
+        # вместо отказа новому подключению закрываем самое старое
+        while len(queues) >= SSE_MAX_STREAMS_PER_USER:
+            self._close_queue(queues.pop(0))
+        subscriber = asyncio.Queue(maxsize=100)
+        queues.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, user_id: int, subscriber: asyncio.Queue):
+        queues = self.subscribers.get(user_id)
+        if queues is None or subscriber not in queues:
+            return
+        queues.remove(subscriber)
+        if not queues:
+            del self.subscribers[user_id]
 
-    async def ban_user(self, user_id: int, reason: str, ban_until: Optional[datetime] = None):
-        async with self.pool.acquire() as conn:
-            await conn.execute('UPDATE users SET is_banned = TRUE, ban_reason = $1, ban_until = $2, updated_at = CURRENT_TIMESTAMP WHERE user_id = $3', reason, ban_until, user_id)
-            self.admin_cache = []
+    @staticmethod
+    def _close_queue(subscriber: asyncio.Queue):
+        # None — сигнал обработчику потока завершиться; место освобождаем за счёт самого старого события
+        if subscriber.full():
+            subscriber.get_nowait()
+        subscriber.put_nowait(None)
 
-    async def unban_user(self, user_id: int):
-        async with self.pool.acquire() as conn:
-            await conn.execute('UPDATE users SET is_banned = FALSE, ban_reason = NULL, ban_until = NULL, updated_at = CURRENT_TIMESTAMP WHERE user_id = $1', user_id)
+    def has_subscribers(self, user_id: int) -> bool:
+        return user_id in self.subscribers
 
-    async def get_all_users(self) -> List[Dict]:
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('SELECT * FROM users ORDER BY created_at DESC')
-            return [dict(row) for row in rows]
+    def queue_depth(self) -> int:
+        return sum(subscriber.qsize() for queues in self.subscribers.values() for subscriber in queues)
 
-    async def add_admin(self, user_id: int, added_by: int) -> bool:
+    def publish(self, user_id: int, event: Dict):
+        for subscriber in self.subscribers.get(user_id, ()):
+            try:
+                subscriber.put_nowait(event)
+            except asyncio.QueueFull:
+                logger.warning(f"Очередь событий пользователя {user_id} переполнена, событие пропущено")
+
+    def close(self):
+        for queues in self.subscribers.values():
+            for subscriber in queues:
+                self._close_queue(subscriber)
+
+    def _on_message_answered(self, conn, pid, channel, payload):
+        data = json.loads(payload)
+        # Полную запись читаем только если у пользователя есть открытая сессия
+        if self.has_subscribers(data['user_id']):
+            task = asyncio.create_task(self._push_answer(data['user_id'], data['message_id']))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _on_message_delivery(self, conn, pid, channel, payload):
+        # Статус целиком в payload: в БД идти не нужно
+        data = json.loads(payload)
+        self.publish(data['user_id'], {'type': 'delivery', 'message': {'message_id': data['message_id'], 'delivery_status': data['delivery_status']}})
+
+    async def _push_answer(self, user_id: int, message_id: int):
         try:
-            async with self.pool.acquire() as conn:
-                await conn.execute('''
-                    INSERT INTO admins (user_id, added_by) VALUES ($1, $2)
-                    ON CONFLICT (user_id) DO UPDATE SET is_active = TRUE, added_by = EXCLUDED.added_by, added_at = CURRENT_TIMESTAMP
-                ''', user_id, added_by)
-                self.admin_cache = []
-                return True
+            message = await self.db.get_inbox_message(message_id)
+            if not message:
+                return
+            if message.get('answered_at'):
+                message['answered_at'] = message['answered_at'].isoformat()
+            self.publish(user_id, {'type': 'answer', 'message': message})
         except Exception as e:
-            logger.error(f"Ошибка добавления администратора {user_id}: {e}")
-            return False
+            logger.error(f"Ошибка отправки события ответа #{message_id}: {e}")
+
+# ==================== Access Gate ====================
+ROLE_LEVELS = {'user': 0, 'admin': 1, 'owner': 2}
+
+class Access:
+    # Роль, закрытый режим и бан отправителя: считаются один раз на апдейт, обработчик получает аргументом access
+    def __init__(self, role: str, closed: bool, closed_message: str):
+        self.role = role
+        self.closed = closed
+        self.closed_message = closed_message
+        self.banned = False
+        self.ban_reason = ""
+        self.ban_until: Optional[datetime] = None
+
+    @property
+    def is_admin(self) -> bool:
+        return self.role != 'user'
+
+class AccessGateMiddleware(BaseMiddleware):
+    # Требования к роли задаются флагами обработчика:
+    #   flags={'role': 'admin'}                 — остальным «недостаточно прав»
+    #   flags={'role': 'admin', 'quiet': True}  — остальным без ответа
+    # Флаги известны только после фильтров, поэтому это inner-middleware на message и callback_query
+    def __init__(self, bot: 'MessageForwardingBot'):
+        self.bot = bot
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any, data: Dict[str, Any]) -> Any:
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+        role = 'owner' if user.id == OWNER_ID else 'admin' if await self.bot.db.is_admin(user.id) else 'user'
+
+        # Закрытый режим — первым: пользователь видит причину закрытия, а не отказ в правах
+        if BOT_CLOSED and role == 'user':
+            if isinstance(event, CallbackQuery):
+                return await event.answer(f"Приложение закрыто администратором. {BOT_CLOSED_MESSAGE}", show_alert=True)
+            return await event.answer(
+                f"Уважаемый пользователь, {user.first_name or ''}!\n"
+                f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
+                f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
+            )
 
-    async def remove_admin(self, user_id: int) -> bool:
-        if user_id == OWNER_ID:
-            return False
-        try:
-            async with self.pool.acquire() as conn:
-                await conn.execute('DELETE FROM admins WHERE user_id = $1', user_id)
-                self.admin_cache = []
-                return True
-        except Exception as e:
-            logger.error(f"Ошибка удаления администратора {user_id}: {e}")
-            return False
-
-    async def get_admins(self) -> List[int]:
-        if self.admin_cache and (datetime.now().timestamp() - self.admin_cache_time) < 300:
-            return self.admin_cache
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('SELECT user_id FROM admins WHERE is_active = TRUE')
-            self.admin_cache = [row['user_id'] for row in rows]
-            self.admin_cache_time = datetime.now().timestamp()
-            return self.admin_cache
-
-    async def is_admin(self, user_id: int) -> bool:
-        if user_id == OWNER_ID:
-            return True
-        admins = await self.get_admins()
-        return user_id in admins
-
-    async def update_stats(self, **kwargs):
-        async with self.pool.acquire() as conn:
-            set_clause = ', '.join([f"{k} = {k} + ${i+1}" for i, k in enumerate(kwargs.keys())])
-            set_clause += ", updated_at = CURRENT_TIMESTAMP"
-            await conn.execute(f'UPDATE stats SET {set_clause} WHERE id = 1', *kwargs.values())
-
-    async def get_stats(self) -> Dict:
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('SELECT * FROM stats WHERE id = 1')
-            if not row:
-                return {'total_messages':0, 'successful_forwards':0, 'failed_forwards':0, 'bans_issued':0, 'rate_limit_blocks':0, 'answers_sent':0}
-            return dict(row)
-
-    async def get_users_count(self) -> Dict:
-        async with self.pool.acquire() as conn:
-            total = await conn.fetchval('SELECT COUNT(*) FROM users')
-            banned = await conn.fetchval('SELECT COUNT(*) FROM users WHERE is_banned = TRUE')
-            active_today = await conn.fetchval('SELECT COUNT(*) FROM users WHERE updated_at > CURRENT_TIMESTAMP - INTERVAL \'24 hours\'')
-            return {'total': total, 'banned': banned, 'active_today': active_today}
-
-    async def clear_database(self):
-        async with self.pool.acquire() as conn:
-            await conn.execute('DELETE FROM messages')
-            await conn.execute('UPDATE message_counter SET last_message_id = $1 WHERE id = 1', MESSAGE_ID_START)
-            await conn.execute('UPDATE stats SET total_messages = 0, successful_forwards = 0, failed_forwards = 0, answers_sent = 0 WHERE id = 1')
-            await conn.execute('UPDATE users SET messages_sent = 0')
-            logger.warning("База данных очищена администратором")
-
-    async def close(self):
-        if self.pool:
-            await self.pool.close()
+        if ROLE_LEVELS[role] < ROLE_LEVELS[get_flag(data, 'role', default='user')]:
+            if get_flag(data, 'quiet'):
+                return None
+            text = "У вас недостаточно прав для выполнения данной команды."
+            if isinstance(event, CallbackQuery):
+                return await event.answer(text, show_alert=True)
+            return await event.answer(text)
+
+        access = Access(role, BOT_CLOSED, BOT_CLOSED_MESSAGE)
+        # Бан бывает только у пользователей: администраторов заблокировать нельзя, запрос к БД им не нужен
+        if role == 'user':
+            access.banned, access.ban_reason, access.ban_until = await self.bot.check_ban_status(user.id)
+        data['access'] = access
+        return await handler(event, data)
 
 # ==================== Bot Class ====================
+# Вложения обращений: подпись в уведомлении администратору и метод Bot API с именем аргумента
+MEDIA_PREVIEWS = {'photo': 'Фото', 'video': 'Видео', 'voice': 'Голосовое', 'sticker': 'Стикер'}
+MEDIA_METHODS = {
+    'photo': ('send_photo', 'photo'),
+    'video': ('send_video', 'video'),
+    'voice': ('send_voice', 'voice'),
+    'sticker': ('send_sticker', 'sticker'),
+    'document': ('send_document', 'document'),
+}
+
 class MessageForwardingBot:
-    def __init__(self, token: str, db: Database):
+    def __init__(self, token: str, db: Database, hub: AnswerHub = None):
         self.token = token
         self.db = db
+        self.hub = hub
         self.storage = MemoryStorage()
-        self.bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+        self.bot = Bot(token=token, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
         self.dp = Dispatcher(storage=self.storage)
         self.router = Router()
         self.dp.include_router(self.router)
         self.is_running = True
+        self.polling_started_at = None
+        self.profiler = SamplingProfiler()
+        self.memory_profiler = MemoryProfiler()
+        self.outbox = OutboxDispatcher(db, self.bot)
+        self.retention = RetentionJob(db)
         self.register_handlers()
+        self.router.message.middleware(AccessGateMiddleware(self))
+        self.router.callback_query.middleware(AccessGateMiddleware(self))
         logger.info("Экземпляр бота создан")
 
     async def notify_admins(self, message: str, exclude_user_id: int = None):
+        # Через outbox: обработчик не ждёт Telegram, а сбой отправки повторяется, а не теряется
         admins = await self.db.get_admins()
-        for admin_id in admins:
-            if exclude_user_id and admin_id == exclude_user_id:
-                continue
-            try:
-                await self.bot.send_message(admin_id, message)
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление администратору {admin_id}: {e}")
+        await self.db.enqueue_outbox([
+            outbox_item(admin_id, 'send_message', text=message) for admin_id in admins if admin_id != exclude_user_id
+        ])
 
     def get_user_info(self, user_data: Dict) -> str:
         if user_data and user_data.get('username'):
@@ -461,6 +276,15 @@ class MessageForwardingBot:
             return f"ID: {user_data['user_id']}"
         return "Неизвестный пользователь"
 
+    def memory_structures(self) -> Dict[str, int]:
+        # Структуры в памяти, которые могут расти без ограничений: /memprof status и метрика app_in_memory_items
+        return {
+            'delete_confirmations': len(self.db.delete_confirmations),
+            'remove_data_confirmations': len(self.db.remove_data_confirmations),
+            'fsm_storage': len(self.storage.storage),
+            'sse_subscribers': sum(len(queues) for queues in self.hub.subscribers.values()) if self.hub else 0,
+        }
+
     async def save_user_from_message(self, message: Message):
         user = message.from_user
         await self.db.save_user(user_id=user.id, username=user.username, first_name=user.first_name, last_name=user.last_name)
@@ -492,72 +316,47 @@ class MessageForwardingBot:
             return False, RATE_LIMIT_MINUTES - int(time_diff)
         return True, 0
 
-    async def forward_message_to_admins(self, message: Message, user_data: Dict, message_id: int):
+    async def admin_forward_outbox(self, user_data: Dict, message_id: int, content_type: str = 'text',
+                                   text: str = None, caption: str = None, file_id: str = None) -> List[Dict]:
+        # Пересылка обращения: текст и вложение каждому администратору; строки outbox пишутся вместе с сообщением
         content_preview = ""
-        if message.text:
-            content_preview = f"\nТекст: {message.text[:100]}{'...' if len(message.text) > 100 else ''}"
-        elif message.caption:
-            content_preview = f"\nПодпись: {message.caption[:100]}{'...' if len(message.caption) > 100 else ''}"
-        elif message.photo:
-            content_preview = "\nФото"
-        elif message.video:
-            content_preview = "\nВидео"
-        elif message.voice:
-            content_preview = "\nГолосовое"
-        elif message.sticker:
-            content_preview = "\nСтикер"
-
-        text = (
+        if text:
+            content_preview = f"\nТекст: {text[:100]}{'...' if len(text) > 100 else ''}"
+        elif caption:
+            content_preview = f"\nПодпись: {caption[:100]}{'...' if len(caption) > 100 else ''}"
+        elif content_type in MEDIA_PREVIEWS:
+            content_preview = f"\n{MEDIA_PREVIEWS[content_type]}"
+
+        notice = (
             f"Новое сообщение #{message_id}\n"
             f"Отправитель: {self.get_user_info_with_id(user_data)}\n"
             f"Время: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n"
             f"{content_preview}\n\n"
             f"Для ответа используйте: #ID текст"
         )
-        admins = await self.db.get_admins()
-        success_count = 0
-        for admin_id in admins:
-            try:
-                await self.bot.send_message(admin_id, text)
-                if message.photo:
-                    await self.bot.send_photo(admin_id, message.photo[-1].file_id)
-                elif message.video:
-                    await self.bot.send_video(admin_id, message.video.file_id)
-                elif message.voice:
-                    await self.bot.send_voice(admin_id, message.voice.file_id)
-                elif message.sticker:
-                    await self.bot.send_sticker(admin_id, message.sticker.file_id)
-                elif message.document:
-                    await self.bot.send_document(admin_id, message.document.file_id)
-                success_count += 1
-            except Exception as e:
-                logger.error(f"Ошибка отправки администратору {admin_id}: {e}")
-        logger.info(f"Сообщение #{message_id} переслано {success_count}/{len(admins)} администраторам")
-        return success_count
+        items = []
+        for admin_id in await self.db.get_admins():
+            items.append(outbox_item(admin_id, 'send_message', kind='forward', message_id=message_id,
+                                     dedup_key=f'forward:{message_id}:{admin_id}', text=notice))
+            if file_id and content_type in MEDIA_METHODS:
+                method, argument = MEDIA_METHODS[content_type]
+                items.append(outbox_item(admin_id, method, kind='forward', message_id=message_id,
+                                         dedup_key=f'forward:{message_id}:{admin_id}:{content_type}', **{argument: file_id}))
+        return items
 
     def register_handlers(self):
         
         @self.router.callback_query(lambda c: c.data == 'accept_tos')
-        async def callback_accept_tos(callback_query: CallbackQuery):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
+        async def callback_accept_tos(callback_query: CallbackQuery, access: Access):
             user_id = callback_query.from_user.id
             
-            if BOT_CLOSED:
-                await callback_query.answer(
-                    f"Приложение закрыто администратором. {BOT_CLOSED_MESSAGE}",
-                    show_alert=True
-                )
-                return
-            
             # Проверяем бан
-            is_banned, reason, ban_until = await self.check_ban_status(user_id)
-            if is_banned:
+            if access.banned:
                 ban_text = "навсегда"
-                if ban_until:
-                    ban_text = f"до {ban_until.strftime('%d.%m.%Y %H:%M')}"
+                if access.ban_until:
+                    ban_text = f"до {access.ban_until.strftime('%d.%m.%Y %H:%M')}"
                 await callback_query.answer(
-                    f"Вы заблокированы {ban_text}. Причина: {reason}",
+                    f"Вы заблокированы {ban_text}. Причина: {access.ban_reason}",
                     show_alert=True
                 )
                 return
@@ -579,13 +378,11 @@ class MessageForwardingBot:
             log_user_action("ПРИНЯТИЕ_TOS", user.id, {'username': user.username, 'first_name': user.first_name})
 
         # ========== КОМАНДЫ ДЛЯ ЗАКРЫТИЯ/ОТКРЫТИЯ БОТА ==========
-        @self.router.message(Command("close"))
+        @self.router.message(Command("close"), flags={'role': 'admin'})
         async def cmd_close_bot(message: Message):
             global BOT_CLOSED, BOT_CLOSED_MESSAGE
             
             user = message.from_user
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             
             text = message.text.replace("/close", "").strip()
             if not text:
@@ -593,6 +390,7 @@ class MessageForwardingBot:
             
             BOT_CLOSED = True
             BOT_CLOSED_MESSAGE = text
+            await self.db.save_closed_state(True, text)
             
             await message.answer(
                 f"Бот закрыт для пользователей\n"
@@ -606,16 +404,15 @@ class MessageForwardingBot:
                 exclude_user_id=user.id
             )
 
-        @self.router.message(Command("open"))
+        @self.router.message(Command("open"), flags={'role': 'admin'})
         async def cmd_open_bot(message: Message):
             global BOT_CLOSED, BOT_CLOSED_MESSAGE
             
             user = message.from_user
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             
             BOT_CLOSED = False
             BOT_CLOSED_MESSAGE = ""
+            await self.db.save_closed_state(False, "")
             
             await message.answer("Бот открыт для пользователей")
             
@@ -627,21 +424,10 @@ class MessageForwardingBot:
             )
 
         # ========== КОМАНДА ДЛЯ СБРОСА СОГЛАСИЯ TOS ==========
-        @self.router.message(Command("unset_tos"))
+        @self.router.message(Command("unset_tos"), flags={'role': 'admin'})
         async def cmd_unset_tos(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             
             args = message.text.split()
             if len(args) < 2:
@@ -678,21 +464,10 @@ class MessageForwardingBot:
                 await message.answer(f"Не удалось сбросить согласие для пользователя {target_id}.")
 
         # ========== КОМАНДА ДЛЯ ОТПРАВКИ КОПИИ ДАННЫХ ==========
-        @self.router.message(Command("send_copy"))
+        @self.router.message(Command("send_copy"), flags={'role': 'admin'})
         async def cmd_send_copy(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             
             args = message.text.split()
             if len(args) < 2:
@@ -739,21 +514,10 @@ class MessageForwardingBot:
             
             logger.info(f"Администратор {user.id} запросил копию данных пользователя {target_id}")
 
-        @self.router.message(Command("remove_data"))
+        @self.router.message(Command("remove_data"), flags={'role': 'admin'})
         async def cmd_remove_data(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             
             args = message.text.split()
             if len(args) < 2:
@@ -791,21 +555,10 @@ class MessageForwardingBot:
                 f"Команда: /confirm_remove {target_id} {confirm_code}"
             )
 
-        @self.router.message(Command("confirm_remove"))
+        @self.router.message(Command("confirm_remove"), flags={'role': 'admin'})
         async def cmd_confirm_remove(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             
             args = message.text.split()
             if len(args) < 3:
@@ -847,30 +600,20 @@ class MessageForwardingBot:
 
         # ========== КОМАНДЫ PRIVACY И TERMS ==========
         @self.router.message(Command("privacy"))
-        async def cmd_privacy(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
+        async def cmd_privacy(message: Message, access: Access):
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
             logger.info(f"/privacy от пользователя {user.id}")
             
             # Проверяем бан
-            is_banned, reason, ban_until = await self.check_ban_status(user.id)
-            if is_banned:
+            if access.banned:
                 ban_text = "навсегда"
-                if ban_until:
-                    ban_text = f"до {ban_until.strftime('%d.%m.%Y %H:%M')}"
+                if access.ban_until:
+                    ban_text = f"до {access.ban_until.strftime('%d.%m.%Y %H:%M')}"
                 await message.answer(
                     f"Доступ заблокирован\n\n"
                     f"Ваш аккаунт заблокирован {ban_text}.\n"
-                    f"Причина: {reason}\n\n"
+                    f"Причина: {access.ban_reason}\n\n"
                     f"Для вопросов: @vrsnsky_bot"
                 )
                 return
@@ -883,30 +626,20 @@ class MessageForwardingBot:
             )
 
         @self.router.message(Command("terms"))
-        async def cmd_terms(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
+        async def cmd_terms(message: Message, access: Access):
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
             logger.info(f"/terms от пользователя {user.id}")
             
             # Проверяем бан
-            is_banned, reason, ban_until = await self.check_ban_status(user.id)
-            if is_banned:
+            if access.banned:
                 ban_text = "навсегда"
-                if ban_until:
-                    ban_text = f"до {ban_until.strftime('%d.%m.%Y %H:%M')}"
+                if access.ban_until:
+                    ban_text = f"до {access.ban_until.strftime('%d.%m.%Y %H:%M')}"
                 await message.answer(
                     f"Доступ заблокирован\n\n"
                     f"Ваш аккаунт заблокирован {ban_text}.\n"
-                    f"Причина: {reason}\n\n"
+                    f"Причина: {access.ban_reason}\n\n"
                     f"Для вопросов: @vrsnsky_bot"
                 )
                 return
@@ -920,26 +653,16 @@ class MessageForwardingBot:
 
         # ========== ОСНОВНЫЕ КОМАНДЫ ==========
         @self.router.message(CommandStart())
-        async def cmd_start(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
+        async def cmd_start(message: Message, access: Access):
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
             logger.info(f"/start от пользователя {user.id} (@{user.username})")
             
             # Проверяем бан
-            is_banned, reason, ban_until = await self.check_ban_status(user.id)
-            if is_banned:
+            if access.banned:
                 ban_text = "навсегда"
-                if ban_until:
-                    ban_remaining = (ban_until - datetime.now()).total_seconds() // 3600
+                if access.ban_until:
+                    ban_remaining = (access.ban_until - datetime.now()).total_seconds() // 3600
                     if ban_remaining < 24:
                         ban_text = f"через {ban_remaining:.0f} часов" if ban_remaining > 1 else "через 1 час"
                     else:
@@ -947,7 +670,7 @@ class MessageForwardingBot:
                         ban_text = f"через {days:.0f} дней"
                 await message.answer(
                     f"ВЫ ЗАБЛОКИРОВАНЫ\n\n"
-                    f"Причина: {reason}\n"
+                    f"Причина: {access.ban_reason}\n"
                     f"Истекает: {ban_text}\n\n"
                     f"Если вы считаете, что это ошибка, обратитесь к администратору."
                 )
@@ -986,30 +709,20 @@ class MessageForwardingBot:
             await self.notify_admins(f"Новый пользователь: {self.get_user_info_with_id(user_data)}", exclude_user_id=message.from_user.id)
 
         @self.router.message(Command("app"))
-        async def cmd_app(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
+        async def cmd_app(message: Message, access: Access):
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
             logger.info(f"/app от пользователя {user.id}")
             
             # Проверяем бан
-            is_banned, reason, ban_until = await self.check_ban_status(user.id)
-            if is_banned:
+            if access.banned:
                 ban_text = "навсегда"
-                if ban_until:
-                    ban_text = f"до {ban_until.strftime('%d.%m.%Y %H:%M')}"
+                if access.ban_until:
+                    ban_text = f"до {access.ban_until.strftime('%d.%m.%Y %H:%M')}"
                 await message.answer(
                     f"Доступ запрещён\n\n"
                     f"Ваш аккаунт заблокирован {ban_text}.\n"
-                    f"Причина: {reason}"
+                    f"Причина: {access.ban_reason}"
                 )
                 return
             
@@ -1028,37 +741,26 @@ class MessageForwardingBot:
             log_user_action("APP_COMMAND", user.id, {'username': user.username, 'first_name': user.first_name})
 
         @self.router.message(Command("help"))
-        async def cmd_help(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
+        async def cmd_help(message: Message, access: Access):
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
             logger.info(f"/help от пользователя {user.id}")
             
             # Проверяем бан
-            is_banned, reason, ban_until = await self.check_ban_status(user.id)
-            if is_banned:
+            if access.banned:
                 ban_text = "навсегда"
-                if ban_until:
-                    ban_text = f"до {ban_until.strftime('%d.%m.%Y %H:%M')}"
+                if access.ban_until:
+                    ban_text = f"до {access.ban_until.strftime('%d.%m.%Y %H:%M')}"
                 await message.answer(
                     f"Доступ запрещён\n\n"
                     f"Ваш аккаунт заблокирован {ban_text}.\n"
-                    f"Причина: {reason}\n\n"
+                    f"Причина: {access.ban_reason}\n\n"
                     f"Команда /help недоступна заблокированным пользователям."
                 )
                 return
             
             # Проверяем ToS для не-админов
-            is_admin = await self.db.is_admin(user.id)
-            if not is_admin and not await self.db.has_accepted_tos(user.id):
+            if not access.is_admin and not await self.db.has_accepted_tos(user.id):
                 keyboard = InlineKeyboardMarkup(inline_keyboard=[[
                     InlineKeyboardButton(text="Принимаю условия", callback_data="accept_tos")
                 ]])
@@ -1068,14 +770,16 @@ class MessageForwardingBot:
                 )
                 return
             
-            if is_admin:
+            if access.is_admin:
                 await message.answer(
                     "Доступные команды администратора:\n\n"
                     "Основные:\n"
                     "/app - открыть приложение\n"
                     "/stats - статистика системы\n"
                     "/users - список пользователей\n"
-                    "/requests - неотвеченные обращения\n\n"
+                    "/requests - неотвеченные обращения\n"
+                    "/dbprof [N] - самые дорогие запросы к БД\n"
+                    "/memprof - диагностика памяти (tracemalloc)\n\n"
                     "Работа с сообщениями:\n"
                     "#ID текст - ответить на сообщение\n"
                     "/get #ID - информация о сообщении\n"
@@ -1106,25 +810,16 @@ class MessageForwardingBot:
                     "Для отправки сообщений используйте кнопку «Открыть приложение» или команду /app"
                 )
 
-        @self.router.message(Command("stats"))
+        @self.router.message(Command("stats"), flags={'role': 'admin', 'quiet': True})
         async def cmd_stats(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
             logger.info(f"/stats от пользователя {user.id}")
-            if not await self.db.is_admin(user.id):
-                return
             stats = await self.db.get_stats()
             user_stats = await self.db.get_users_count()
             admins = await self.db.get_admins()
+            outbox = await self.db.get_outbox_stats()
+            oldest = f" (старейшее {int(outbox['oldest_pending_seconds'])} с)" if outbox['pending'] else ""
             text = (
                 f"Статистика системы\n\n"
                 f"Пользователи:\n"
@@ -1135,26 +830,18 @@ class MessageForwardingBot:
                 f"Сообщения:\n"
                 f"Всего: {stats['total_messages']}\n"
                 f"Ответов: {stats['answers_sent']}\n"
-                f"Выдано банов: {stats['bans_issued']}"
+                f"Выдано банов: {stats['bans_issued']}\n\n"
+                f"Очередь отправки:\n"
+                f"Ожидают: {outbox['pending']}{oldest}\n"
+                f"Не доставлено: {outbox['failed']}"
             )
             await message.answer(text)
 
-        @self.router.message(Command("users"))
+        @self.router.message(Command("users"), flags={'role': 'admin', 'quiet': True})
         async def cmd_users(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
             logger.info(f"/users от пользователя {user.id}")
-            if not await self.db.is_admin(user.id):
-                return
             users = await self.db.get_all_users()
             if not users:
                 return await message.answer("В системе нет зарегистрированных пользователей.")
@@ -1171,21 +858,8 @@ class MessageForwardingBot:
                 text += f"\nОтображено 20 из {len(users)} пользователей"
             await message.answer(text)
 
-        @self.router.message(Command("ban"))
+        @self.router.message(Command("ban"), flags={'role': 'admin'})
         async def cmd_ban(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
-            user = message.from_user
-            
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             try:
                 args = message.text.split()[1:]
                 if len(args) < 2:
@@ -1228,21 +902,8 @@ class MessageForwardingBot:
             except Exception as e:
                 await message.answer(f"Ошибка: {e}")
 
-        @self.router.message(Command("unban"))
+        @self.router.message(Command("unban"), flags={'role': 'admin'})
         async def cmd_unban(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
-            user = message.from_user
-            
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             try:
                 args = message.text.split()[1:]
                 if len(args) < 1:
@@ -1265,21 +926,10 @@ class MessageForwardingBot:
             except Exception as e:
                 await message.answer(f"Ошибка: {e}")
 
-        @self.router.message(Command("admin"))
+        @self.router.message(Command("admin"), flags={'role': 'admin'})
         async def cmd_admin(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             text = message.text.split()
             if len(text) == 1:
                 await message.answer("Управление администраторами\n\n/admin add ID - добавить\n/admin remove ID - удалить\n/admin list - список")
@@ -1315,21 +965,10 @@ class MessageForwardingBot:
                         admin_text += f"{i}. {username} (ID: {aid})\n"
                 await message.answer(admin_text)
 
-        @self.router.message(Command("clear_db_1708"))
+        @self.router.message(Command("clear_db_1708"), flags={'role': 'admin'})
         async def cmd_clear_db(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             
             confirm_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
             self.db.delete_confirmations[user.id] = {
@@ -1346,21 +985,10 @@ class MessageForwardingBot:
                 f"Команда: /confirm_clear {confirm_code}"
             )
 
-        @self.router.message(Command("confirm_clear"))
+        @self.router.message(Command("confirm_clear"), flags={'role': 'admin'})
         async def cmd_confirm_clear(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             
             args = message.text.split()
             if len(args) < 2:
@@ -1390,21 +1018,8 @@ class MessageForwardingBot:
                 exclude_user_id=user.id
             )
 
-        @self.router.message(Command("get"))
+        @self.router.message(Command("get"), flags={'role': 'admin'})
         async def cmd_get_message(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
-            user = message.from_user
-            
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             parts = message.text.split(maxsplit=1)
             if len(parts) < 2:
                 return await message.answer("Использование: /get #ID")
@@ -1430,23 +1045,14 @@ class MessageForwardingBot:
                 text += f"Ответил: {answered_by}\n"
             else:
                 text += "Статус: ожидает ответа"
+            if msg_data.get('archived_at'):
+                text += f"\nВ архиве с {msg_data['archived_at'].strftime('%d.%m.%Y')}"
             await message.answer(text)
 
-        @self.router.message(Command("del"))
+        @self.router.message(Command("del"), flags={'role': 'admin'})
         async def cmd_delete_message(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             
             parts = message.text.split(maxsplit=1)
             if len(parts) < 2:
@@ -1479,21 +1085,10 @@ class MessageForwardingBot:
                 f"Команда: /confirm_del {msg_id} {confirm_code}"
             )
 
-        @self.router.message(Command("confirm_del"))
+        @self.router.message(Command("confirm_del"), flags={'role': 'admin'})
         async def cmd_confirm_delete(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
             user = message.from_user
             
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             
             args = message.text.split()
             if len(args) < 3:
@@ -1533,21 +1128,8 @@ class MessageForwardingBot:
             else:
                 await message.answer(f"Не удалось удалить сообщение #{msg_id}.")
 
-        @self.router.message(Command("requests"))
+        @self.router.message(Command("requests"), flags={'role': 'admin'})
         async def cmd_requests(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
-            user = message.from_user
-            
-            if BOT_CLOSED and not await self.db.is_admin(user.id):
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
-            
-            if not await self.db.is_admin(user.id):
-                return await message.answer("У вас недостаточно прав для выполнения данной команды.")
             unanswered = await self.db.get_unanswered_requests()
             if not unanswered:
                 await message.answer("В настоящий момент неотвеченных обращений нет.")
@@ -1565,35 +1147,133 @@ class MessageForwardingBot:
                 text += f"... и ещё {len(unanswered)-20} обращений"
             await message.answer(text)
 
+        @self.router.message(Command("dbprof"), flags={'role': 'admin'})
+        async def cmd_dbprof(message: Message):
+            parts = message.text.split()
+            limit = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 10
+            top = self.db.profiler.top(min(max(limit, 1), 20))
+            if not top:
+                return await message.answer("Запросов к БД пока не было.")
+            text = f"Топ запросов по суммарному времени с {self.db.profiler.started_at.strftime('%d.%m %H:%M')}:\n\n"
+            for i, row in enumerate(top, 1):
+                query = row['query'][:150] + ('…' if len(row['query']) > 150 else '')
+                entry = (
+                    f"{i}. всего {row['total_ms']:.0f} мс | вызовов {row['calls']} | "
+                    f"ср. {row['avg_ms']:.1f} мс | p95 {row['p95_ms']:.1f} мс | макс {row['max_ms']:.0f} мс"
+                )
+                if row['errors']:
+                    entry += f" | ошибок {row['errors']}"
+                entry += f"\n<code>{html.escape(query)}</code>\n\n"
+                # Лимит сообщения Telegram — 4096 символов, обрезать посреди тега нельзя
+                if len(text) + len(entry) > 4000:
+                    break
+                text += entry
+            await message.answer(text)
+
+        @self.router.message(Command("partitions"), flags={'role': 'owner'})
+        async def cmd_partitions(message: Message):
+            parts = message.text.split()
+            if len(parts) == 3 and parts[1] == 'detach':
+                try:
+                    month = datetime.strptime(parts[2], '%Y-%m')
+                    name = await self.db.detach_message_partition(month)
+                except ValueError as e:
+                    return await message.answer(f"Ошибка: {e}")
+                if not name:
+                    return await message.answer(f"Секция за {parts[2]} не найдена или уже отсоединена.")
+                return await message.answer(f"Секция {name} отсоединена. Таблица сохранена в БД: её можно выгрузить и удалить.")
+            partitions = await self.db.get_message_partitions()
+            text = "Секции messages (по месяцам forwarded_at):\n\n"
+            for partition in partitions:
+                text += f"{partition['name']}: ~{partition['rows_estimate']} строк, {partition['total_bytes'] / 1024 / 1024:.1f} МБ\n"
+            text += "\nОтсоединить старую секцию (после архивации, только пустую): /partitions detach ГГГГ-ММ"
+            await message.answer(text)
+
+        @self.router.message(Command("retention"), flags={'role': 'owner'})
+        async def cmd_retention(message: Message):
+            parts = message.text.split()
+            if len(parts) == 2 and parts[1] == 'run':
+                if RETENTION_DAYS <= 0:
+                    return await message.answer("Архивация выключена: RETENTION_DAYS=0.")
+                if not self.retention.trigger():
+                    return await message.answer("Архивация уже выполняется. Ход: /retention")
+                return await message.answer("Архивация запущена. Ход: /retention")
+            status = self.retention.status()
+            archive = await self.db.get_archive_stats()
+            progress = status['progress']
+            text = f"Архив отвеченных обращений старше {RETENTION_DAYS} дн.\n\n" if RETENTION_DAYS > 0 else "Архивация выключена (RETENTION_DAYS=0).\n\n"
+            text += f"В архиве: {archive['total']}, {archive['total_bytes'] / 1024 / 1024:.1f} МБ\n"
+            if archive['oldest']:
+                text += f"Самое старое: {archive['oldest'].strftime('%d.%m.%Y')}\n"
+            if status['state'] == 'running':
+                text += f"\nИдёт перенос: {progress['moved']} из ~{progress['total']}, пачек {progress['batches']}\n"
+            elif status['last_result']:
+                last = status['last_result']
+                finished = datetime.fromtimestamp(status['last_run_at']).strftime('%d.%m.%Y %H:%M')
+                text += f"\nПоследний прогон {finished}: {last['result']}, перенесено {last['moved']} за {last['seconds']} с\n"
+            if status['last_error']:
+                text += f"Ошибка: {html.escape(status['last_error'])}\n"
+            text += "\nЗапустить сейчас: /retention run"
+            await message.answer(text)
+
+        @self.router.message(Command("profile"), flags={'role': 'owner', 'quiet': True})
+        async def cmd_profile(message: Message):
+            parts = message.text.split()
+            if len(parts) < 2 or not parts[1].isdigit():
+                return await message.answer("Использование: /profile секунды")
+            if self.profiler.busy:
+                return await message.answer("Профилирование уже идёт, дождитесь окончания.")
+            seconds = self.profiler.window(int(parts[1]))
+            await message.answer(f"Профилирование запущено на {seconds:g} с...")
+            collapsed, summary = await self.profiler.run(seconds)
+            filename = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.collapsed.txt"
+            await message.answer_document(
+                BufferedInputFile(collapsed.encode('utf-8'), filename=filename),
+                caption=html.escape(summary)[:1024]
+            )
+
+        @self.router.message(Command("memprof"), flags={'role': 'admin'})
+        async def cmd_memprof(message: Message):
+            parts = message.text.split()
+            action = parts[1] if len(parts) > 1 else 'status'
+            args = [int(part) for part in parts[2:] if part.isdigit()]
+            memory = self.memory_profiler
+            if action == 'start':
+                memory.start(args[0] if args else 1)
+                text = "tracemalloc включён. Снимок: /memprof snap"
+            elif action == 'stop':
+                memory.stop()
+                text = "tracemalloc выключен, снимки удалены."
+            elif action == 'snap':
+                text = await memory.snapshot() if memory.tracing else "Сначала включите: /memprof start [глубина стека]"
+            elif action == 'diff':
+                text = memory.diff(*args[:2])
+            elif action == 'types':
+                text = await memory.object_types()
+            elif action == 'status':
+                text = memory.status({**self.memory_structures(), 'asyncio_tasks': len(asyncio.all_tasks())})
+            else:
+                text = "Использование: /memprof [status|start [глубина]|snap|diff [N M]|types|stop]"
+            await message.answer(f"<pre>{html.escape(text[:4000])}</pre>")
+
         @self.router.message()
-        async def handle_message(message: Message):
-            global BOT_CLOSED, BOT_CLOSED_MESSAGE
-            
+        async def handle_message(message: Message, access: Access):
             user = message.from_user
             user_id = user.id
-            is_admin = await self.db.is_admin(user_id)
-            
-            if BOT_CLOSED and not is_admin:
-                return await message.answer(
-                    f"Уважаемый пользователь, {user.first_name or ''}!\n"
-                    f"Администратор закрыл бота на время, попробуйте вернуться чуть позже\n"
-                    f"При закрытии бота администратор оставил сообщение: {BOT_CLOSED_MESSAGE}"
-                )
             
             # Проверяем бан
-            is_banned, reason, ban_until = await self.check_ban_status(user_id)
-            if is_banned:
+            if access.banned:
                 ban_text = "навсегда"
-                if ban_until:
-                    ban_text = f"до {ban_until.strftime('%d.%m.%Y %H:%M')}"
+                if access.ban_until:
+                    ban_text = f"до {access.ban_until.strftime('%d.%m.%Y %H:%M')}"
                 await message.answer(
                     f"Доступ запрещён\n\n"
                     f"Ваш аккаунт заблокирован {ban_text}.\n"
-                    f"Причина: {reason}"
+                    f"Причина: {access.ban_reason}"
                 )
                 return
             
-            if is_admin:
+            if access.is_admin:
                 if message.text and message.text.startswith('#'):
                     await self.handle_answer_command(message)
                 else:
@@ -1654,14 +1334,17 @@ class MessageForwardingBot:
         try:
             admin_name = self.get_user_info(await self.db.get_user(user.id))
 
-            await self.bot.send_message(
-                user_id,
-                f"Получен ответ на ваше обращение #{message_id}\n\n"
-                f"Для просмотра ответа откройте приложение.",
-                reply_markup=keyboard
-            )
-
-            await self.db.mark_message_answered(message_id, user.id, answer_text)
+            # Открытая сессия Mini App получит ответ через /api/events; иначе уведомление ставится
+            # в outbox в той же транзакции, что и отметка об ответе
+            outbox = []
+            if not (self.hub and self.hub.has_subscribers(user_id)):
+                outbox.append(outbox_item(
+                    user_id, 'send_message', kind='answer', message_id=message_id, dedup_key=f'answer:{message_id}:{user.id}:{message.message_id}',
+                    text=f"Получен ответ на ваше обращение #{message_id}\n\n"
+                         f"Для просмотра ответа откройте приложение.",
+                    reply_markup=keyboard
+                ))
+            await self.db.mark_message_answered(message_id, user.id, answer_text, outbox=outbox)
             await self.db.update_stats(answers_sent=1)
 
             await message.answer(f"Ответ на обращение #{message_id} успешно отправлен пользователю.")
@@ -1704,41 +1387,33 @@ class MessageForwardingBot:
         
         try:
             message_id = await self.db.get_next_message_id()
-            await self.db.save_message(message_id, user_id, 'text', text=text)
-            
-            class TempMessage:
-                def __init__(self, text, user_id):
-                    self.text = text
-                    self.caption = None
-                    self.content_type = 'text'
-                    self.from_user = type('User', (), {'id': user_id})()
-                    self.photo = None
-                    self.video = None
-                    self.voice = None
-                    self.sticker = None
-                    self.document = None
-            
-            temp_msg = TempMessage(text, user_id)
-            user_data = await self.db.get_user(user_id)
-            success_count = await self.forward_message_to_admins(temp_msg, user_data, message_id)
-            
-            if success_count > 0:
-                await self.db.update_user_last_message(user_id, datetime.now())
-                await self.db.update_user_stats(user_id, increment_messages=True)
-                await self.db.update_stats(total_messages=1, successful_forwards=success_count)
-                return True, message_id
+            # Пересылку выполняет OutboxDispatcher: запрос ждёт только фиксации в БД, не Telegram.
+            # Результат пересылки клиент узнаёт по delivery_status (событие delivery, /api/messages/*)
+            outbox = await self.admin_forward_outbox(user_data, message_id, text=text)
+            delivery_status = await self.db.save_message(message_id, user_id, 'text', text=text, outbox=outbox)
+            if outbox:
+                logger.info(f"Сообщение #{message_id} поставлено в очередь для {len(outbox)} администраторов")
             else:
-                return False, "no_admins"
+                # Обращение не теряется: администраторы увидят его в /requests
+                logger.warning(f"Сообщение #{message_id} сохранено, но администраторов для пересылки нет")
+
+            await self.db.update_user_last_message(user_id, datetime.now())
+            await self.db.update_user_stats(user_id, increment_messages=True)
+            await self.db.update_stats(total_messages=1)
+            return True, {'message_id': message_id, 'delivery_status': delivery_status}
         except Exception as e:
             logger.error(f"Ошибка обработки сообщения из Web App: {e}\n{traceback.format_exc()}")
             await self.db.update_stats(failed_forwards=1)
             return False, "error"
 
+    async def load_closed_state(self):
+        global BOT_CLOSED, BOT_CLOSED_MESSAGE
+        BOT_CLOSED, BOT_CLOSED_MESSAGE = await self.db.load_closed_state()
+        if BOT_CLOSED:
+            logger.info(f"Бот закрыт для пользователей: {BOT_CLOSED_MESSAGE}")
+
     async def is_admin_simple(self, user_id: int) -> bool:
-        if user_id == OWNER_ID:
-            return True
-        admins = await self.db.get_admins()
-        return user_id in admins
+        return await self.db.is_admin(user_id)
 
     async def shutdown(self, sig=None):
         logger.info(f"Завершение работы... Сигнал: {sig}")
@@ -1748,13 +1423,16 @@ class MessageForwardingBot:
         await self.db.close()
         logger.info("Завершение работы выполнено успешно.")
 
+    async def prepare_polling(self):
+        # Заодно прогревает HTTP-сессию к Bot API до первого getUpdates
+        await self.bot.delete_webhook(drop_pending_updates=True)
+
     async def run_polling(self):
         try:
-            await self.bot.delete_webhook(drop_pending_updates=True)
-            await asyncio.sleep(1)
             logger.info("Бот запущен в режиме polling")
             logger.info(f"Владелец: {OWNER_ID}")
             logger.info(f"URL приложения: {APP_URL}")
+            self.polling_started_at = time.monotonic()
             while self.is_running:
                 try:
                     await self.dp.start_polling(self.bot)
@@ -1772,36 +1450,89 @@ async def main():
         logger.error("Отсутствует BOT_TOKEN или DATABASE_URL")
         return
 
-    db = Database(DATABASE_URL)
-    await db.create_pool()
+    startup_started = time.perf_counter()
+    startup_timings = {}
+    loop_monitor = LoopMonitor()
+    loop_monitor.start()
 
-    bot = MessageForwardingBot(BOT_TOKEN, db)
+    # Объекты без сетевого ввода-вывода: создание мгновенное, подключения — ниже параллельно
+    db = Database(DATABASE_URL)
+    instrument_database(db)
+    hub = AnswerHub(db)
+    bot = MessageForwardingBot(BOT_TOKEN, db, hub)
+    instrument_bot(bot.bot, bot.dp, bot.router)
+    recorder = UpdateRecorder(UPDATE_RECORD_PATH, db.is_admin) if UPDATE_RECORD_PATH else None
+    if recorder:
+        bot.dp.update.outer_middleware(recorder)
+    EVENT_QUEUE_DEPTH.set_function(lambda: hub.queue_depth())
+    IN_MEMORY_ITEMS.set_function(lambda: {(name,): size for name, size in bot.memory_structures().items()})
+    keep_warm = KeepWarmScheduler(db, APP_URL.rstrip('/') + '/health', [db.load_admins, bot.load_closed_state])
+    startup_ready = asyncio.Event()
+    static_cache = {}
+    mini_app_dir = os.path.join(os.path.dirname(__file__), 'mini_app')
+    content_types = {'.js': 'application/javascript', '.css': 'text/css', '.html': 'text/html', '.png': 'image/png', '.jpg': 'image/jpeg', '.svg': 'image/svg+xml'}
+
+    def read_static_file(filename: str) -> Optional[tuple]:
+        file_path = os.path.join(mini_app_dir, filename)
+        if not os.path.isfile(file_path):
+            return None
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        content_type = content_types.get(os.path.splitext(filename)[1], 'text/plain')
+        return content, content_type
+
+    def preload_static_files():
+        for filename in os.listdir(mini_app_dir):
+            asset = read_static_file(filename)
+            if asset:
+                static_cache[filename] = asset
+
+    async def get_static_file(filename: str) -> Optional[tuple]:
+        asset = static_cache.get(filename)
+        cache_result('static', asset is not None)
+        if asset is None:
+            asset = await asyncio.to_thread(read_static_file, filename)
+            if asset:
+                static_cache[filename] = asset
+        return asset
+
+    def static_response(asset: tuple) -> web.Response:
+        content, content_type = asset
+        charset = 'utf-8' if content_type.startswith('text/') or content_type.endswith(('javascript', 'svg+xml')) else None
+        return web.Response(body=content, content_type=content_type, charset=charset)
+
+    @web.middleware
+    async def startup_gate_middleware(request: web.Request, handler):
+        # Порт открыт раньше, чем готовы БД и бот: API-запросы дожидаются окончания старта
+        if not startup_ready.is_set() and request.path.startswith(('/api/', '/webhook')):
+            try:
+                await asyncio.wait_for(startup_ready.wait(), timeout=STARTUP_WAIT_SECONDS)
+            except asyncio.TimeoutError:
+                return web.json_response({'ok': False, 'error': 'starting'}, status=503)
+        return await handler(request)
 
-    app = web.Application()
+    app = web.Application(middlewares=[http_metrics_middleware, startup_gate_middleware])
 
     async def static_files_handler(request: web.Request) -> web.Response:
         filename = request.match_info['filename']
-        file_path = os.path.join(os.path.dirname(__file__), 'mini_app', filename)
-        if '..' in filename or not os.path.exists(file_path):
+        if '..' in filename:
             return web.Response(status=404, text="Файл не найден")
-        content_types = {'.js': 'application/javascript', '.css': 'text/css', '.html': 'text/html', '.png': 'image/png', '.jpg': 'image/jpeg', '.svg': 'image/svg+xml'}
-        ext = os.path.splitext(filename)[1]
-        content_type = content_types.get(ext, 'text/plain')
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            return web.Response(text=content, content_type=content_type)
-        except Exception as e:
+            asset = await get_static_file(filename)
+        except Exception:
             return web.Response(status=500, text="Внутренняя ошибка сервера")
+        if not asset:
+            return web.Response(status=404, text="Файл не найден")
+        return static_response(asset)
 
     async def root_handler(request: web.Request) -> web.Response:
-        html_path = os.path.join(os.path.dirname(__file__), 'mini_app', 'index.html')
         try:
-            with open(html_path, 'r', encoding='utf-8') as f:
-                html = f.read()
-            return web.Response(text=html, content_type='text/html')
-        except FileNotFoundError:
+            asset = await get_static_file('index.html')
+        except Exception:
+            asset = None
+        if not asset:
             return web.Response(text="Файл Mini App index.html не найден", content_type='text/plain')
+        return static_response(asset)
 
     async def webhook_handler(request: web.Request) -> web.Response:
         try:
@@ -1813,9 +1544,64 @@ async def main():
             logger.error(f"Ошибка webhook: {e}")
             return web.Response(text="Ошибка", status=500)
 
-    async def api_auth_handler(request: web.Request) -> web.Response:
+    # Общие проверки /api/auth и /api/bootstrap: (ответ-ошибка или None, данные пользователя, is_admin)
+    async def authorize_web_app_user(user_info: Dict):
         global BOT_CLOSED, BOT_CLOSED_MESSAGE
-        
+
+        user_id = user_info['id']
+        logger.info(f"Авторизация пользователя {user_id} (@{user_info.get('username', 'N/A')})")
+        user_data = await db.upsert_user(user_id, username=user_info.get('username'), first_name=user_info.get('first_name'), last_name=user_info.get('last_name'))
+        log_user_action("AUTH", user_id, {'username': user_info.get('username'), 'first_name': user_info.get('first_name')})
+
+        # ПРИОРИТЕТ 1: Проверка на закрытый бот (показываем даже если забанен)
+        is_admin = await db.is_admin(user_id)
+        if BOT_CLOSED and not is_admin:
+            return web.json_response({
+                'ok': False,
+                'error': 'night_mode',
+                'message': BOT_CLOSED_MESSAGE
+            }, status=503), user_data, is_admin
+
+        # ПРИОРИТЕТ 2: Проверка бана (только если бот открыт)
+        if user_data.get('is_banned'):
+            ban_until = user_data.get('ban_until')
+            if ban_until and datetime.now() > ban_until.replace(tzinfo=None):
+                await db.unban_user(user_id)
+                user_data['is_banned'] = False
+            else:
+                ban_info = {
+                    'reason': user_data.get('ban_reason'),
+                    'until': ban_until.isoformat() if ban_until else None,
+                    'until_str': ban_until.strftime('%d.%m.%Y %H:%M') if ban_until else 'навсегда'
+                }
+                return web.json_response({
+                    'ok': False, 
+                    'error': 'banned', 
+                    'ban_info': ban_info
+                }, status=403), user_data, is_admin
+
+        # ПРИОРИТЕТ 3: Проверка ToS (только если бот открыт и не забанен)
+        if not user_data.get('accepted_tos') and not is_admin:
+            return web.json_response({
+                'ok': False,
+                'error': 'tos_not_accepted',
+                'message': 'Необходимо принять условия использования'
+            }, status=403), user_data, is_admin
+
+        return None, user_data, is_admin
+
+    def web_app_user_payload(user_info: Dict, user_data: Dict, is_admin: bool, unanswered: int) -> Dict:
+        return {
+            'id': user_info['id'],
+            'is_admin': is_admin,
+            'is_banned': bool(user_data.get('is_banned')),
+            'first_name': user_info.get('first_name'),
+            'username': user_info.get('username'),
+            'unanswered': unanswered,
+            'accepted_tos': bool(user_data.get('accepted_tos'))
+        }
+
+    async def api_auth_handler(request: web.Request) -> web.Response:
         try:
             data = await request.json()
             init_data = data.get('initData')
@@ -1823,75 +1609,67 @@ async def main():
             if not init_data:
                 return web.json_response({'ok': False, 'error': 'Нет initData'})
 
-            parsed = urllib.parse.parse_qs(init_data)
-            user_str = parsed.get('user', ['{}'])[0]
-            user_info = json.loads(urllib.parse.unquote(user_str))
+            user_info = parse_init_data_user(init_data)
             user_id = user_info.get('id')
             if not user_id:
                 return web.json_response({'ok': False, 'error': 'ID пользователя не найден'})
 
-            logger.info(f"Авторизация пользователя {user_id} (@{user_info.get('username', 'N/A')})")
-            await db.save_user(user_id, username=user_info.get('username'), first_name=user_info.get('first_name'), last_name=user_info.get('last_name'))
-            log_user_action("AUTH", user_id, {'username': user_info.get('username'), 'first_name': user_info.get('first_name')})
+            error_response, user_data, is_admin = await authorize_web_app_user(user_info)
+            if error_response:
+                return error_response
 
-            user_data = await db.get_user(user_id)
-            
-            # ПРИОРИТЕТ 1: Проверка на закрытый бот (показываем даже если забанен)
-            is_admin = await db.is_admin(user_id)
-            if BOT_CLOSED and not is_admin:
-                return web.json_response({
-                    'ok': False,
-                    'error': 'night_mode',
-                    'message': BOT_CLOSED_MESSAGE
-                }, status=503)
-
-            # ПРИОРИТЕТ 2: Проверка бана (только если бот открыт)
-            is_banned = user_data and user_data.get('is_banned')
-            if is_banned:
-                ban_until = user_data.get('ban_until')
-                if ban_until and datetime.now() > ban_until.replace(tzinfo=None):
-                    await db.unban_user(user_id)
-                    is_banned = False
-                else:
-                    ban_info = {
-                        'reason': user_data.get('ban_reason'),
-                        'until': ban_until.isoformat() if ban_until else None,
-                        'until_str': ban_until.strftime('%d.%m.%Y %H:%M') if ban_until else 'навсегда'
-                    }
-                    return web.json_response({
-                        'ok': False, 
-                        'error': 'banned', 
-                        'ban_info': ban_info
-                    }, status=403)
-
-            # ПРИОРИТЕТ 3: Проверка ToS (только если бот открыт и не забанен)
-            has_accepted = await db.has_accepted_tos(user_id)
-            if not has_accepted and not is_admin:
-                return web.json_response({
-                    'ok': False,
-                    'error': 'tos_not_accepted',
-                    'message': 'Необходимо принять условия использования'
-                }, status=403)
-
-            is_admin = await db.is_admin(user_id)
             unanswered = await db.get_unanswered_count(user_id) if not is_admin else 0
 
             return web.json_response({
                 'ok': True,
-                'user': {
-                    'id': user_id,
-                    'is_admin': is_admin,
-                    'is_banned': is_banned,
-                    'first_name': user_info.get('first_name'),
-                    'username': user_info.get('username'),
-                    'unanswered': unanswered,
-                    'accepted_tos': has_accepted
-                }
+                'user': web_app_user_payload(user_info, user_data, is_admin, unanswered)
             })
         except Exception as e:
             logger.error(f"Ошибка обработчика авторизации: {e}\n{traceback.format_exc()}")
             return web.json_response({'ok': False, 'error': str(e)})
 
+    # Всё, что нужно Mini App при открытии, за один запрос
+    async def api_bootstrap_handler(request: web.Request) -> web.Response:
+        try:
+            data = await request.json()
+            init_data = data.get('initData')
+            if not init_data:
+                return web.json_response({'ok': False, 'error': 'Нет initData'})
+
+            user_info = parse_init_data_user(init_data)
+            user_id = user_info.get('id')
+            if not user_id:
+                return web.json_response({'ok': False, 'error': 'ID пользователя не найден'})
+
+            error_response, user_data, is_admin = await authorize_web_app_user(user_info)
+            if error_response:
+                return error_response
+
+            since = parse_sync_cursor(data['since']) if data.get('since') else None
+
+            result = {'ok': True}
+            if since is not None:
+                # У клиента есть локальная копия истории: достаточно дельты
+                changes = await db.get_user_changes(user_id, since)
+                unanswered = changes['unanswered']
+                result['changes'] = {
+                    'full': changes['full'],
+                    'cursor': changes['cursor'].isoformat(),
+                    'messages': [to_json_row(m) for m in changes['messages']],
+                    'deleted': changes['deleted']
+                }
+            else:
+                pages = await db.get_bootstrap_pages(user_id, BOOTSTRAP_PAGE_SIZE)
+                unanswered = pages['unanswered']
+                result['inbox'] = pages['inbox']
+                result['sent'] = pages['sent']
+
+            result['user'] = web_app_user_payload(user_info, user_data, is_admin, unanswered if not is_admin else 0)
+            return web.json_response(result)
+        except Exception as e:
+            logger.error(f"Ошибка обработчика bootstrap: {e}\n{traceback.format_exc()}")
+            return web.json_response({'ok': False, 'error': str(e)})
+
     async def web_app_handler(request: web.Request) -> web.Response:
         global BOT_CLOSED, BOT_CLOSED_MESSAGE
         
@@ -1902,16 +1680,14 @@ async def main():
             if not init_data or not text:
                 return web.json_response({'ok': False, 'error': 'Отсутствуют данные'})
 
-            parsed = urllib.parse.parse_qs(init_data)
-            user_str = parsed.get('user', ['{}'])[0]
-            user_info = json.loads(urllib.parse.unquote(user_str))
+            user_info = parse_init_data_user(init_data)
             user_id = user_info.get('id')
             if not user_id:
                 return web.json_response({'ok': False, 'error': 'ID пользователя не найден'})
 
             success, result = await bot.process_web_app_message(user_id, text)
             if success:
-                return web.json_response({'ok': True, 'message_id': result})
+                return web.json_response({'ok': True, **result})
             else:
                 if isinstance(result, str) and result.startswith('bot_closed:'):
                     message = result[11:]
@@ -1959,9 +1735,7 @@ async def main():
             init_data = request.headers.get('X-Telegram-Init-Data')
             if not init_data:
                 return web.json_response({'error': 'Не авторизован'}, status=401)
-            parsed = urllib.parse.parse_qs(init_data)
-            user_str = parsed.get('user', ['{}'])[0]
-            user_info = json.loads(urllib.parse.unquote(user_str))
+            user_info = parse_init_data_user(init_data)
             user_id = user_info.get('id')
             if not user_id:
                 return web.json_response({'error': 'ID пользователя не найден'}, status=400)
@@ -1983,14 +1757,17 @@ async def main():
                     'until_str': ban_until.strftime('%d.%m.%Y %H:%M') if ban_until else 'навсегда'
                 }}, status=403)
             
-            messages = await db.get_user_inbox(user_id)
-            for m in messages:
-                if m.get('answered_at') and hasattr(m['answered_at'], 'isoformat'):
-                    m['answered_at'] = m['answered_at'].isoformat()
-            return web.json_response({'messages': messages})
+            etag = f'W/"inbox-{await db.get_user_messages_version(user_id)}"'
+            cache_headers = {'ETag': etag, 'Cache-Control': 'private, no-cache', 'Vary': 'X-Telegram-Init-Data'}
+            if etag_matches(request, etag):
+                return web.Response(status=304, headers=cache_headers)
+
+            messages = [to_json_row(m) for m in await db.get_user_inbox(user_id)]
+            return web.json_response({'messages': messages}, headers=cache_headers)
         except Exception as e:
-            logger.error(f"Ошибка обработчика входящих: {e}")
-            return web.json_response({'messages': []})
+            # Не пустой список: клиент принял бы ошибку за пустую историю
+            logger.error(f"Ошибка обработчика входящих: {e}\n{traceback.format_exc()}")
+            return web.json_response({'error': 'inbox_failed'}, status=500)
 
     async def api_messages_sent_handler(request: web.Request) -> web.Response:
         global BOT_CLOSED, BOT_CLOSED_MESSAGE
@@ -1999,9 +1776,7 @@ async def main():
             init_data = request.headers.get('X-Telegram-Init-Data')
             if not init_data:
                 return web.json_response({'error': 'Не авторизован'}, status=401)
-            parsed = urllib.parse.parse_qs(init_data)
-            user_str = parsed.get('user', ['{}'])[0]
-            user_info = json.loads(urllib.parse.unquote(user_str))
+            user_info = parse_init_data_user(init_data)
             user_id = user_info.get('id')
             if not user_id:
                 return web.json_response({'error': 'ID пользователя не найден'}, status=400)
@@ -2023,22 +1798,174 @@ async def main():
                     'until_str': ban_until.strftime('%d.%m.%Y %H:%M') if ban_until else 'навсегда'
                 }}, status=403)
             
-            messages = await db.get_user_sent(user_id)
-            for m in messages:
-                if m.get('forwarded_at') and hasattr(m['forwarded_at'], 'isoformat'):
-                    m['forwarded_at'] = m['forwarded_at'].isoformat()
-                if m.get('answered_at') and hasattr(m['answered_at'], 'isoformat'):
-                    m['answered_at'] = m['answered_at'].isoformat()
-            return web.json_response({'messages': messages})
+            etag = f'W/"sent-{await db.get_user_messages_version(user_id)}"'
+            cache_headers = {'ETag': etag, 'Cache-Control': 'private, no-cache', 'Vary': 'X-Telegram-Init-Data'}
+            if etag_matches(request, etag):
+                return web.Response(status=304, headers=cache_headers)
+
+            # m.* включает все временные поля, в том числе updated_at
+            messages = [to_json_row(m) for m in await db.get_user_sent(user_id)]
+            return web.json_response({'messages': messages}, headers=cache_headers)
+        except Exception as e:
+            logger.error(f"Ошибка обработчика отправленных: {e}\n{traceback.format_exc()}")
+            return web.json_response({'error': 'sent_failed'}, status=500)
+
+    async def api_messages_changes_handler(request: web.Request) -> web.Response:
+        global BOT_CLOSED, BOT_CLOSED_MESSAGE
+
+        try:
+            init_data = request.headers.get('X-Telegram-Init-Data')
+            if not init_data:
+                return web.json_response({'error': 'Не авторизован'}, status=401)
+            user_info = parse_init_data_user(init_data)
+            user_id = user_info.get('id')
+            if not user_id:
+                return web.json_response({'error': 'ID пользователя не найден'}, status=400)
+
+            is_admin = await db.is_admin(user_id)
+            if BOT_CLOSED and not is_admin:
+                return web.json_response({
+                    'error': 'night_mode',
+                    'message': BOT_CLOSED_MESSAGE
+                }, status=503)
+
+            is_banned, reason, ban_until = await bot.check_ban_status(user_id)
+            if is_banned:
+                return web.json_response({'error': 'banned', 'ban_info': {
+                    'reason': reason,
+                    'until': ban_until.isoformat() if ban_until else None,
+                    'until_str': ban_until.strftime('%d.%m.%Y %H:%M') if ban_until else 'навсегда'
+                }}, status=403)
+
+            # Некорректный или отсутствующий курсор означает полную синхронизацию
+            since = parse_sync_cursor(request.query['since']) if request.query.get('since') else None
+
+            changes = await db.get_user_changes(user_id, since)
+            return web.json_response({
+                'full': changes['full'],
+                'cursor': changes['cursor'].isoformat(),
+                'messages': [to_json_row(m) for m in changes['messages']],
+                'deleted': changes['deleted']
+            })
         except Exception as e:
-            logger.error(f"Ошибка обработчика отправленных: {e}")
-            return web.json_response({'messages': []})
+            logger.error(f"Ошибка обработчика синхронизации: {e}")
+            return web.json_response({'error': 'sync_failed'}, status=500)
+
+    async def api_events_handler(request: web.Request) -> web.StreamResponse:
+        global BOT_CLOSED, BOT_CLOSED_MESSAGE
+
+        # EventSource не умеет передавать заголовки, поэтому initData приходит в query
+        init_data = request.query.get('initData')
+        if not init_data:
+            return web.json_response({'error': 'Не авторизован'}, status=401)
+        try:
+            user_id = parse_init_data_user(init_data).get('id')
+        except Exception:
+            user_id = None
+        if not user_id:
+            return web.json_response({'error': 'ID пользователя не найден'}, status=400)
+
+        if BOT_CLOSED and not await db.is_admin(user_id):
+            return web.json_response({'error': 'night_mode', 'message': BOT_CLOSED_MESSAGE}, status=503)
+        is_banned, reason, ban_until = await bot.check_ban_status(user_id)
+        if is_banned:
+            return web.json_response({'error': 'banned'}, status=403)
+
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
+        await response.prepare(request)
+        queue = hub.subscribe(user_id)
+        try:
+            await response.write(b'retry: 5000\n\n')
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=25)
+                except asyncio.TimeoutError:
+                    await response.write(b': ping\n\n')
+                    continue
+                if event is None:
+                    break
+                data = json.dumps(event['message'], ensure_ascii=False)
+                await response.write(f"event: {event['type']}\ndata: {data}\n\n".encode('utf-8'))
+        except ConnectionResetError:
+            pass
+        finally:
+            # Отмена (остановка сервера) пробрасывается дальше, подписка снимается в любом случае
+            hub.unsubscribe(user_id, queue)
+        return response
 
     async def health_handler(request: web.Request) -> web.Response:
-        return web.Response(text="OK")
+        return web.Response(text="OK", headers={'X-Keep-Warm': keep_warm.state, 'X-Loop-Lag-Ms': f"{loop_monitor.lag * 1000:.1f}"})
+
+    async def ready_handler(request: web.Request) -> web.Response:
+        if not startup_ready.is_set():
+            return web.json_response({'ready': False, 'failed': ['starting']}, status=503)
+        checks = {}
+        failed = []
+
+        size = db.pool.get_size()
+        in_use = size - db.pool.get_idle_size()
+        usage = in_use / db.pool.get_max_size()
+        checks['pool'] = {'in_use': in_use, 'size': size, 'max': db.pool.get_max_size(), 'usage': round(usage, 2)}
+        if usage >= READY_MAX_POOL_USAGE:
+            failed.append('pool')
+
+        # До первого ответа getUpdates отсчитываем от старта polling
+        last_poll = BOT_API_LAST_OK.get('getUpdates') or bot.polling_started_at
+        poll_age = time.monotonic() - last_poll if last_poll else None
+        checks['polling'] = {'seconds_since_get_updates': round(poll_age, 1) if poll_age is not None else None}
+        if poll_age is None or poll_age > READY_MAX_POLL_AGE_SECONDS:
+            failed.append('polling')
+
+        outbound = int(BOT_API_IN_FLIGHT.get()) + hub.queue_depth()
+        checks['outbound'] = {'bot_api_in_flight': int(BOT_API_IN_FLIGHT.get()), 'sse_queued': hub.queue_depth()}
+        if outbound > READY_MAX_OUTBOUND:
+            failed.append('outbound')
+
+        checks['outbox'] = bot.outbox.status()
+        checks['loop'] = loop_monitor.status()
+        if loop_monitor.lag * 1000 > READY_MAX_LOOP_LAG_MS:
+            failed.append('loop')
+
+        # Время до БД включает ожидание соединения из пула — это и есть задержка для пользователя
+        started = time.perf_counter()
+        try:
+            async with db.pool.acquire(timeout=READY_MAX_DB_MS / 1000 * 4) as conn:
+                await conn.fetchval('SELECT 1')
+            db_ms = (time.perf_counter() - started) * 1000
+            checks['database'] = {'round_trip_ms': round(db_ms, 1)}
+            if db_ms > READY_MAX_DB_MS:
+                failed.append('database')
+        except Exception as e:
+            checks['database'] = {'error': str(e) or type(e).__name__}
+            failed.append('database')
+
+        return web.json_response({'ready': not failed, 'failed': failed, 'checks': checks}, status=503 if failed else 200)
+
+    async def admin_profile_handler(request: web.Request) -> web.Response:
+        # Без ADMIN_API_TOKEN эндпоинт не существует; токен — только в заголовке, не в URL
+        if not ADMIN_API_TOKEN or request.headers.get('Authorization') != f'Bearer {ADMIN_API_TOKEN}':
+            return web.Response(status=404, text="Not Found")
+        try:
+            seconds = float(request.query.get('seconds', 10))
+        except ValueError:
+            return web.Response(status=400, text="seconds должен быть числом")
+        if bot.profiler.busy:
+            return web.Response(status=409, text="Профилирование уже идёт")
+        collapsed, summary = await bot.profiler.run(seconds)
+        logger.info(f"Профиль по HTTP снят:\n{summary}")
+        return web.Response(text=collapsed, content_type='text/plain')
 
     async def shutdown_handler(sig):
         logger.info(f"Получен сигнал {sig}, завершение работы...")
+        hub.close()
+        await keep_warm.stop()
+        await bot.outbox.stop()
+        await bot.retention.stop()
+        await loop_monitor.stop()
         await bot.shutdown(sig)
         await asyncio.sleep(1)
 
@@ -2051,16 +1978,24 @@ async def main():
     app.router.add_post('/webhook', webhook_handler)
     app.router.add_post('/api/send', web_app_handler)
     app.router.add_post('/api/auth', api_auth_handler)
+    app.router.add_post('/api/bootstrap', api_bootstrap_handler)
     app.router.add_get('/api/messages/inbox', api_messages_inbox_handler)
     app.router.add_get('/api/messages/sent', api_messages_sent_handler)
+    app.router.add_get('/api/messages/changes', api_messages_changes_handler)
+    app.router.add_get('/api/events', api_events_handler)
     app.router.add_get('/health', health_handler)
+    app.router.add_get('/ready', ready_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/admin/profile', admin_profile_handler)
 
     logger.info("Маршруты зарегистрированы")
 
+    # Сначала открываем порт: /health отвечает, пока идёт остальная инициализация
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', PORT)
     await site.start()
+    startup_timings['http'] = time.perf_counter() - startup_started
     logger.info(f"HTTP сервер запущен на порту {PORT}")
 
     if sys.platform != 'win32':
@@ -2068,12 +2003,48 @@ async def main():
         for sig in (signal.SIGTERM, signal.SIGINT):
             loop.add_signal_handler(sig, lambda s=sig: asyncio.create_task(shutdown_handler(s)))
 
+    async def timed(name: str, coro):
+        started = time.perf_counter()
+        await coro
+        startup_timings[name] = time.perf_counter() - started
+
+    async def init_database():
+        await db.create_pool()
+        await hub.start()
+        await bot.load_closed_state()
+
+    try:
+        await asyncio.gather(
+            timed('database', init_database()),
+            timed('telegram', bot.prepare_polling()),
+            timed('static', asyncio.to_thread(preload_static_files)),
+        )
+    except Exception:
+        await runner.cleanup()
+        await bot.bot.session.close()
+        await db.close()
+        raise
+    startup_ready.set()
+    await bot.outbox.start()
+    if KEEP_WARM_ENABLED:
+        keep_warm.start()
+    if RETENTION_DAYS > 0:
+        bot.retention.start()
+    startup_timings['total'] = time.perf_counter() - startup_started
+    logger.info("Время старта: " + ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in startup_timings.items()))
+
     try:
         await bot.run_polling()
     except KeyboardInterrupt:
         logger.info("Прерывание с клавиатуры")
     finally:
+        await keep_warm.stop()
+        await bot.outbox.stop()
+        await bot.retention.stop()
+        await loop_monitor.stop()
         await runner.cleanup()
+        if recorder:
+            recorder.close()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,256 @@
+import asyncio
+import bisect
+import functools
+import inspect
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+from config import ADMIN_API_TOKEN
+from database import QUERY_COUNT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# ==================== Metric Types ====================
+# Хранилище в памяти процесса, формат вывода — Prometheus text 0.0.4
+def escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labelnames: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Counter:
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, **labels) -> float:
+        return self.values.get(tuple(labels.get(name, '') for name in self.labelnames), 0)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, format_labels(self.labelnames, key), value
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.callback: Optional[Callable[[], Dict[Tuple, float]]] = None
+
+    def set(self, value: float, **labels):
+        self.values[tuple(labels.get(name, '') for name in self.labelnames)] = value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    def set_function(self, callback: Callable[[], Any]):
+        # Значение считается в момент запроса /metrics: без меток — число, с метками — {метки: число}
+        self.callback = callback
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception as e:
+                logger.warning(f"Не удалось вычислить метрику {self.name}: {e}")
+                return
+            values = value if isinstance(value, dict) else {(): value}
+        else:
+            values = self.values
+        for key, value in values.items():
+            yield self.name, format_labels(self.labelnames, key), value
+
+class Histogram:
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # метки -> [счётчики по корзинам (последняя — +Inf), сумма, количество]
+        self.values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', format_labels(self.labelnames, key, f'le="{format_value(bound)}"'), cumulative
+            labels = format_labels(self.labelnames, key)
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+# ==================== Application Metrics ====================
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram('http_request_duration_seconds', 'Время обработки HTTP-запроса', ('route', 'method', 'status')))
+BOT_HANDLER_SECONDS = REGISTRY.register(Histogram('bot_handler_duration_seconds', 'Время работы обработчика aiogram', ('handler',)))
+BOT_UPDATE_LAG_SECONDS = REGISTRY.register(Histogram('bot_update_lag_seconds', 'Задержка между date апдейта и началом обработки', (), (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)))
+DB_CALL_SECONDS = REGISTRY.register(Histogram('db_call_duration_seconds', 'Время выполнения метода Database', ('method',)))
+DB_CALL_ERRORS = REGISTRY.register(Counter('db_call_errors_total', 'Исключения в методах Database', ('method',)))
+BOT_API_SECONDS = REGISTRY.register(Histogram('bot_api_request_duration_seconds', 'Время запроса к Bot API', ('method', 'result')))
+BOT_API_IN_FLIGHT = REGISTRY.register(Gauge('bot_api_requests_in_flight', 'Запросы к Bot API, ожидающие ответа'))
+CACHE_REQUESTS = REGISTRY.register(Counter('cache_requests_total', 'Обращения к кэшам: hit или miss', ('cache', 'result')))
+DB_POOL_CONNECTIONS = REGISTRY.register(Gauge('db_pool_connections', 'Соединения пула по состоянию', ('state',)))
+EVENT_QUEUE_DEPTH = REGISTRY.register(Gauge('sse_event_queue_depth', 'События, ожидающие отправки в SSE-потоки'))
+LOOP_LAG_SECONDS = REGISTRY.register(Histogram('event_loop_lag_seconds', 'Задержка пробуждения цикла событий', (), (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)))
+LOOP_LAG_GAUGE = REGISTRY.register(Gauge('event_loop_lag_last_seconds', 'Последний замер задержки цикла событий'))
+LOOP_BLOCKS = REGISTRY.register(Counter('event_loop_blocks_total', 'Блокировки цикла событий дольше порога'))
+DB_QUERIES_PER_REQUEST = REGISTRY.register(Histogram('http_request_db_queries', 'Запросы к БД на один HTTP-запрос', ('route',), (0, 1, 2, 3, 5, 8, 13, 21, 34)))
+ASYNCIO_TASKS = REGISTRY.register(Gauge('asyncio_tasks', 'Незавершённые задачи asyncio'))
+ASYNCIO_TASKS.set_function(lambda: len(asyncio.all_tasks()))
+IN_MEMORY_ITEMS = REGISTRY.register(Gauge('app_in_memory_items', 'Элементы в структурах памяти процесса', ('structure',)))
+OUTBOX_DELIVERIES = REGISTRY.register(Counter('outbox_deliveries_total', 'Попытки отправки из outbox: sent, retry или failed', ('kind', 'result')))
+RETENTION_ARCHIVED = REGISTRY.register(Counter('retention_archived_messages_total', 'Обращения, перенесённые в messages_archive'))
+# Метод Bot API -> time.monotonic() последнего успешного ответа (для /ready)
+BOT_API_LAST_OK: Dict[str, float] = {}
+
+def cache_result(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+# ==================== Instrumentation ====================
+@web.middleware
+async def http_metrics_middleware(request: web.Request, handler):
+    # Метка — шаблон маршрута, а не путь: иначе число серий растёт с каждым файлом и ID
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    started = time.perf_counter()
+    status = 500
+    queries = [0]
+    QUERY_COUNT.set(queries)
+    try:
+        response = await handler(request)
+        status = response.status
+        # Логгер запросов asyncpg вызывается через call_soon: один проход цикла, чтобы учесть последние
+        await asyncio.sleep(0)
+        if not response.prepared:
+            response.headers['X-DB-Queries'] = str(queries[0])
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method, status=status)
+        DB_QUERIES_PER_REQUEST.observe(queries[0], route=route)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Inner-middleware: вызывается уже после выбора обработчика, имя берём из его функции
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any, data: Dict[str, Any]) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            BOT_HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+class UpdateLagMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any, data: Dict[str, Any]) -> Any:
+        # У callback_query нет своей даты отправки, лаг считаем только по сообщениям
+        message = event.message or event.edited_message
+        if message is not None:
+            BOT_UPDATE_LAG_SECONDS.observe(max(time.time() - message.date.timestamp(), 0.0))
+        return await handler(event, data)
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        result = 'error'
+        BOT_API_IN_FLIGHT.inc()
+        try:
+            response = await make_request(bot, method)
+            result = 'ok'
+            BOT_API_LAST_OK[method.__api_method__] = time.monotonic()
+            return response
+        finally:
+            BOT_API_IN_FLIGHT.dec()
+            BOT_API_SECONDS.observe(time.perf_counter() - started, method=method.__api_method__, result=result)
+
+def timed_db_method(name: str, method):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        except Exception:
+            DB_CALL_ERRORS.inc(method=name)
+            raise
+        finally:
+            DB_CALL_SECONDS.observe(time.perf_counter() - started, method=name)
+    return wrapper
+
+def instrument_database(db):
+    # Оборачиваем публичные корутины экземпляра: классы и вызовы в database.py не меняются
+    for name, method in inspect.getmembers(type(db), inspect.iscoroutinefunction):
+        if name.startswith('_') or name in ('create_pool', 'close'):
+            continue
+        setattr(db, name, timed_db_method(name, getattr(db, name)))
+
+    def pool_connections():
+        if db.pool is None:
+            return {}
+        idle = db.pool.get_idle_size()
+        return {('in_use',): db.pool.get_size() - idle, ('idle',): idle}
+    DB_POOL_CONNECTIONS.set_function(pool_connections)
+
+def instrument_bot(bot, dp, router):
+    bot.session.middleware(BotApiMetricsMiddleware())
+    dp.update.outer_middleware(UpdateLagMiddleware())
+    router.message.middleware(HandlerMetricsMiddleware())
+    router.callback_query.middleware(HandlerMetricsMiddleware())
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    # Внутренности обработчиков, БД и очередей — только с токеном, как /admin/profile
+    if not ADMIN_API_TOKEN or request.headers.get('Authorization') != f'Bearer {ADMIN_API_TOKEN}':
+        return web.Response(status=404, text="Not Found")
+    return web.Response(body=REGISTRY.render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+
+from config import (
+    OUTBOX_BATCH_SIZE, OUTBOX_CONCURRENCY, OUTBOX_POLL_SECONDS, OUTBOX_LEASE_SECONDS, OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_RETRY_BASE_SECONDS, OUTBOX_RETRY_MAX_SECONDS, OUTBOX_KEEP_HOURS
+)
+from metrics import OUTBOX_DELIVERIES
+
+logger = logging.getLogger(__name__)
+
+# Методы Bot, которые можно ставить в очередь; payload — их именованные аргументы кроме chat_id
+OUTBOX_METHODS = ('send_message', 'send_photo', 'send_video', 'send_voice', 'send_sticker', 'send_document')
+PURGE_INTERVAL_SECONDS = 3600
+
+def outbox_item(chat_id: int, method: str, kind: str = 'notice', message_id: int = None, dedup_key: str = None, **payload) -> Dict:
+    # kind: forward — пересылка обращения администратору, answer — уведомление пользователя об ответе, notice — остальное
+    markup = payload.get('reply_markup')
+    if isinstance(markup, InlineKeyboardMarkup):
+        payload['reply_markup'] = markup.model_dump(mode='json', exclude_none=True)
+    return {'chat_id': chat_id, 'method': method, 'payload': payload, 'kind': kind, 'message_id': message_id, 'dedup_key': dedup_key}
+
+def retry_delay(attempts: int) -> float:
+    # Экспонента с разбросом: повторы после сбоя Telegram не приходят одной волной
+    delay = min(OUTBOX_RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0), OUTBOX_RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+class OutboxDispatcher:
+    def __init__(self, db, bot: Bot):
+        self.db = db
+        self.bot = bot
+        self.counts = {'sent': 0, 'retry': 0, 'failed': 0}
+        self.last_error = None
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self._last_purge = 0.0
+        self._stopping = False
+        self._task = None
+
+    async def start(self):
+        await self.db.add_notification_handler('outbox', self._on_notify)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Отправка из outbox запущена: до {OUTBOX_BATCH_SIZE} строк за раз, {OUTBOX_CONCURRENCY} чатов параллельно")
+
+    async def stop(self, timeout: float = 5):
+        # Текущую пачку даём дослать; недосланное вернётся в очередь по истечении аренды
+        self._stopping = True
+        self._wakeup.set()
+        if self._task:
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Отправка из outbox не завершилась вовремя, прервана")
+            except asyncio.CancelledError:
+                pass
+
+    def wake(self):
+        self._wakeup.set()
+
+    def status(self) -> Dict:
+        return {**self.counts, 'last_error': self.last_error}
+
+    async def flush(self, timeout: float = 10):
+        # Отправить всё, что уже пора отправлять (bench/replay.py, тесты); отложенные повторы не ждёт
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and await self.process_batch():
+            pass
+
+    def _on_notify(self, conn, pid, channel, payload):
+        self._wakeup.set()
+
+    async def _run(self):
+        while not self._stopping:
+            # Сброс до выборки: NOTIFY, пришедший во время отправки, не теряется
+            self._wakeup.clear()
+            try:
+                claimed = await self.process_batch()
+                if time.monotonic() - self._last_purge > PURGE_INTERVAL_SECONDS:
+                    self._last_purge = time.monotonic()
+                    purged = await self.db.purge_outbox(OUTBOX_KEEP_HOURS)
+                    if purged:
+                        logger.info(f"Из outbox удалено {purged} обработанных строк")
+            except Exception as e:
+                logger.error(f"Ошибка обработки outbox: {e}")
+                self.last_error = str(e)
+                claimed = 0
+            if claimed >= OUTBOX_BATCH_SIZE or self._stopping:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_batch(self) -> int:
+        rows = await self.db.claim_outbox(OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS)
+        if not rows:
+            return 0
+        # В пределах чата — строго по порядку постановки (текст, затем вложение), разные чаты — параллельно
+        chats = defaultdict(list)
+        for row in rows:
+            chats[row['chat_id']].append(row)
+        sent: List[int] = []
+        retry: List[Tuple] = []
+        failed: List[Tuple] = []
+        await asyncio.gather(*(self._send_chat(chat_rows, sent, retry, failed) for chat_rows in chats.values()))
+        await self.db.finish_outbox(sent, retry, failed)
+
+        by_id = {row['id']: row for row in rows}
+        for result, ids in (('sent', sent), ('retry', [item[0] for item in retry]), ('failed', [item[0] for item in failed])):
+            self.counts[result] += len(ids)
+            for outbox_id in ids:
+                OUTBOX_DELIVERIES.inc(kind=by_id[outbox_id]['kind'], result=result)
+        # Пересылка считается по текстовому уведомлению: одно на администратора, как раньше
+        def forwards(ids: List[int]) -> int:
+            return sum(1 for outbox_id in ids if by_id[outbox_id]['kind'] == 'forward' and by_id[outbox_id]['method'] == 'send_message')
+        successful, unsuccessful = forwards(sent), forwards([item[0] for item in failed])
+        if successful or unsuccessful:
+            await self.db.update_stats(successful_forwards=successful, failed_forwards=unsuccessful)
+        finished = sent + [item[0] for item in failed]
+        await self.db.update_delivery_status([by_id[outbox_id]['message_id'] for outbox_id in finished if by_id[outbox_id]['kind'] == 'forward'])
+        return len(rows)
+
+    async def _send_chat(self, rows: List[Dict], sent: List[int], retry: List[Tuple], failed: List[Tuple]):
+        async with self._semaphore:
+            # Аренда отсчитана от выборки, а чат мог ждать семафора или медленного Telegram: продлеваем
+            # перед первой строкой и затем каждые пол-аренды. Строку, которую уже забрал другой процесс,
+            # не шлём (иначе дубль), остаток чата тоже — чтобы не нарушить порядок
+            owned, renewed_at = set(), None
+            for index, row in enumerate(rows):
+                if renewed_at is None or time.monotonic() - renewed_at > OUTBOX_LEASE_SECONDS / 2:
+                    owned = await self.db.renew_outbox_lease(rows[index:], OUTBOX_LEASE_SECONDS)
+                    renewed_at = time.monotonic()
+                if row['id'] not in owned:
+                    logger.warning(f"Аренда outbox #{row['id']} истекла до отправки, строка оставлена другому процессу")
+                    return
+                try:
+                    await self._deliver(row)
+                    sent.append(row['id'])
+                    continue
+                except TelegramRetryAfter as e:
+                    # Flood control: ждём, сколько сказал Telegram; попытка не засчитывается
+                    delay, error, counted = e.retry_after, str(e), False
+                except (TelegramForbiddenError, TelegramBadRequest, ValueError) as e:
+                    # Бот заблокирован, чат не найден, некорректный запрос — повтор не поможет
+                    logger.warning(f"Outbox #{row['id']} для {row['chat_id']} не отправлен: {e}")
+                    failed.append((row['id'], str(e)))
+                    continue
+                except Exception as e:
+                    delay, error, counted = retry_delay(row['attempts']), str(e) or type(e).__name__, True
+                    self.last_error = error
+                if counted and row['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+                    logger.error(f"Outbox #{row['id']} для {row['chat_id']} не отправлен после {row['attempts']} попыток: {error}")
+                    failed.append((row['id'], error))
+                    continue
+                # Остаток чата откладывается вместе со строкой, чтобы не нарушить порядок
+                retry.append((row['id'], delay, error, counted))
+                retry.extend((rest['id'], delay, error, False) for rest in rows[index + 1:])
+                return
+
+    async def _deliver(self, row: Dict):
+        if row['method'] not in OUTBOX_METHODS:
+            raise ValueError(f"метод {row['method']} не поддерживается")
+        payload = dict(row['payload'])
+        if payload.get('reply_markup'):
+            payload['reply_markup'] = InlineKeyboardMarkup.model_validate(payload['reply_markup'])
+        await getattr(self.bot, row['method'])(row['chat_id'], **payload)
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict
+
+from config import RETENTION_DAYS, RETENTION_BATCH_SIZE, RETENTION_PAUSE_SECONDS, RETENTION_INTERVAL_HOURS
+from metrics import RETENTION_ARCHIVED
+
+logger = logging.getLogger(__name__)
+
+# Отчёт о ходе переноса в лог — не чаще, чем раз в столько секунд
+PROGRESS_LOG_SECONDS = 30
+
+class RetentionJob:
+    # Переносит отвеченные обращения старше RETENTION_DAYS из messages в messages_archive
+    def __init__(self, db):
+        self.db = db
+        self.state = 'idle'
+        self.progress = {'moved': 0, 'total': 0, 'batches': 0, 'last_id': 0}
+        self.last_run_at = None
+        self.last_result = None
+        self.last_error = None
+        self._task = None
+        self._manual_task = None
+        self._run_lock = asyncio.Lock()
+        self._stopping = False
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Архивация запущена: отвеченные старше {RETENTION_DAYS} дн., каждые {RETENTION_INTERVAL_HOURS} ч")
+
+    async def stop(self):
+        # Прерываем между пачками: каждая пачка — своя транзакция, недоделанное перенесётся в следующий раз
+        self._stopping = True
+        for task in (self._task, self._manual_task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+    def trigger(self, days: int = RETENTION_DAYS) -> bool:
+        # Внеочередной прогон (/retention run): команда отвечает сразу, ход виден в status()
+        if self._run_lock.locked():
+            return False
+        self._manual_task = asyncio.create_task(self._run_logged(days))
+        return True
+
+    def status(self) -> Dict:
+        return {
+            'state': self.state,
+            'progress': dict(self.progress),
+            'last_run_at': self.last_run_at,
+            'last_result': self.last_result,
+            'last_error': self.last_error,
+        }
+
+    async def _run(self):
+        # Первый прогон — через минуту после старта, чтобы не мешать прогреву и разбору очереди
+        await asyncio.sleep(60)
+        while not self._stopping:
+            await self._run_logged(RETENTION_DAYS)
+            await asyncio.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
+    async def _run_logged(self, days: int):
+        try:
+            await self.run_once(days)
+        except Exception as e:
+            logger.error(f"Ошибка архивации: {e}")
+
+    async def run_once(self, days: int = RETENTION_DAYS) -> Dict:
+        if self._run_lock.locked():
+            raise RuntimeError("архивация уже выполняется")
+        async with self._run_lock:
+            cutoff = datetime.now() - timedelta(days=days)
+            self.state = 'running'
+            self.progress = {'moved': 0, 'total': 0, 'batches': 0, 'last_id': 0}
+            started = time.monotonic()
+            last_log = started
+            result = 'done'
+            try:
+                self.progress['total'] = await self.db.count_archivable_messages(cutoff)
+                if self.progress['total']:
+                    logger.info(f"Архивация: к переносу {self.progress['total']} обращений, отвеченных до {cutoff:%d.%m.%Y}")
+                while True:
+                    if self._stopping:
+                        result = 'stopped'
+                        break
+                    batch = await self.db.archive_messages_batch(cutoff, self.progress['last_id'], RETENTION_BATCH_SIZE)
+                    if batch is None:
+                        # Переносом занята другая реплика — она и доведёт дело до конца
+                        result = 'skipped'
+                        break
+                    moved, last_id = batch
+                    if last_id is None:
+                        break
+                    self.progress['moved'] += moved
+                    self.progress['batches'] += 1
+                    self.progress['last_id'] = last_id
+                    RETENTION_ARCHIVED.inc(moved)
+                    if time.monotonic() - last_log >= PROGRESS_LOG_SECONDS:
+                        last_log = time.monotonic()
+                        logger.info(f"Архивация: перенесено {self.progress['moved']} из ~{self.progress['total']}, message_id до {last_id}")
+                    # Пауза между пачками: автовакуум и обычные запросы не конкурируют с переносом
+                    await asyncio.sleep(RETENTION_PAUSE_SECONDS)
+                self.last_error = None
+            except asyncio.CancelledError:
+                result = 'stopped'
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+                result = 'error'
+                raise
+            finally:
+                self.state = 'idle'
+                self.last_run_at = time.time()
+                self.last_result = {'result': result, 'moved': self.progress['moved'], 'seconds': round(time.monotonic() - started, 1)}
+                if self.progress['moved']:
+                    logger.info(f"Архивация завершена: перенесено {self.progress['moved']} за {self.last_result['seconds']} с")
+            return self.last_result
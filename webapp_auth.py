@@ -0,0 +1,33 @@
+import hashlib
+import hmac
+import json
+import logging
+import urllib.parse
+from typing import Dict, Optional
+
+from config import BOT_TOKEN
+
+logger = logging.getLogger(__name__)
+
+# ==================== Web App initData ====================
+# Общий разбор initData для main.py и api.py; вынесено отдельно, чтобы мерить в bench/microbench.py
+def parse_init_data_user(init_data: str) -> Dict:
+    parsed = urllib.parse.parse_qs(init_data)
+    user_str = parsed.get('user', ['{}'])[0]
+    return json.loads(urllib.parse.unquote(user_str))
+
+def validate_telegram_data(init_data: str) -> Optional[Dict]:
+    # Алгоритм Telegram для Mini App: значения раскодированы, ключ — HMAC("WebAppData", токен бота)
+    try:
+        data = dict(urllib.parse.parse_qsl(init_data, keep_blank_values=True))
+        hash_check = data.pop('hash', '')
+        data_check_string = '\n'.join(f"{k}={v}" for k, v in sorted(data.items()))
+        secret_key = hmac.new(b'WebAppData', BOT_TOKEN.encode(), hashlib.sha256).digest()
+        h = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256)
+
+        if hmac.compare_digest(h.hexdigest(), hash_check):
+            return data
+        return None
+    except Exception as e:
+        logger.error(f"Validation error: {e}")
+        return None